@@ -3,8 +3,9 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
 from dataclasses import dataclass, field
-from typing import Any, Dict, List
-import textwrap, json, sys, argparse
+from functools import lru_cache
+from typing import IO, Any, Dict, FrozenSet, Iterable, Iterator, List, MutableMapping, NamedTuple, Optional, Sequence, Set, Tuple
+import textwrap, json, sys, argparse, re, time, os
 
 # -------------------- Domain & Template --------------------
 DOMAIN_TREE: Dict[str, Any] = {
@@ -289,62 +290,3261 @@ DEFAULT_KEYS = [
     "Beteiligte","Förderideen","Kompetenzziel","Aufgabenbeschreibung","Evaluationskriterium"
 ]
 
+# -------------------- Token estimate --------------------
+# Lokale, BPE-ähnliche Schätzung ohne Netz: Text wird in Wortstücke zerlegt, jedes Stück
+# kostet ~1 Token je 4 ASCII- bzw. 3 Nicht-ASCII-Zeichen (Ziffern: je 3), Satzzeichen und
+# Zeilenumbrüche je 1. Lange Texte werden über Stichprobenfenster hochgerechnet.
+_PIECE_RE = re.compile(r"\d+|[^\W\d_]+|[^\w\s]|_")
+_TOKEN_SAMPLE = 2048
+
+@lru_cache(maxsize=16384)
+def _piece_tokens(piece: str) -> int:
+    n = len(piece)
+    if n <= 2: return 1
+    if piece.isdigit(): return (n + 2) // 3
+    per = 4 if piece.isascii() else 3
+    return (n + per - 1) // per
+
+def _count_tokens(text: str) -> int:
+    return sum(map(_piece_tokens, _PIECE_RE.findall(text))) + text.count("\n")
+
+def estimate_tokens(text: str) -> int:
+    n = len(text)
+    if n <= 4 * _TOKEN_SAMPLE:
+        return _count_tokens(text) if n else 0
+    step = n // 4
+    windows = [text[i*step:i*step + _TOKEN_SAMPLE] for i in range(4)]
+    return round(sum(map(_count_tokens, windows)) * n / sum(map(len, windows)))
+
+# -------------------- Template engine --------------------
+# PROMPT_TEMPLATE wird einmal in Segmente zerlegt und pro Auftrag gecacht;
+# das Rendern ist danach ein einziger join über die Segmentliste.
+_PLACEHOLDER_RE = re.compile(r"\{([^{}\n]+)\}")
+_CONTEXT_LINE_RE = re.compile(r"^(- ([^\n]+): )\{([^{}\n]+)\}(\n?)$")
+_CORE_KEYS = frozenset({"Bereich", "Rolle", "Auftrag"})
+
+@dataclass(frozen=True)
+class _Slot:
+    key: str
+    head: str = ""  # "- Key: " einer Kontextzeile (nur im Kompaktmodus)
+    tail: str = ""  # Zeilenende einer Kontextzeile (nur im Kompaktmodus)
+    overhead: int = 0  # geschätzte Tokens von head + tail
+
+@dataclass(frozen=True)
+class CompiledTemplate:
+    parts: Tuple[Any, ...]  # str-Literale und _Slot-Platzhalter
+    keys: Optional[FrozenSet[str]] = None  # None = alle DEFAULT_KEYS aktiv
+    static_tokens: int = 0  # geschätzte Tokens aller Literale
+
+    def render(self, selections: Dict[str, Any]) -> str:
+        out: List[str] = []
+        append = out.append
+        for part in self.parts:
+            if part.__class__ is str:
+                append(part); continue
+            val = _format_value(selections.get(part.key))
+            if val:
+                if part.head: append(part.head)
+                append(val)
+                if part.tail: append(part.tail)
+        return "".join(out)
+
+def _format_value(val: Any) -> str:
+    if val is None: return ""
+    if isinstance(val, str): return val
+    if isinstance(val, list): return ", ".join(v if isinstance(v, str) else str(v) for v in val)
+    return str(val)
+
+def compile_template(template: str, keys: Iterable[str], active: Optional[FrozenSet[str]] = None,
+                     compact: bool = False) -> CompiledTemplate:
+    # active: nur diese Platzhalter bleiben Slots, alle anderen werden als leer "eingebacken".
+    # compact: "- Key: {Key}"-Zeilen entfallen, wenn der Wert leer ist.
+    known = set(keys)
+    parts: List[Any] = []
+    buf: List[str] = []
+    def flush() -> None:
+        if buf:
+            parts.append("".join(buf)); buf.clear()
+    for line in template.splitlines(keepends=True):
+        m = _CONTEXT_LINE_RE.match(line)
+        if compact and m and m.group(2) == m.group(3) and m.group(3) in known:
+            key = m.group(3)
+            if active is None or key in active:
+                flush(); parts.append(_Slot(key, m.group(1), m.group(4), estimate_tokens(m.group(1) + m.group(4))))
+            continue
+        pos = 0
+        for pm in _PLACEHOLDER_RE.finditer(line):
+            key = pm.group(1)
+            if key not in known: continue
+            buf.append(line[pos:pm.start()]); pos = pm.end()
+            if active is None or key in active:
+                flush(); parts.append(_Slot(key))
+        buf.append(line[pos:])
+    flush()
+    static = sum(estimate_tokens(p) for p in parts if p.__class__ is str)
+    return CompiledTemplate(parts=tuple(parts), keys=active, static_tokens=static)
+
+def compiled_prompt_template(auftrag: str = "", compact: bool = False,
+                             pack: Optional["TemplatePack"] = None) -> CompiledTemplate:
+    return (pack or BUILTIN_PACK).compiled(auftrag, compact)
+
+def _legacy_compose(selections: Dict[str, Any]) -> str:
+    # Referenzimplementierung (33× str.replace) für Tests und Benchmark
+    data = {k: "" for k in DEFAULT_KEYS}
+    for k, v in selections.items():
+        data[k] = ", ".join(v) if isinstance(v, list) else v
+    prompt = PROMPT_TEMPLATE
+    for k in DEFAULT_KEYS:
+        prompt = prompt.replace("{"+k+"}", data.get(k, ""))
+    return prompt.strip()
+
 # -------------------- Pure logic --------------------
-@dataclass
+class _Raw:
+    # Wert in einem Optionsfeld, der sich nicht als Index speichern lässt (z. B. int aus JSON)
+    __slots__ = ("value",)
+    def __init__(self, value: Any) -> None:
+        self.value = value
+    def __eq__(self, other: Any) -> bool:
+        return other.__class__ is _Raw and other.value == self.value
+
+_MISSING = object()
+_NO_SPECS: Dict[str, "FieldSpec"] = {}
+
+class TrackedSelections(MutableMapping[str, Any]):
+    # Kompakte Auswahl einer Sitzung mit Änderungsverfolgung (`dirty`):
+    # Optionswerte liegen als Index (Mehrfachauswahl: bytes mit Indizes) in den geteilten
+    # Optionstabellen des DomainIndex, nur Freitext bleibt ein eigener String je Sitzung.
+    # Zuweisungen eines gleichen Werts zählen nicht als Änderung.
+    __slots__ = ("_data", "_specs", "dirty", "version")
+
+    def __init__(self, data: Any = ()) -> None:
+        self._data: Dict[str, Any] = {}
+        self._specs = _NO_SPECS
+        self.dirty: Optional[Set[str]] = None  # erst bei der ersten Änderung angelegt
+        self.version = 0  # zählt Änderungen (Autosave)
+        for k, v in (data.items() if hasattr(data, "items") else data):
+            self[k] = v
+        self.dirty = None  # Caches sind beim Anlegen ohnehin leer
+
+    def _encode(self, key: str, value: Any) -> Any:
+        spec = self._specs.get(key)
+        cls = value.__class__
+        if spec is not None and spec.options:
+            if cls is str:
+                i = spec.positions.get(value)
+                return value if i is None else i
+            if cls is list and spec.multi:
+                try:
+                    return bytes([spec.positions[v] for v in value])
+                except (KeyError, TypeError, ValueError):
+                    return value
+        return _Raw(value) if cls is int or cls is bytes else value
+
+    def _decode(self, key: str, stored: Any) -> Any:
+        cls = stored.__class__
+        if cls is int: return self._specs[key].options[stored]
+        if cls is bytes:
+            opts = self._specs[key].options
+            return [opts[i] for i in stored]
+        if cls is _Raw: return stored.value
+        return stored
+
+    def _respec(self) -> None:
+        # Auftrag/Bereich gewechselt: Werte mit den alten Tabellen lesen, mit den neuen speichern
+        data = self._data
+        plain = {k: self._decode(k, v) for k, v in data.items()}
+        auftrag = plain.get("Auftrag")
+        specs = pack_for(plain.get("Bereich")).index.specs
+        self._specs = specs.get(auftrag, _NO_SPECS) if isinstance(auftrag, str) else _NO_SPECS
+        for k, v in plain.items():
+            data[k] = self._encode(k, v)
+
+    def __getitem__(self, key: str) -> Any:
+        return self._decode(key, self._data[key])
+
+    def get(self, key: str, default: Any = None) -> Any:
+        stored = self._data.get(key, _MISSING)
+        return default if stored is _MISSING else self._decode(key, stored)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key.__class__ is str: key = sys.intern(key)
+        new = self._encode(key, value)
+        old = self._data.get(key, _MISSING)
+        if old is new or (old.__class__ is new.__class__ and old == new): return
+        self._data[key] = new
+        self.version += 1
+        if self.dirty is None: self.dirty = {key}
+        else: self.dirty.add(key)
+        if key == "Auftrag" or key == "Bereich": self._respec()
+
+    def __delitem__(self, key: str) -> None:
+        del self._data[key]
+        self.version += 1
+        if self.dirty is None: self.dirty = {key}
+        else: self.dirty.add(key)
+        if key == "Auftrag" or key == "Bereich": self._respec()
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self._data
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {k: self._decode(k, v) for k, v in self._data.items()}
+
+    def __repr__(self) -> str:
+        return repr(self.to_dict())
+
+@dataclass(slots=True)
 class WizardState:
-    selections: Dict[str, Any] = field(default_factory=dict)
-    def to_preview_lines(self) -> List[str]:
-        return [f"{k}: {', '.join(v) if isinstance(v, list) else v}" for k, v in self.selections.items()]
-    def compose_prompt(self) -> str:
-        data = {k: "" for k in DEFAULT_KEYS}
-        for k, v in self.selections.items():
-            data[k] = ", ".join(v) if isinstance(v, list) else v
-        prompt = PROMPT_TEMPLATE
-        for k in DEFAULT_KEYS:
-            prompt = prompt.replace("{"+k+"}", data.get(k, ""))
-        return prompt.strip()
-
-def validate(selections: Dict[str, Any]) -> List[str]:
-    issues: List[str] = []
-    for core in ["Bereich","Rolle","Auftrag"]:
-        if not selections.get(core):
-            issues.append(f"Pflichtfeld fehlt: {core}")
-    meta = DOMAIN_META.get(selections.get("Auftrag") or "", {})
-    for key in meta.get("required", []):
-        val = selections.get(key)
-        if isinstance(val, list):
-            if not val: issues.append(f"Pflichtfeld (Mehrfachauswahl) fehlt: {key}")
+    # Änderungen laufen über set()/set_rolle()/set_auftrag() oder direkt über `selections`
+    # (TrackedSelections). Formatierte Werte, Vorschauzeilen und der Prompt werden erst bei
+    # Bedarf erzeugt, gecacht und nach Änderungen nur für die geänderten Felder neu gebaut.
+    selections: TrackedSelections = field(default_factory=TrackedSelections)  # type: ignore[assignment]
+    _values: Optional[Dict[str, str]] = field(default=None, init=False, repr=False, compare=False)
+    _lines: Optional[Dict[str, str]] = field(default=None, init=False, repr=False, compare=False)
+    _preview: Optional[List[str]] = field(default=None, init=False, repr=False, compare=False)
+    _prompts: Optional[Dict[bool, str]] = field(default=None, init=False, repr=False, compare=False)
+    _tokens: Optional[Dict[str, int]] = field(default=None, init=False, repr=False, compare=False)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        if name == "selections":
+            value = value if isinstance(value, TrackedSelections) else TrackedSelections(value)
+            object.__setattr__(self, "_values", None)
+            object.__setattr__(self, "_lines", None)
+            object.__setattr__(self, "_preview", None)
+            object.__setattr__(self, "_prompts", None)
+            object.__setattr__(self, "_tokens", None)
+        object.__setattr__(self, name, value)
+
+    def _sync(self) -> None:
+        dirty = self.selections.dirty
+        if not dirty: return
+        for cache in (self._values, self._lines, self._tokens):
+            if cache:
+                for k in dirty: cache.pop(k, None)
+        self.selections.dirty = None
+        self._preview = None
+        self._prompts = None
+
+    def set(self, key: str, value: Any) -> None:
+        self.selections[key] = value
+
+    def set_rolle(self, rolle: str) -> bool:
+        sel = self.selections
+        if rolle == sel.get("Rolle"): return False
+        sel["Rolle"] = rolle or ""
+        for k in [k for k in sel if k not in _CORE_KEYS]: del sel[k]
+        sel.pop("Auftrag", None)
+        return True
+
+    def set_bereich(self, bereich: str) -> bool:
+        sel = self.selections
+        if bereich == sel.get("Bereich"): return False
+        sel.clear()
+        sel["Bereich"] = bereich
+        return True
+
+    def set_auftrag(self, auftrag: str) -> bool:
+        sel = self.selections
+        if auftrag == sel.get("Auftrag"): return False
+        sel["Auftrag"] = auftrag or ""
+        for k in [k for k in sel if k not in _CORE_KEYS]: del sel[k]
+        return True
+
+    def jump_to(self, hit: "SearchHit") -> bool:
+        # Suchtreffer übernehmen: Rolle/Auftrag wechseln, Option vorauswählen
+        changed = self.set_rolle(hit.rolle)
+        if hit.auftrag: changed = self.set_auftrag(hit.auftrag) or changed
+        if not hit.option: return changed
+        spec = pack_for(self.selections.get("Bereich")).index.specs[hit.auftrag][hit.key]
+        current = self.selections.get(hit.key)
+        if spec.multi:
+            values = current if isinstance(current, list) else ([current] if current else [])
+            if hit.option in values: return changed
+            self.set(hit.key, values + [hit.option])
+        elif current != hit.option:
+            self.set(hit.key, hit.option)
         else:
-            if not val: issues.append(f"Pflichtfeld fehlt: {key}")
-    for key, rng in meta.get("numeric", {}).items():
-        raw = selections.get(key)
-        if not raw: continue
+            return changed
+        return True
+
+    def reset(self) -> None:
+        self.selections.clear()
+
+    def to_preview_lines(self) -> List[str]:
+        self._sync()
+        if self._preview is None:
+            lines = self._lines
+            if lines is None: lines = self._lines = {}
+            for k in self.selections:
+                if k not in lines:
+                    v = self.selections[k]
+                    lines[k] = f"{k}: {', '.join(v) if isinstance(v, list) else v}"
+            self._preview = [lines[k] for k in self.selections]
+        return list(self._preview)
+
+    def _formatted(self) -> Dict[str, str]:
+        values = self._values
+        if values is None: values = self._values = {}
+        for k in self.selections:
+            if k not in values: values[k] = _format_value(self.selections[k])
+        return values
+
+    def token_report(self, compact: bool = False) -> TokenReport:
+        self._sync()
+        if self._tokens is None: self._tokens = {}
+        return token_report(self._formatted(), compact, self._tokens)
+
+    def fit_budget(self, budget: int, compact: bool = False) -> BudgetFit:
+        report = self.token_report(compact)
+        if report.total <= budget:
+            return BudgetFit(self.compose_prompt(compact), report, [])
+        return fit_to_budget(self.selections.to_dict(), budget, compact)
+
+    def compose_prompt(self, compact: bool = False, budget: Optional[int] = None) -> str:
+        if budget:
+            return self.fit_budget(budget, compact).prompt
+        self._sync()
+        prompts = self._prompts
+        if prompts is None: prompts = self._prompts = {}
+        prompt = prompts.get(compact)
+        if prompt is not None: return prompt
+        prompt = prompts[compact] = render_prompt(self._formatted(), compact)
+        return prompt
+
+def template_for(selections: Dict[str, Any], compact: bool = False) -> CompiledTemplate:
+    pack = pack_for(selections.get("Bereich"))
+    auftrag = selections.get("Auftrag")
+    key = (auftrag if isinstance(auftrag, str) else "", compact)
+    tpl = pack.templates.get(key) or pack.compiled(*key)
+    if tpl.keys is not None:
+        for k, v in selections.items():
+            # Felder außerhalb des Auftrags (z. B. aus JSON-Import) -> generisches Template
+            if v and k not in tpl.keys:
+                return pack.compiled("", compact)
+    return tpl
+
+def render_prompt(selections: Dict[str, Any], compact: bool = False) -> str:
+    # zustandslose Variante für Batch/HTTP (ohne WizardState-Caches)
+    return template_for(selections, compact).render(selections).strip()
+
+# -------------------- Token budget --------------------
+class TokenReport(NamedTuple):
+    total: int
+    static: int  # Template-Text ohne Feldwerte
+    fields: Dict[str, int]  # Feld -> Tokens (Wert inkl. Kontextzeile im Kompaktmodus)
+
+class BudgetFit(NamedTuple):
+    prompt: str
+    report: TokenReport
+    trimmed: List[str]  # gekürzte Freitextfelder
+
+TRIM_MARKER = " […]"
+
+def token_report(selections: Dict[str, Any], compact: bool = False,
+                 cache: Optional[Dict[str, int]] = None) -> TokenReport:
+    # cache: Feld -> Tokens des Werts (von WizardState je Feld invalidiert)
+    tpl = template_for(selections, compact)
+    fields: Dict[str, int] = {}
+    total = tpl.static_tokens
+    for part in tpl.parts:
+        if part.__class__ is str: continue
+        n = cache.get(part.key) if cache is not None else None
+        if n is None:
+            n = estimate_tokens(_format_value(selections.get(part.key)))
+            if cache is not None: cache[part.key] = n
+        if n:
+            fields[part.key] = n + part.overhead
+            total += n + part.overhead
+    return TokenReport(total, tpl.static_tokens, fields)
+
+def _trim_to_tokens(text: str, limit: int) -> str:
+    n = estimate_tokens(text)
+    if n <= limit: return text
+    cut = int(len(text) * limit / n)
+    while cut > 0:
+        head = text[:cut]
+        sp = head.rfind(" ")
+        if sp > cut // 2: head = head[:sp]
+        out = head.rstrip() + TRIM_MARKER
+        if estimate_tokens(out) <= limit: return out
+        cut = int(cut * 0.9)
+    return TRIM_MARKER.strip()
+
+def fit_to_budget(selections: Dict[str, Any], budget: int, compact: bool = False) -> BudgetFit:
+    # kürzt die größten Freitextfelder auf eine gemeinsame Obergrenze ("Wasserstand"),
+    # bis der geschätzte Prompt ins Budget passt; Options- und Zahlenfelder bleiben unverändert
+    sel = dict(selections)
+    report = token_report(sel, compact)
+    auftrag = sel.get("Auftrag")
+    specs = pack_for(sel.get("Bereich")).index.specs.get(auftrag, _NO_SPECS) if isinstance(auftrag, str) else _NO_SPECS
+    free = {k: estimate_tokens(v) for k, v in sel.items()
+            if k in report.fields and isinstance(v, str) and k not in _CORE_KEYS
+            and (k not in specs or (specs[k].freitext and specs[k].numeric is None))}
+    trimmed: List[str] = []
+    for _ in range(8):
+        excess = report.total - budget
+        if excess <= 0 or not free: break
+        lo, hi = 0, max(free.values())
+        while lo < hi:  # größte Obergrenze, deren Kürzung den Überhang deckt
+            cap = (lo + hi + 1) // 2
+            if sum(max(0, t - cap) for t in free.values()) >= excess: lo = cap
+            else: hi = cap - 1
+        for k, t in list(free.items()):
+            if t > lo:
+                sel[k] = _trim_to_tokens(sel[k], lo)
+                free[k] = estimate_tokens(sel[k])
+                if k not in trimmed: trimmed.append(k)
+        report = token_report(sel, compact)
+        if all(t <= 1 for t in free.values()): break
+    return BudgetFit(render_prompt(sel, compact), report, trimmed)
+
+# -------------------- Validation --------------------
+# DOMAIN_META wird beim Import in unveränderliche Validatoren (einer pro Auftrag) übersetzt.
+class ValidationResult(NamedTuple):
+    issues: List[str]
+    done: int
+    total: int
+
+@dataclass(frozen=True)
+class NumericRule:
+    key: str
+    min: Optional[float] = None
+    max: Optional[float] = None
+
+    @staticmethod
+    def parse(raw: Any) -> Optional[float]:
+        if raw.__class__ is str and raw.isascii() and raw.isdigit():
+            return int(raw)
         try:
-            num = float(str(raw).replace(",", "."))
+            return float(str(raw).replace(",", "."))
         except Exception:
-            issues.append(f"{key}: muss eine Zahl sein"); continue
-        if "min" in rng and num < rng["min"]: issues.append(f"{key}: muss ≥ {rng['min']} sein")
-        if "max" in rng and num > rng["max"]: issues.append(f"{key}: muss ≤ {rng['max']} sein")
-    return issues
+            return None
+
+    def in_range(self, num: float) -> bool:
+        return not ((self.min is not None and num < self.min) or (self.max is not None and num > self.max))
+
+    def check(self, raw: Any, issues: List[str]) -> None:
+        num = self.parse(raw)
+        if num is None:
+            issues.append(f"{self.key}: muss eine Zahl sein"); return
+        if self.min is not None and num < self.min: issues.append(f"{self.key}: muss ≥ {self.min} sein")
+        if self.max is not None and num > self.max: issues.append(f"{self.key}: muss ≤ {self.max} sein")
+
+@dataclass(frozen=True)
+class AuftragValidator:
+    auftrag: str
+    required: Tuple[str, ...] = ()
+    required_set: FrozenSet[str] = frozenset()
+    multi: FrozenSet[str] = frozenset()
+    numeric: Tuple[NumericRule, ...] = ()
+
+    def numeric_rule(self, key: str) -> Optional[NumericRule]:
+        for rule in self.numeric:
+            if rule.key == key: return rule
+        return None
+
+    def check(self, selections: Dict[str, Any]) -> ValidationResult:
+        issues: List[str] = []
+        get = selections.get
+        for core in ("Bereich","Rolle","Auftrag"):
+            if not get(core): issues.append(f"Pflichtfeld fehlt: {core}")
+        done = 0
+        for key in self.required:
+            val = get(key)
+            if val: done += 1
+            elif isinstance(val, list): issues.append(f"Pflichtfeld (Mehrfachauswahl) fehlt: {key}")
+            else: issues.append(f"Pflichtfeld fehlt: {key}")
+        for rule in self.numeric:
+            raw = get(rule.key)
+            if raw: rule.check(raw, issues)
+        return ValidationResult(issues, done, len(self.required))
+
+def _domain_problems(tree: Dict[str, Any], meta: Dict[str, Dict[str, Any]]) -> List[str]:
+    problems: List[str] = []
+    leaves: Dict[str, Dict[str, Any]] = {}
+    for bereich in tree["Bereich"].values():
+        for rolle in bereich["Rolle"].values():
+            leaves.update(rolle["Auftrag"])
+    for auftrag in leaves.keys() - meta.keys(): problems.append(f"{auftrag}: keine DOMAIN_META")
+    for auftrag in meta.keys() - leaves.keys(): problems.append(f"{auftrag}: nicht in DOMAIN_TREE")
+    for auftrag, m in meta.items():
+        leaf = leaves.get(auftrag)
+        if leaf is None: continue
+        for key in m.get("required", []):
+            if key not in leaf and key not in _CORE_KEYS: problems.append(f"{auftrag}: Pflichtfeld '{key}' fehlt im Baum")
+        for key in m.get("multi", []):
+            if not isinstance(leaf.get(key), list): problems.append(f"{auftrag}: Mehrfachauswahl '{key}' ist keine Optionsliste")
+        for key in m.get("numeric", {}):
+            if leaf.get(key) != "freitext": problems.append(f"{auftrag}: Zahlenfeld '{key}' ist kein Freitextfeld")
+    return sorted(problems)
+
+def compile_validators(tree: Dict[str, Any], meta: Dict[str, Dict[str, Any]]) -> Dict[str, AuftragValidator]:
+    problems = _domain_problems(tree, meta)
+    if problems:
+        raise ValueError("DOMAIN_META passt nicht zu DOMAIN_TREE:\n" + "\n".join(problems))
+    return {
+        auftrag: AuftragValidator(
+            auftrag=auftrag,
+            required=tuple(m.get("required", [])),
+            required_set=frozenset(m.get("required", [])),
+            multi=frozenset(m.get("multi", [])),
+            numeric=tuple(NumericRule(k, rng.get("min"), rng.get("max")) for k, rng in m.get("numeric", {}).items()),
+        )
+        for auftrag, m in meta.items()
+    }
+
+# -------------------- Domain index --------------------
+# Flacher Index über DOMAIN_TREE (einmal pro Prozess): UI und Validierung
+# schlagen nur noch in Dicts nach, statt den Baum bei jedem Rerun abzusteigen.
+SENSITIVE_FIELDS = frozenset({"Kind-Profil (Stärken/Bedarfe)","Situation","Interpretation"})
+_LONG_FIELD_MARKERS = ("beschreibung","material","besonder","situation","interpretation","förder","profil","ziel","maßnahmen","planungs")
+
+@dataclass(frozen=True)
+class FieldSpec:
+    key: str
+    options: Tuple[str, ...] = ()  # leer = Freitext
+    positions: Dict[str, int] = field(default_factory=dict)  # Option -> Index in options
+    multi: bool = False
+    required: bool = False
+    numeric: Optional[NumericRule] = None
+    long: bool = False
+    sensitive: bool = False
+
+    @property
+    def freitext(self) -> bool:
+        return not self.options
+
+@dataclass(frozen=True)
+class DomainIndex:
+    bereich: str
+    rollen: Tuple[str, ...]
+    rolle_pos: Dict[str, int]
+    auftraege: Dict[str, Tuple[str, ...]]  # Rolle -> Aufträge (Baumreihenfolge)
+    auftrag_pos: Dict[Tuple[str, str], int]
+    leaves: Dict[Tuple[str, str], Tuple[FieldSpec, ...]]  # (Rolle, Auftrag) -> Felder
+    auftrag_fields: Dict[str, FrozenSet[str]]  # Auftrag -> Feldnamen inkl. Bereich/Rolle/Auftrag
+    field_auftraege: Dict[str, Tuple[str, ...]]  # Feldname -> Aufträge, die es verwenden
+    validators: Dict[str, AuftragValidator]
+    specs: Dict[str, Dict[str, FieldSpec]]  # Auftrag -> Feldname -> FieldSpec
+
+    @classmethod
+    def build(cls, tree: Dict[str, Any], meta: Dict[str, Dict[str, Any]], bereich: str) -> "DomainIndex":
+        validators = compile_validators(tree, meta)
+        rollen_tree = tree["Bereich"][bereich]["Rolle"]
+        auftraege: Dict[str, Tuple[str, ...]] = {}
+        auftrag_pos: Dict[Tuple[str, str], int] = {}
+        leaves: Dict[Tuple[str, str], Tuple[FieldSpec, ...]] = {}
+        auftrag_fields: Dict[str, FrozenSet[str]] = {}
+        field_auftraege: Dict[str, List[str]] = {}
+        for rolle, node in rollen_tree.items():
+            auftraege[rolle] = tuple(node["Auftrag"])
+            for pos, (auftrag, leaf) in enumerate(node["Auftrag"].items()):
+                auftrag_pos[(rolle, auftrag)] = pos
+                v = validators[auftrag]
+                specs: List[FieldSpec] = []
+                for key, sub in leaf.items():
+                    field_auftraege.setdefault(key, []).append(auftrag)
+                    key = sys.intern(key)
+                    if isinstance(sub, list):
+                        sub = [sys.intern(o) for o in sub]
+                        specs.append(FieldSpec(key, options=tuple(sub), positions={o: i for i, o in enumerate(sub)},
+                                               multi=key in v.multi, required=key in v.required_set))
+                    else:
+                        specs.append(FieldSpec(key, required=key in v.required_set, numeric=v.numeric_rule(key),
+                                               long=any(t in key.lower() for t in _LONG_FIELD_MARKERS),
+                                               sensitive=key in SENSITIVE_FIELDS))
+                leaves[(rolle, auftrag)] = tuple(specs)
+                auftrag_fields[auftrag] = _CORE_KEYS | frozenset(leaf)
+        return cls(
+            bereich=bereich,
+            rollen=tuple(rollen_tree),
+            rolle_pos={r: i for i, r in enumerate(rollen_tree)},
+            auftraege=auftraege,
+            auftrag_pos=auftrag_pos,
+            leaves=leaves,
+            auftrag_fields=auftrag_fields,
+            field_auftraege={k: tuple(v) for k, v in field_auftraege.items()},
+            validators=validators,
+            specs={auftrag: {f.key: f for f in leaf} for (_, auftrag), leaf in leaves.items()},
+        )
+
+    def leaf(self, rolle: Any, auftrag: Any) -> Tuple[FieldSpec, ...]:
+        if not (isinstance(rolle, str) and isinstance(auftrag, str)): return ()
+        return self.leaves.get((rolle, auftrag), ())
+
+def _process_shared(build: Any) -> Any:
+    # `streamlit run` führt dieses Skript bei jedem Rerun neu aus; statische Strukturen
+    # liegen dann in st.cache_resource und werden nur einmal pro Prozess gebaut.
+    # Streamlit wird hier nie importiert (Batch/CLI bleiben ohne Streamlit).
+    st = sys.modules.get("streamlit")
+    if __name__ == "__main__" and st is not None and hasattr(st, "cache_resource"):
+        return st.cache_resource(show_spinner=False)(build)()
+    return build()
+
+def _build_domain_index() -> DomainIndex:
+    return DomainIndex.build(DOMAIN_TREE, DOMAIN_META, "Elementarpädagogik")
+
+def _build_template_cache() -> Dict[Tuple[str, bool], CompiledTemplate]:
+    return {}
+
+def _build_draft_store() -> Optional["DraftStore"]:
+    path = os.environ.get(DRAFTS_ENV)
+    if not path: return None
+    import atexit
+    store = DraftStore(path)
+    atexit.register(store.close)  # offene Entwürfe beim Beenden nicht verlieren
+    return store
+
+DOMAIN_INDEX: DomainIndex = _process_shared(_build_domain_index)
+_TEMPLATE_CACHE: Dict[Tuple[str, bool], CompiledTemplate] = _process_shared(_build_template_cache)
+VALIDATORS = DOMAIN_INDEX.validators
+_NULL_VALIDATOR = AuftragValidator(auftrag="")
+
+def validator_for(auftrag: Any, bereich: Any = None) -> AuftragValidator:
+    validators = VALIDATORS if bereich is None else pack_for(bereich).index.validators
+    return validators.get(auftrag, _NULL_VALIDATOR) if isinstance(auftrag, str) else _NULL_VALIDATOR
+
+def validate(selections: Dict[str, Any], privacy: bool = False) -> List[str]:
+    issues = validator_for(selections.get("Auftrag"), selections.get("Bereich")).check(selections).issues
+    return issues + privacy_issues(selections) if privacy else issues
 
 def progress_ratio(selections: Dict[str, Any]) -> tuple[int,int]:
-    meta = DOMAIN_META.get(selections.get("Auftrag",""), {})
-    req = meta.get("required", [])
-    if not req: return (0,0)
-    done=0
-    for k in req:
-        v = selections.get(k)
-        if isinstance(v, list):
-            if v: done+=1
+    res = validator_for(selections.get("Auftrag"), selections.get("Bereich")).check(selections)
+    return (res.done, res.total)
+
+def validate_many(selections_list: Iterable[Dict[str, Any]], privacy: bool = False) -> List[List[str]]:
+    items = list(selections_list)
+    groups: Dict[Tuple[Any, Any], List[int]] = {}
+    for i, sel in enumerate(items):
+        auftrag, bereich = sel.get("Auftrag"), sel.get("Bereich")
+        groups.setdefault((auftrag if isinstance(auftrag, str) else None,
+                           bereich if isinstance(bereich, str) else None), []).append(i)
+    out: List[List[str]] = [[] for _ in items]
+    for (auftrag, bereich), idxs in groups.items():
+        check = validator_for(auftrag, bereich).check
+        for i in idxs:
+            out[i] = check(items[i]).issues
+    if privacy:
+        for i, sel in enumerate(items): out[i] += privacy_issues(sel)
+    return out
+
+# -------------------- Template packs --------------------
+# Weitere Bereiche kommen als Template-Pack aus einem Verzeichnis (PROMPT_BUILDER_PACKS, sonst
+# ./packs neben diesem Skript): eine JSON- oder TOML-Datei je Bereich, Dateiname = Bereich.
+#   {"Rolle": {<Rolle>: {"Auftrag": {<Auftrag>: {<Feld>: [Optionen] | "freitext"}}}},
+#    "meta": {<Auftrag>: {"required": [...], "multi": [...], "numeric": {...}}},
+#    "template": optional, "keys": optional, "aufgabe": optional (Schlussteil des generischen Templates)}
+# Ein Pack wird erst geparst, wenn sein Bereich gebraucht wird. Das kompilierte Pack (Index,
+# Validatoren, Templates je Auftrag) landet als Pickle im Cache-Verzeichnis, Schlüssel = Pfad +
+# mtime + Größe; ein Warmstart überspringt Parsen und Kompilieren. Geänderte Dateien werden
+# beim nächsten Zugriff (höchstens einmal pro check_interval) neu geladen.
+PACKS_ENV = "PROMPT_BUILDER_PACKS"
+PACK_CACHE_ENV = "PROMPT_BUILDER_PACK_CACHE"
+_PACK_SUFFIXES = (".json", ".toml")
+_PACK_CACHE_VERSION = 1
+
+@dataclass(frozen=True)
+class TemplatePack:
+    bereich: str
+    index: DomainIndex
+    template: str
+    keys: Tuple[str, ...]
+    templates: Dict[Tuple[str, bool], CompiledTemplate] = field(default_factory=dict)  # (Auftrag, compact)
+
+    def compiled(self, auftrag: str = "", compact: bool = False) -> CompiledTemplate:
+        tpl = self.templates.get((auftrag, compact))
+        if tpl is None:
+            tpl = self.templates[(auftrag, compact)] = compile_template(
+                self.template, self.keys, self.index.auftrag_fields.get(auftrag), compact)
+        return tpl
+
+    @classmethod
+    def from_data(cls, bereich: str, data: Dict[str, Any]) -> "TemplatePack":
+        rollen = data.get("Rolle")
+        if not isinstance(rollen, dict) or not rollen:
+            raise ValueError(f"Template-Pack {bereich}: \"Rolle\" fehlt oder ist leer")
+        tree = {"Bereich": {bereich: {"Rolle": rollen}}}
+        index = DomainIndex.build(tree, data.get("meta") or {}, bereich)
+        keys = tuple(data.get("keys") or _pack_keys(rollen))
+        template = data.get("template") or _generic_template(keys, data.get("aufgabe"))
+        pack = cls(bereich, index, template, keys)
+        for auftrag in ("",) + tuple(index.auftrag_fields):  # vorkompilieren, damit der Cache sie enthält
+            for compact in (False, True): pack.compiled(auftrag, compact)
+        return pack
+
+    def to_data(self) -> Dict[str, Any]:
+        rollen = {r: {"Auftrag": {a: {f.key: list(f.options) if f.options else "freitext" for f in self.index.leaf(r, a)}
+                                  for a in self.index.auftraege[r]}} for r in self.index.rollen}
+        meta = {a: {"required": list(v.required), "multi": sorted(v.multi),
+                    "numeric": {n.key: {k: getattr(n, k) for k in ("min", "max") if getattr(n, k) is not None}
+                                for n in v.numeric}}
+                for a, v in self.index.validators.items()}
+        return {"Rolle": rollen, "meta": meta, "template": self.template, "keys": list(self.keys)}
+
+def _pack_keys(rollen: Dict[str, Any]) -> List[str]:
+    keys = ["Rolle", "Bereich", "Auftrag"]
+    seen = set(keys)
+    for node in rollen.values():
+        for leaf in (node.get("Auftrag") or {}).values():
+            for key in leaf:
+                if key not in seen: seen.add(key); keys.append(key)
+    return keys
+
+def _generic_template(keys: Iterable[str], aufgabe: Optional[str] = None) -> str:
+    context = "\n".join(f"- {k}: {{{k}}}" for k in keys if k not in _CORE_KEYS)
+    tail = aufgabe.strip() if aufgabe else "Aufgabe:" + PROMPT_TEMPLATE.split("\n\nAufgabe:", 1)[1]
+    return f"Rolle: {{Rolle}}\nBereich: {{Bereich}}\nAuftrag: {{Auftrag}}\n\nKontext:\n{context}\n\n{tail}"
+
+def load_pack_file(path: str) -> Dict[str, Any]:
+    if path.endswith(".toml"):
+        try:
+            import tomllib
+        except ImportError:  # Python < 3.11
+            raise ValueError(f"{path}: TOML-Packs brauchen Python ≥ 3.11 (tomllib)") from None
+        with open(path, "rb") as f:
+            try:
+                return tomllib.load(f)
+            except tomllib.TOMLDecodeError as e:
+                raise ValueError(f"{path}: {e}") from None
+    with open(path, encoding="utf-8") as f:
+        try:
+            data = json.load(f)
+        except ValueError as e:
+            raise ValueError(f"{path}: {e}") from None
+    if not isinstance(data, dict):
+        raise ValueError(f"{path}: JSON-Objekt erwartet")
+    return data
+
+class PackRegistry:
+    def __init__(self, directory: str, cache_dir: Optional[str] = None, check_interval: float = 1.0) -> None:
+        import threading
+        self.directory = directory
+        self.cache_dir = cache_dir or os.path.join(directory, ".cache")
+        self.check_interval = check_interval
+        self.parsed = 0  # Packs, die geparst und kompiliert wurden
+        self.cache_hits = 0  # Packs, die aus dem Binär-Cache kamen
+        self.errors: Dict[str, str] = {}  # Bereich -> letzter Ladefehler (alte Version bleibt aktiv)
+        self._packs: Dict[str, Tuple[Tuple[int, int], TemplatePack]] = {}
+        self._checked: Dict[str, float] = {}
+        self._files: Dict[str, str] = {}
+        self._listed = float("-inf")
+        self._lock = threading.RLock()
+
+    def files(self) -> Dict[str, str]:
+        now = time.monotonic()
+        if now - self._listed >= self.check_interval:
+            with self._lock:
+                try:
+                    names = sorted(os.listdir(self.directory))
+                except FileNotFoundError:
+                    names = []
+                self._files = {n.rsplit(".", 1)[0]: os.path.join(self.directory, n)
+                               for n in names if n.endswith(_PACK_SUFFIXES) and not n.startswith(".")}
+                self._listed = now
+        return self._files
+
+    def bereiche(self) -> List[str]:
+        return list(self.files())
+
+    def get(self, bereich: str) -> Optional[TemplatePack]:
+        entry = self._packs.get(bereich)
+        if entry is not None and time.monotonic() - self._checked.get(bereich, 0.0) < self.check_interval:
+            return entry[1]
+        with self._lock:
+            path = self.files().get(bereich)
+            if path is None:
+                self._packs.pop(bereich, None)
+                return None
+            st = os.stat(path)
+            sig = (st.st_mtime_ns, st.st_size)
+            self._checked[bereich] = time.monotonic()
+            entry = self._packs.get(bereich)
+            if entry is not None and entry[0] == sig:
+                return entry[1]
+            try:
+                pack = self._load(bereich, path, sig)
+            except (ValueError, OSError) as e:
+                if entry is None: raise
+                self.errors[bereich] = str(e)  # Tippfehler beim Bearbeiten: alte Version weiter nutzen
+                return entry[1]
+            self._packs[bereich] = (sig, pack)
+            self.errors.pop(bereich, None)
+            return pack
+
+    def _load(self, bereich: str, path: str, sig: Tuple[int, int]) -> TemplatePack:
+        import hashlib, pickle
+        # __name__ im Schlüssel: Pickles verweisen auf Klassen dieses Moduls ("__main__" unter Streamlit)
+        key = hashlib.blake2b(f"{_PACK_CACHE_VERSION}|{__name__}|{os.path.abspath(path)}|{sig}".encode("utf-8"),
+                              digest_size=12).hexdigest()
+        stem = re.sub(r"[^\w-]+", "_", bereich)
+        cache_file = os.path.join(self.cache_dir, f"{stem}-{key}.pickle")
+        try:
+            with open(cache_file, "rb") as f:
+                pack = pickle.load(f)
+            if isinstance(pack, TemplatePack) and pack.bereich == bereich:
+                self.cache_hits += 1
+                return pack
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            pass
+        pack = TemplatePack.from_data(bereich, load_pack_file(path))
+        self.parsed += 1
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            for old in os.listdir(self.cache_dir):  # veraltete Einträge dieses Packs
+                if old.startswith(stem + "-") and old.endswith(".pickle"):
+                    os.remove(os.path.join(self.cache_dir, old))
+            tmp = f"{cache_file}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                pickle.dump(pack, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, cache_file)
+        except OSError:
+            pass  # Cache ist optional (z. B. schreibgeschütztes Verzeichnis)
+        return pack
+
+def _build_pack_registry() -> Optional[PackRegistry]:
+    directory = os.environ.get(PACKS_ENV) or os.path.join(os.path.dirname(os.path.abspath(__file__)), "packs")
+    if not os.path.isdir(directory): return None
+    return PackRegistry(directory, os.environ.get(PACK_CACHE_ENV))
+
+BUILTIN_PACK = TemplatePack(DOMAIN_INDEX.bereich, DOMAIN_INDEX, PROMPT_TEMPLATE, tuple(DEFAULT_KEYS), _TEMPLATE_CACHE)
+PACKS: Optional[PackRegistry] = _process_shared(_build_pack_registry)
+
+def pack_for(bereich: Any) -> TemplatePack:
+    # Elementarpädagogik (eingebaut) und unbekannte Bereiche -> eingebautes Pack
+    if PACKS is None or bereich.__class__ is not str or bereich == BUILTIN_PACK.bereich:
+        return BUILTIN_PACK
+    return PACKS.get(bereich) or BUILTIN_PACK
+
+def bereiche() -> List[str]:
+    extra = [b for b in PACKS.bereiche() if b != BUILTIN_PACK.bereich] if PACKS is not None else []
+    return [BUILTIN_PACK.bereich] + extra
+
+# -------------------- Search --------------------
+# Suche über Rollen, Aufträge, Feldnamen und Optionen eines Bereichs. Texte werden normalisiert:
+# Kleinschreibung, ä/ae -> a (ö, ü entsprechend), ß -> ss, Genderformen („:in“, „*innen“,
+# „/-in“, „(in)“, „Innen“) entfallen. Der Index entsteht einmal je DomainIndex: Trigramm ->
+# Text-IDs, dazu Text- und Wortanfänge (1–2 Zeichen) für kurze Eingaben. Die IDs sind nach Rang
+# vergeben (Rolle vor Auftrag vor Feld vor Option, kürzere Texte zuerst), eine Anfrage vergleicht
+# deshalb nur Trefferklassen und IDs. Tippfehler: Kandidaten kommen nur aus den seltensten
+# Trigrammen (wer ≥ k von n Trigrammen enthält, steckt in einer der n-k+1 kürzesten Listen).
+_GENDER_RE = re.compile(r"(?<=[^\W\d_])(?:(?:[:*_]|/-?)in(?:nen)?|\(in(?:nen)?\)|(?<=[a-zäöüß])In(?:nen)?)(?![^\W\d_])")
+_COMBINING_RE = re.compile(r"[\u0300-\u036f]+")
+_UMLAUT_PAIR_RE = re.compile(r"([aou])e")
+_NON_ALNUM_RE = re.compile(r"[\W_]+")
+_SEARCH_KINDS = ("Rolle", "Auftrag", "Feld", "Option")
+SEARCH_MIN_SIMILARITY = 0.5  # Anteil gemeinsamer Trigramme für unscharfe Treffer
+
+def normalize_search(text: str) -> str:
+    import unicodedata
+    text = unicodedata.normalize("NFKD", _GENDER_RE.sub("", text).lower().replace("ß", "ss"))
+    return _NON_ALNUM_RE.sub(" ", _UMLAUT_PAIR_RE.sub(r"\1", _COMBINING_RE.sub("", text))).strip()
+
+class SearchHit(NamedTuple):
+    kind: str  # Rolle | Auftrag | Feld | Option
+    label: str
+    rolle: str
+    auftrag: str = ""
+    key: str = ""
+    option: str = ""
+
+    def display(self) -> str:
+        if self.kind == "Rolle": return f"👤 {self.rolle}"
+        if self.kind == "Auftrag": return f"📋 {self.auftrag} · {self.rolle}"
+        if self.kind == "Feld": return f"✏️ {self.key} — {self.auftrag}"
+        return f"☑️ {self.option} ({self.key}) — {self.auftrag}"
+
+def _bitmask(ids: Iterable[int], size: int) -> int:
+    buf = bytearray((size + 7) // 8)
+    for i in ids: buf[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(buf, "little")
+
+def _bits(mask: int) -> Iterator[int]:
+    # gesetzte Bits aufsteigend = Text-IDs in Rangfolge
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+class SearchIndex:
+    def __init__(self, index: DomainIndex) -> None:
+        docs: Dict[str, List[SearchHit]] = {}  # normalisierter Text -> Treffer
+        def add(text: str, hit: SearchHit) -> None:
+            norm = normalize_search(text)
+            if norm: docs.setdefault(norm, []).append(hit)
+        for rolle in index.rollen:
+            add(rolle, SearchHit("Rolle", rolle, rolle))
+            for auftrag in index.auftraege[rolle]:
+                add(auftrag, SearchHit("Auftrag", auftrag, rolle, auftrag))
+                for spec in index.leaf(rolle, auftrag):
+                    add(spec.key, SearchHit("Feld", spec.key, rolle, auftrag, spec.key))
+                    for option in spec.options:
+                        add(option, SearchHit("Option", option, rolle, auftrag, spec.key, option))
+        rank = {kind: i for i, kind in enumerate(_SEARCH_KINDS)}
+        order = sorted(docs, key=lambda t: (min(rank[h.kind] for h in docs[t]), len(t), t))
+        self.texts = [f" {t} " for t in order]
+        self.hits = [tuple(docs[t]) for t in order]
+        self.exact = {t: i for i, t in enumerate(order)}
+        grams: Dict[str, List[int]] = {}
+        starts: Dict[str, List[int]] = {}
+        words: Dict[str, List[int]] = {}
+        for i, text in enumerate(self.texts):
+            for g in {text[j:j + 3] for j in range(len(text) - 2)}:
+                grams.setdefault(g, []).append(i)
+            for p in {text[1:2], text[1:3]}:
+                starts.setdefault(p, []).append(i)
+            for p in {w[:n] for w in text.split() for n in (1, 2)}:
+                words.setdefault(p, []).append(i)
+        # Posting-Listen als Bitmasken über die Text-IDs: Schnittmengen und Zählen per Bitoperation
+        size = len(order)
+        self.grams = {g: _bitmask(ids, size) for g, ids in grams.items()}
+        self.starts = {p: _bitmask(ids, size) for p, ids in starts.items()}
+        self.words = {p: _bitmask(ids, size) for p, ids in words.items()}
+
+    def __len__(self) -> int:
+        return sum(map(len, self.hits))
+
+    def search(self, query: str, limit: int = 8) -> List[SearchHit]:
+        q = normalize_search(query)
+        if not q or limit <= 0: return []
+        out: List[SearchHit] = []
+        seen: Set[int] = set()
+        for i in self._ranked(q):
+            if i in seen: continue
+            seen.add(i)
+            out.extend(self.hits[i][:limit - len(out)])
+            if len(out) >= limit: break
+        return out
+
+    def _ranked(self, q: str) -> Iterator[int]:
+        # Text-IDs bestmöglich zuerst; der Aufrufer hört nach `limit` Treffern auf
+        exact = self.exact.get(q)
+        if exact is not None: yield exact
+        if len(q) < 3:  # zu kurz für Trigramme: Text-, dann Wortanfang
+            yield from _bits(self.starts.get(q, 0))
+            yield from _bits(self.words.get(q, 0))
+            return
+        texts, head = self.texts, " " + q
+        # Eingabe ist evtl. noch unvollständig: kein Leerzeichen hinter dem letzten Wort
+        masks = [self.grams.get(head[j:j + 3], 0) for j in range(len(head) - 2)]
+        full = -1
+        for m in masks: full &= m
+        first = full & self.starts.get(q[:2], 0)
+        for i in _bits(first):
+            if texts[i].startswith(head): yield i
+        for i in _bits(full & ~first):
+            if head in texts[i]: yield i
+        # unscharf (Tippfehler): absteigend nach Zahl gemeinsamer Trigramme, Zähler bitweise je Stelle
+        planes: List[int] = []
+        for carry in masks:
+            for k in range(len(planes)):
+                if not carry: break
+                planes[k], carry = planes[k] ^ carry, planes[k] & carry
+            if carry: planes.append(carry)
+        need = max(1, int(len(masks) * SEARCH_MIN_SIMILARITY + 0.999))
+        for c in range(len(masks), need - 1, -1):
+            if c >> len(planes): continue
+            eq = -1
+            for k, plane in enumerate(planes):
+                eq &= plane if c >> k & 1 else ~plane
+            yield from _bits(eq)
+
+def _build_search_indexes() -> Dict[int, Tuple[DomainIndex, SearchIndex]]:
+    return {}
+
+_SEARCH_INDEXES: Dict[int, Tuple[DomainIndex, SearchIndex]] = _process_shared(_build_search_indexes)
+
+def search_index(bereich: Any = None) -> SearchIndex:
+    index = pack_for(bereich).index
+    entry = _SEARCH_INDEXES.get(id(index))
+    if entry is None or entry[0] is not index:
+        if len(_SEARCH_INDEXES) > 32: _SEARCH_INDEXES.clear()  # neu geladene Packs
+        entry = _SEARCH_INDEXES[id(index)] = (index, SearchIndex(index))
+    return entry[1]
+
+def search(query: str, bereich: Any = None, limit: int = 8) -> List[SearchHit]:
+    return search_index(bereich).search(query, limit)
+
+def scaled_domain_index(factor: int) -> DomainIndex:
+    # eingebauter Bereich factor-fach mit durchnummerierten Rollen/Aufträgen/Optionen (Benchmark)
+    rollen: Dict[str, Any] = {}
+    meta: Dict[str, Dict[str, Any]] = {}
+    idx = DOMAIN_INDEX
+    for k in range(factor):
+        for rolle in idx.rollen:
+            auftraege = rollen.setdefault(f"{rolle} {k}", {"Auftrag": {}})["Auftrag"]
+            for auftrag in idx.auftraege[rolle]:
+                auftraege[f"{auftrag} {k}"] = {s.key: [f"{o} {k}" for o in s.options] if s.options else "freitext"
+                                               for s in idx.leaf(rolle, auftrag)}
+                meta[f"{auftrag} {k}"] = DOMAIN_META[auftrag]
+    return DomainIndex.build({"Bereich": {idx.bereich: {"Rolle": rollen}}}, meta, idx.bereich)
+
+_SEARCH_BENCH_QUERIES = ("erzieh", "Elternbrief", "musik", "dienstplnung", "Sprachförderung", "el", "kita leitung",
+                         "Praxisanleiter*innen", "beobachtungsbogn", "übergang schule")
+
+def _cli_search(args: argparse.Namespace) -> int:
+    try:
+        pack_for(args.bereich)
+    except (ValueError, OSError) as e:
+        print(f"Fehler: {e}", file=sys.stderr); return 2
+    if not args.scale:
+        if not args.query:
+            print("Fehler: Suchbegriff fehlt", file=sys.stderr); return 2
+        for hit in search(" ".join(args.query), args.bereich, args.limit):
+            print(hit.display())
+        return 0
+    t0 = time.perf_counter()
+    index = SearchIndex(scaled_domain_index(args.scale) if args.scale > 1 else pack_for(args.bereich).index)
+    print(f"Index: {len(index):,} Einträge, {len(index.texts):,} Texte, {len(index.grams):,} Trigramme, "
+          f"aufgebaut in {(time.perf_counter() - t0) * 1000:.0f} ms")
+    print(f"{'Anfrage':<24} {'Treffer':>7} {'p50 µs':>8} {'p99 µs':>8} {'max µs':>8}")
+    worst = 0.0
+    for query in ([" ".join(args.query)] if args.query else _SEARCH_BENCH_QUERIES):
+        samples: List[float] = []
+        for _ in range(args.repeat):
+            t = time.perf_counter_ns()
+            hits = index.search(query, args.limit)
+            samples.append((time.perf_counter_ns() - t) / 1000)
+        samples.sort()
+        p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+        worst = max(worst, p99)
+        print(f"{query:<24} {len(hits):>7} {samples[len(samples) // 2]:>8.1f} {p99:>8.1f} {samples[-1]:>8.1f}")
+    print(f"schlechtestes p99: {worst:.1f} µs")
+    return 0
+
+# -------------------- Privacy scanner --------------------
+# Alle Muster (Vornamen-Lexikon als Präfixbaum, Datum, Telefon, Adresse, E-Mail) stecken in
+# EINEM kompilierten Regex; alle Freitextfelder werden verbunden und in einem Durchlauf
+# gescannt. Treffer sind Hinweise, keine Gewissheit – das Lexikon meidet daher Vornamen,
+# die zugleich häufige Wörter sind (Rose, Rosa, Wolf, Ernst, …). Ein Datum zählt nur mit
+# Geburtskontext („geb.“, „geboren“, „Geburtstag“) oder als volles Datum in einem Geburtsjahr
+# von Kita-/Hortkindern; eine Adresse braucht Straße plus Hausnummer (ohne Einheit dahinter).
+NAMES_ENV = "PROMPT_BUILDER_NAMES"  # optionale Datei mit weiteren Vornamen (eine Zeile je Name)
+# Planungsfelder: Datumsangaben sind hier Teil der Aufgabe (Zeitraum, Schließtage), kein Personenbezug
+PLANNING_DATE_FIELDS = frozenset({"Planungszeitraum (KW/Monat)", "Planungszeitraum (Jahr/KW)", "Schließtage/Termine",
+                                  "Abwesenheiten (Urlaub/Krankheit)", "Restriktionen/Wünsche", "Meilensteine",
+                                  "Maßnahmen/Meilensteine"})
+_FIRST_NAMES = """
+Aaron Adam Adrian Ahmad Ahmet Aisha Albert Alessa Alessandro Alexander Alexandra Ali Alicia Alina Aliya Amalia Amelie
+Amina Amir Amira Amy Anastasia Andrea Andreas Angelika Anja Anke Anna Annabell Anne Annika Anton Antonia Arda Arne Arthur
+Aylin Ayse Ayşe Bastian Ben Benedikt Benjamin Bernd Bianca Birgit Björn Carina Carl Carla Carlotta Caroline Charlotte
+Christian Christina Christine Clara Claudia Constantin Cornelia Dana Daniel Daniela Darius David Defne Deniz Dennis Diana
+Dieter Dirk Dominik Dmitri Eda Elena Elias Elif Elisa Elisabeth Ella Elena Emil Emilia Emily Emir Emma Enes Erik Eric
+Esra Eva Fabian Fatima Fatma Felix Finn Fiona Florian Frederik Frida Frieda Friedrich Fritz Gabriele Georg Gerhard Greta
+Günter Hamza Hanna Hannah Hannes Hans Harald Heike Heinz Helena Helga Helmut Henri Henrik Henry Hugo Ibrahim Ida Ilias
+Ilyas Ines Ingrid Isabel Isabella Isabelle Ivan Jakob Jakub Jan Jana Jannik Jannis Jasmin Jens Jessica Joel Johanna
+Johannes Jonas Jonathan Jörg Josef Joshua Julia Julian Juliane Jürgen Kacper Karim Karin Karl Katharina Katja Katrin
+Kerstin Kevin Klara Klaus Konstantin Lara Lars Laura Layla Lea Leah Lena Leni Lennard Lennart Lennox Leo Leon Leonard
+Leonie Levi Leyla Lia Liam Lilli Lilly Lina Linda Linus Lisa Lotta Lotte Louis Luca Lucas Ludwig Luis Luisa Luise Luka
+Lukas Luna Lya Madita Magdalena Maik Maja Malia Malik Manfred Manuel Marc Marcel Marco Maria Mariam Marie Mario Marius
+Marko Markus Marlene Marlon Martha Martin Martina Marvin Mathilda Mats Matteo Matthias Mattis Max Maximilian Maya Mehmet
+Melanie Melina Merle Mia Michael Michaela Mila Milan Milena Mina Mira Mohammed Mohammad Monika Moritz Muhammed Mustafa
+Natalia Nele Nick Nico Nicole Niklas Nils Nina Noah Noel Nora Ole Olga Oliver Oliwia Omar Oskar Oscar Patrick Paul Paula
+Pauline Peter Petra Philipp Pia Piotr Ralf Rainer Rebecca Renate Robin Romy Ronja Ruben Sabine Sami Samuel Sandra
+Sara Sarah Sebastian Selin Simon Sofia Sofie Sophia Sophie Stefan Stefanie Stephan Susanne Sven Tanja Theo Theodor Thomas
+Tilda Till Tim Timo Tobias Tom Tomasz Torsten Ursula Ute Uwe Valentin Valentina Vanessa Viktoria Vincent Werner Wolfgang
+Yasin Yasmin Yusuf Zeynep Zoe Zofia
+"""
+
+def _trie_pattern(words: Iterable[str]) -> str:
+    # Präfixbaum -> geschachtelte Alternation: der Regex prüft jedes Präfix nur einmal
+    trie: Dict[str, Any] = {}
+    for w in words:
+        node = trie
+        for ch in w: node = node.setdefault(ch, {})
+        node[""] = {}
+    def emit(node: Dict[str, Any]) -> str:
+        end = "" in node
+        alts = [re.escape(ch) + emit(sub) for ch, sub in sorted(node.items()) if ch]
+        if not alts: return ""
+        body = alts[0] if len(alts) == 1 and len(alts[0]) == 1 else "(?:" + "|".join(alts) + ")"
+        return f"(?:{body})?" if end else body
+    return emit(trie)
+
+_MONTHS = r"(?:Jan(?:uar)?|Feb(?:ruar)?|März|Apr(?:il)?|Mai|Juni?|Juli?|Aug(?:ust)?|Sep(?:t(?:ember)?)?|Okt(?:ober)?|Nov(?:ember)?|Dez(?:ember)?)"
+_STREETS = r"(?:straße|strasse|str\.|weg|gasse|platz|allee|ring|damm|ufer|chaussee)"
+_NOT_STREETS = r"(?!(?:Spiel|Park|Sport|Sitz|Kita|Krippen|Betreuungs|Arbeits|Stell|Bau|Schul|Fest)platz)"
+# Zahl + Einheit ist keine Hausnummer bzw. Postleitzahl („Marktplatz 10 Uhr“, „15000 Euro“)
+_UNITS = (r"(?:€|(?:Uhr|Euro|EUR|Cent|Min(?:uten)?|Std|Stunden|Tage?|Wochen|Monate|Jahre|Kinder|Personen|Plätze"
+          r"|Teilnehm\w*|Besucher\w*|Mitarbeit\w*|mal|x)\b)")
+_BIRTH_CONTEXT_RE = re.compile(r"geb\.|geboren|geburt", re.I)
+_BIRTH_YEARS = 14  # Kinder bis 14 Jahre (Kita und Hort)
+_PRIVACY_PATTERNS = (
+    ("E-Mail", r"@[\w-]+(?:\.[\w-]+)+"),  # lokaler Teil wird in scan_text() rückwärts ergänzt
+    ("Datum", r"\b(?:(?:0?[1-9]|[12]\d|3[01])\.\s?(?:0?[1-9]|1[0-2])\.\s?(?:19|20)?\d{2}\b"
+              r"|(?:19|20)\d{2}-(?:0[1-9]|1[0-2])-(?:0[1-9]|[12]\d|3[01])\b"
+              r"|(?:0?[1-9]|[12]\d|3[01])\.\s?" + _MONTHS + r"\.?(?:\s(?:19|20)\d{2})?(?!\w))"),
+    ("Telefon", r"(?<![\w+])(?:(?:\+|00)\d{2}[\s/-]?(?:\(0\))?\s?\d{2,5}|0\d{2,5})[\s/-]?\d{3,}(?:[\s-]\d{2,})*\b"),
+    ("Adresse", r"\b" + _NOT_STREETS + r"(?:[A-ZÄÖÜ][\wäöüß-]*" + _STREETS
+                + r"|[A-ZÄÖÜ][a-zäöüß]+\s(?:Straße|Strasse|Str\.|Weg|Gasse|Platz|Allee|Ring|Damm))"
+                r"\s?\d{1,4}(?:\s?[a-h])?\b(?!\s?(?:[.,:]\d|" + _UNITS + r"))"
+                r"|\b\d{5}\s(?!" + _UNITS + r")[A-ZÄÖÜ][a-zäöüß]+"),
+)
+
+class PrivacyFinding(NamedTuple):
+    field: str
+    kind: str
+    start: int
+    end: int
+    text: str
+
+def _load_names() -> FrozenSet[str]:
+    names = set(_FIRST_NAMES.split())
+    path = os.environ.get(NAMES_ENV)
+    if path:
+        with open(path, encoding="utf-8") as f:
+            names.update(n.strip() for n in f if n.strip())
+    return frozenset(names)
+
+@lru_cache(maxsize=1)
+def privacy_matcher() -> "re.Pattern[str]":
+    # Gruppen in Reihenfolge der Muster; lastindex liefert die Trefferart ohne Nachschlagen nach Name
+    # Vorab-Lookahead: jedes Muster beginnt mit Großbuchstabe, Ziffer, "+" oder "@";
+    # an allen anderen Stellen (Kleinbuchstaben, Leerzeichen) scheitert der Regex sofort.
+    parts = [f"({pat})" for _, pat in _PRIVACY_PATTERNS]
+    # "Max. 4 Tage", "Jan. bis März": Name mit Punkt und Kleinbuchstabe/Ziffer danach ist eine Abkürzung
+    parts.append(r"\b(" + _trie_pattern(_load_names()) + r")\b(?!\.\s*[\da-zäöüß])")
+    return re.compile(r"(?=[\dA-ZÄÖÜ+@])(?:" + "|".join(parts) + ")")
+
+_PRIVACY_KINDS = tuple(kind for kind, _ in _PRIVACY_PATTERNS) + ("Name",)
+
+_EMAIL_LOCAL_RE = re.compile(r"[\w.+-]{1,64}$")
+
+def _birth_date(text: str, start: int, end: int, this_year: int) -> bool:
+    # Geburtskontext in der Nähe (nicht über die \x00-Feldgrenze) oder volles Datum mit Jahr
+    # im Geburtsjahrgang eines Kita-/Hortkindes
+    lo, hi = text.rfind("\x00", max(0, start - 30), start) + 1 or max(0, start - 30), text.find("\x00", end, end + 15)
+    if _BIRTH_CONTEXT_RE.search(text, lo, hi if hi >= 0 else end + 15): return True
+    found = text[start:end]
+    m = re.search(r"(?:19|20)\d{2}", found) or re.search(r"\.\s?(\d{2})$", found)
+    if m is None: return False
+    year = int(m.group(0)) if m.lastindex is None else 2000 + int(m.group(1))
+    return this_year - _BIRTH_YEARS <= year < this_year
+
+def scan_text(text: str) -> List[Tuple[str, int, int]]:
+    from datetime import date
+    kinds = _PRIVACY_KINDS
+    this_year = date.today().year
+    out: List[Tuple[str, int, int]] = []
+    for m in privacy_matcher().finditer(text):
+        kind, start = kinds[m.lastindex - 1], m.start()
+        if kind == "Datum" and not _birth_date(text, start, m.end(), this_year): continue
+        if kind == "E-Mail":
+            local = _EMAIL_LOCAL_RE.search(text, max(0, start - 64), start)
+            if local is None: continue
+            start = local.start()
+        out.append((kind, start, m.end()))
+    return out
+
+def _freetext_items(selections: Dict[str, Any]) -> List[Tuple[str, str]]:
+    auftrag = selections.get("Auftrag")
+    specs = pack_for(selections.get("Bereich")).index.specs.get(auftrag, _NO_SPECS) if isinstance(auftrag, str) else _NO_SPECS
+    out: List[Tuple[str, str]] = []
+    for key, val in selections.items():
+        if key in _CORE_KEYS or not isinstance(val, str) or not val: continue
+        spec = specs.get(key)
+        if spec is None or spec.freitext: out.append((key, val))
+    return out
+
+def scan_selections(selections: Dict[str, Any]) -> List[PrivacyFinding]:
+    items = _freetext_items(selections)
+    if not items: return []
+    # ein Durchlauf über alle Felder; \x00 trennt sie und wird von keinem Muster überbrückt
+    text = "\x00".join(v for _, v in items)
+    bounds: List[int] = []
+    pos = 0
+    for _, v in items:
+        pos += len(v) + 1; bounds.append(pos)
+    from bisect import bisect_right
+    out: List[PrivacyFinding] = []
+    for kind, start, end in scan_text(text):
+        i = bisect_right(bounds, start)
+        if kind == "Datum" and items[i][0] in PLANNING_DATE_FIELDS: continue
+        offset = bounds[i - 1] if i else 0
+        out.append(PrivacyFinding(items[i][0], kind, start - offset, end - offset, text[start:end]))
+    return out
+
+def privacy_issues(selections: Dict[str, Any]) -> List[str]:
+    return [f"Datenschutz: {f.field} enthält möglicherweise {f.kind} „{f.text}“" for f in scan_selections(selections)]
+
+def _audit_chunk(chunk: List[Tuple[int, str]], _: Any = None) -> str:
+    out: List[str] = []
+    for lineno, line in chunk:
+        try:
+            sel = json.loads(line)
+        except ValueError:
+            continue
+        if not isinstance(sel, dict): continue
+        findings = scan_selections(sel)
+        if findings:
+            out.append(json.dumps({"line": lineno, "findings": [f._asdict() for f in findings]}, ensure_ascii=False) + "\n")
+    return "".join(out)
+
+def run_privacy_audit(src: IO[str], dst: IO[str], workers: int = 0, chunk_size: int = 2048) -> Tuple[int, float]:
+    return _run_chunked(src, dst, _audit_chunk, None, workers, chunk_size)
+
+def _cli_privacy_audit(args: argparse.Namespace) -> int:
+    src = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    dst = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    try:
+        count, secs = run_privacy_audit(src, dst, args.workers, args.chunk_size)
+    finally:
+        if src is not sys.stdin: src.close()
+        if dst is not sys.stdout: dst.close()
+    print(f"{count} Datensätze geprüft in {secs:.2f}s ({count/secs if secs else 0:,.0f}/s)", file=sys.stderr)
+    return 0
+
+# -------------------- Batch (headless) --------------------
+# JSONL-Eingabe (eine Auswahl pro Zeile, Format wie der JSON-Download) -> JSONL-Ausgabe
+# in Eingabereihenfolge. Es sind höchstens workers*2 Chunks gleichzeitig unterwegs,
+# der Speicherbedarf hängt also nicht von der Dateigröße ab.
+def _batch_chunk(chunk: List[Tuple[int, str]], opts: Tuple[bool, bool]) -> str:
+    compact, privacy = opts
+    records: List[Dict[str, Any]] = []
+    parsed: List[Tuple[Dict[str, Any], Dict[str, Any]]] = []
+    for lineno, line in chunk:
+        rec: Dict[str, Any] = {"line": lineno}
+        records.append(rec)
+        try:
+            sel = json.loads(line)
+        except ValueError as e:
+            rec.update(ok=False, error=f"Ungültiges JSON: {e}"); continue
+        if not isinstance(sel, dict):
+            rec.update(ok=False, error="JSON-Objekt erwartet"); continue
+        parsed.append((rec, sel))
+    for (rec, sel), issues in zip(parsed, validate_many((sel for _, sel in parsed), privacy)):
+        if issues:
+            rec.update(ok=False, issues=issues)
+        else:
+            rec.update(ok=True, prompt=render_prompt(sel, compact))
+    return "".join(json.dumps(rec, ensure_ascii=False) + "\n" for rec in records)
+
+def _iter_chunks(src: IO[str], size: int) -> Iterator[List[Tuple[int, str]]]:
+    chunk: List[Tuple[int, str]] = []
+    for n, line in enumerate(src, 1):
+        if not line.strip(): continue
+        chunk.append((n, line))
+        if len(chunk) >= size:
+            yield chunk; chunk = []
+    if chunk:
+        yield chunk
+
+def _run_chunked(src: IO[str], dst: IO[str], job: Any, opts: Any, workers: int, chunk_size: int) -> Tuple[int, float]:
+    from collections import deque
+    t0 = time.perf_counter()
+    count = 0
+    if workers <= 1:
+        for chunk in _iter_chunks(src, chunk_size):
+            dst.write(job(chunk, opts)); count += len(chunk)
+        return count, time.perf_counter() - t0
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending: "deque[Tuple[int, Any]]" = deque()
+        for chunk in _iter_chunks(src, chunk_size):
+            pending.append((len(chunk), pool.submit(job, chunk, opts)))
+            if len(pending) >= workers * 2:
+                n, fut = pending.popleft(); dst.write(fut.result()); count += n
+        while pending:
+            n, fut = pending.popleft(); dst.write(fut.result()); count += n
+    return count, time.perf_counter() - t0
+
+def run_batch(src: IO[str], dst: IO[str], workers: int = 0, chunk_size: int = 256,
+              compact: bool = False, privacy: bool = False) -> Tuple[int, float]:
+    return _run_chunked(src, dst, _batch_chunk, (compact, privacy), workers, chunk_size)
+
+def _cli_batch(args: argparse.Namespace) -> int:
+    src = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    dst = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    try:
+        count, secs = run_batch(src, dst, args.workers, args.chunk_size, args.compact, args.privacy)
+    finally:
+        if src is not sys.stdin: src.close()
+        if dst is not sys.stdout: dst.close()
+    print(f"{count} Datensätze in {secs:.2f}s ({count/secs if secs else 0:,.0f}/s)", file=sys.stderr)
+    return 0
+
+# -------------------- Enumerator --------------------
+# Alle gültigen Kombinationen der Optionsfelder je Auftrag, lazy und in fester Reihenfolge:
+# Aufträge in Baumreihenfolge, darin ein Zähler mit gemischter Basis (letztes Feld läuft
+# am schnellsten). Mehrfachauswahl = Bitmaske über die Optionen, optionale Felder dürfen
+# leer bleiben. Jede Kombination hat so einen globalen Index k, der sich direkt in eine
+# Auswahl umrechnen lässt: Shard i/n nimmt k ≡ i (mod n), ganz ohne Absprache.
+class _Axis(NamedTuple):
+    key: str
+    options: Tuple[str, ...]
+    multi: bool
+    optional: bool
+
+    @property
+    def size(self) -> int:
+        return (1 << len(self.options)) - (not self.optional) if self.multi else len(self.options) + self.optional
+
+    def value(self, d: int) -> Any:
+        if self.multi:
+            mask = d + (not self.optional)
+            return [o for j, o in enumerate(self.options) if mask >> j & 1]
+        if self.optional:
+            return self.options[d - 1] if d else ""
+        return self.options[d]
+
+class EnumerationLeaf(NamedTuple):
+    auftrag: str
+    base: Dict[str, Any]  # feste Felder inkl. Füllwerte für Pflicht-Freitext
+    axes: Tuple[_Axis, ...]
+    count: int
+
+def _fill_value(spec: FieldSpec, fill: Dict[str, str]) -> str:
+    if spec.key in fill: return fill[spec.key]
+    rule = spec.numeric
+    if rule is not None:
+        lo = rule.min if rule.min is not None else 30
+        hi = rule.max if rule.max is not None else 30
+        return str(max(lo, min(hi, 30)))
+    return f"[{spec.key}]"
+
+def enumeration_plan(auftraege: Optional[Iterable[str]] = None, fill: Optional[Dict[str, str]] = None,
+                     bereich: Optional[str] = None) -> List[EnumerationLeaf]:
+    wanted = set(auftraege) if auftraege is not None else None
+    fill = fill or {}
+    idx = pack_for(bereich).index
+    plan: List[EnumerationLeaf] = []
+    for rolle in idx.rollen:
+        for auftrag in idx.auftraege[rolle]:
+            if wanted is not None and auftrag not in wanted: continue
+            base: Dict[str, Any] = {"Bereich": idx.bereich, "Rolle": rolle, "Auftrag": auftrag}
+            axes: List[_Axis] = []
+            for spec in idx.leaf(rolle, auftrag):
+                if spec.options:
+                    axes.append(_Axis(spec.key, spec.options, spec.multi, not spec.required))
+                elif spec.required or spec.key in fill:
+                    base[spec.key] = _fill_value(spec, fill)
+            count = 1
+            for axis in axes: count *= axis.size
+            plan.append(EnumerationLeaf(auftrag, base, tuple(axes), count))
+    if wanted is not None and len(plan) != len(wanted):
+        unknown = wanted - {leaf.auftrag for leaf in plan}
+        raise ValueError("Unbekannte Aufträge: " + ", ".join(sorted(unknown)))
+    return plan
+
+def _decode(leaf: EnumerationLeaf, local: int) -> Dict[str, Any]:
+    digits: List[int] = []
+    for axis in reversed(leaf.axes):
+        local, d = divmod(local, axis.size)
+        digits.append(d)
+    sel = dict(leaf.base)
+    for axis, d in zip(leaf.axes, reversed(digits)):
+        val = axis.value(d)
+        if val: sel[axis.key] = val
+    return sel
+
+def enumerate_selections(plan: List[EnumerationLeaf], shard: Tuple[int, int] = (0, 1)) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    i, n = shard
+    offset = 0
+    for leaf in plan:
+        k = offset + (i - offset) % n  # erster Index dieses Shards im Auftrag
+        end = offset + leaf.count
+        while k < end:
+            yield k, _decode(leaf, k - offset)
+            k += n
+        offset = end
+
+def parse_shard(text: str) -> Tuple[int, int]:
+    i, sep, n = text.partition("/")
+    try:
+        shard = (int(i), int(n))
+    except ValueError:
+        raise ValueError(f"Shard als i/n erwartet, nicht {text!r}") from None
+    if not sep or not 0 <= shard[0] < shard[1]:
+        raise ValueError(f"Shard als i/n mit 0 ≤ i < n erwartet, nicht {text!r}")
+    return shard
+
+def _open_output(path: str) -> IO[str]:
+    # Kompression nach Endung; "-" = stdout (unkomprimiert)
+    if path == "-": return sys.stdout
+    if path.endswith(".gz"):
+        import gzip
+        return gzip.open(path, "wt", encoding="utf-8", compresslevel=6)
+    if path.endswith(".xz"):
+        import lzma
+        return lzma.open(path, "wt", encoding="utf-8")
+    if path.endswith(".bz2"):
+        import bz2
+        return bz2.open(path, "wt", encoding="utf-8")
+    return open(path, "w", encoding="utf-8")
+
+def run_enumeration(plan: List[EnumerationLeaf], dst: IO[str], shard: Tuple[int, int] = (0, 1),
+                    compact: bool = False) -> Tuple[int, int]:
+    written = invalid = 0
+    buf: List[str] = []
+    for k, sel in enumerate_selections(plan, shard):
+        if validate(sel):
+            invalid += 1; continue
+        buf.append(json.dumps({"i": k, "selections": sel, "prompt": render_prompt(sel, compact)}, ensure_ascii=False) + "\n")
+        written += 1
+        if len(buf) >= 512:
+            dst.write("".join(buf)); buf.clear()
+    dst.write("".join(buf))
+    return written, invalid
+
+def _cli_enumerate(args: argparse.Namespace) -> int:
+    try:
+        fill = dict(f.split("=", 1) for f in args.fill)
+        plan = enumeration_plan(args.auftrag or None, fill, args.bereich)
+        shard = parse_shard(args.shard)
+    except ValueError as e:
+        print(e, file=sys.stderr); return 2
+    if args.count:
+        for leaf in plan: print(f"{leaf.count:>10,}  {leaf.auftrag}")
+        print(f"{sum(leaf.count for leaf in plan):>10,}  gesamt")
+        return 0
+    t0 = time.perf_counter()
+    dst = _open_output(args.output)
+    try:
+        written, invalid = run_enumeration(plan, dst, shard, args.compact)
+    finally:
+        if dst is not sys.stdout: dst.close()
+    secs = time.perf_counter() - t0
+    print(f"Shard {shard[0]}/{shard[1]}: {written} Prompts in {secs:.1f}s ({written/secs if secs else 0:,.0f}/s)"
+          + (f", {invalid} ungültig übersprungen" if invalid else ""), file=sys.stderr)
+    return 1 if invalid else 0
+
+# -------------------- Dienstplan --------------------
+# Lokaler Entwurf für „Dienstplanung erstellen“: die Felder werden in ein Modell übersetzt
+# (Arbeitstage × Schichten, Mindestbesetzung je Slot, Wochenstunden, Sperren) und vorab gelöst,
+# statt das Puzzle dem LLM zu überlassen. Verfügbarkeit und Belegung liegen als Bitmasken über
+# das Team je Slot bzw. Tag vor, Stunden in flachen Listen je (Woche, Person). Gelöst wird
+# gierig (knappste Slots zuerst, geringste Auslastung zuerst), danach repariert die lokale Suche
+# Unterdeckungen (Verschieben am selben Tag, Ringtausch, Schicht einer vollen Woche abgeben)
+# und gleicht die Stunden aus. Mitarbeitende heißen MA1…MAn (keine Klarnamen). Erkannt werden:
+#   Planungszeitraum: „KW 45-48 2026“, „November 2026“, „11/2026“, „02.11.2026-27.11.2026“
+#   Mindestbesetzung: „2“ oder „Früh 3, Kernzeit 4, Spät 2; Fr Spät 1“ (sonst 1 je Slot)
+#   Abwesenheiten: „MA3 03.11.-07.11., 12.11.; MA7 KW 46“
+#   Schließtage/Termine: alle Daten/Zeiträume darin sind Schließtage
+#   Restriktionen/Wünsche: „Team 30; MA4 20h; MA7 kein Spät; MA2 nur Früh; MA9 frei Mi; max 4 Tage“
+#   (ohne MA-Angabe gilt eine Regel für alle, MA-Regeln gehen vor)
+ROSTER_AUFTRAG = "Dienstplanung erstellen"
+ROSTER_SHIFTS: Dict[str, Tuple[str, int]] = {  # Schicht -> (Zeit, Minuten)
+    "Früh": ("06:30–13:00", 390), "Kernzeit": ("08:30–15:00", 390),
+    "Spät": ("11:00–17:30", 390), "Randzeiten": ("16:30–18:00", 90),
+}
+ROSTER_WEEK_MINUTES = 39 * 60
+_WEEKDAYS = ("Mo", "Di", "Mi", "Do", "Fr", "Sa", "So")
+_MONTH_NUMBERS = {m: i for i, m in enumerate(("jan", "feb", "mär", "apr", "mai", "jun", "jul", "aug", "sep", "okt", "nov", "dez"), 1)}
+_ROSTER_MONTH_RE = re.compile(r"\b(jan|feb|mär|maer|apr|mai|jun|jul|aug|sep|okt|nov|dez)[a-zä]*\.?(?:\s+(\d{4}))?", re.I)
+_ROSTER_DATE_RE = re.compile(r"(\d{1,2})\.(?:(\d{1,2})\.)?(\d{4})?\s*(?:-|–|bis)\s*(\d{1,2})\.(\d{1,2})\.(\d{4})?"
+                             r"|(\d{1,2})\.(\d{1,2})\.(\d{4})?")
+_ROSTER_KW_RE = re.compile(r"\bKW\s*(\d{1,2})(?:\s*(?:-|–|bis)\s*(?:KW\s*)?(\d{1,2}))?", re.I)
+_ROSTER_SHIFT_RE = re.compile(r"(früh|frueh|kern|spät|spaet|rand)", re.I)
+_ROSTER_WEEKDAY_RE = re.compile(r"\b(mo|di|mi|do|fr)(?:ntag|enstag|ttwoch|nnerstag|eitag)?s?\b", re.I)
+_ROSTER_STAFF_RE = re.compile(r"\b(?:MA|P|Person)\s?(\d{1,3})\b")
+_ROSTER_TEAM_RE = re.compile(r"\bTeam\D{0,3}(\d{1,3})\b|\b(\d{1,3})\s*(?:Mitarbeitende|Mitarbeiter\w*|Personen|Fachkräfte|Kolleg\w*)", re.I)
+_ROSTER_HOURS_RE = re.compile(r"(\d{1,2}(?:[.,]\d)?)\s*(?:h|Std\.?|Stunden)(?!\w)", re.I)
+_ROSTER_DAYS_RE = re.compile(r"(\d)\s*(?:Tage|Arbeitstage)\b", re.I)
+_ROSTER_NEG_RE = re.compile(r"\b(?:kein\w*|nicht|frei|ohne)\b", re.I)
+_ROSTER_ONLY_RE = re.compile(r"\bnur\b", re.I)
+_ROSTER_CLAUSE_RE = re.compile(r"[;\n]+|,(?!\d)\s*")  # „3,5 h“ bleibt zusammen
+# Klausel beginnt mit einem Namen statt MA<n> („Anna Urlaub 2.11.“) – wird gemeldet, nicht geraten
+_ROSTER_NAME_RE = re.compile(r"^(?!(?:Alle|Jede|Niemand|Team|Kein|Nicht|Nur|Max|Mind|Höchstens|Pro|Urlaub|Krank|"
+                             r"Fortbildung|Schulung|Elternzeit|Kur|KW|Mo|Di|Mi|Do|Fr|Früh|Kern|Spät|Rand|"
+                             r"Jan|Feb|Mär|Apr|Mai|Jun|Jul|Aug|Sep|Okt|Nov|Dez)[a-zäöüß]*\b)[A-ZÄÖÜ][a-zäöüß]+\b")
+ROSTER_HELP: Dict[str, str] = {  # Eingabeformat, das der lokale Entwurf versteht
+    "Planungszeitraum (KW/Monat)": "z. B. „KW 45-48 2026“, „November 2026“, „11/2026“ oder „02.11.2026-27.11.2026“",
+    "Mindestbesetzung je Zeitslot": "Schicht + Anzahl, Klauseln mit ; trennen, Wochentag davor gilt nur dort: "
+                                    "„Früh 2, Spät 1; Fr Spät 2“",
+    "Abwesenheiten (Urlaub/Krankheit)": "Personen als MA1, MA2 … statt Namen, danach Daten oder KW: "
+                                        "„MA1 03.11.-06.11., 09.11.; MA4 KW 47“",
+    "Schließtage/Termine": "Daten, Zeiträume oder KW: „Teamtag 05.11.; 23.12.-2.1.“",
+    "Restriktionen/Wünsche": "Teamgröße und Regeln je MA<n>, ohne MA gilt die Regel für alle: "
+                             "„Team 12; MA2 nur Früh; MA3 frei Mo; MA4 26h; MA5 4 Tage“",
+}
+
+def _shift_names(text: str) -> List[str]:
+    keys = {"fr": "Früh", "ke": "Kernzeit", "sp": "Spät", "ra": "Randzeiten"}
+    return [keys[m.group(1)[:2].lower()] for m in _ROSTER_SHIFT_RE.finditer(text)]
+
+def _weekday_numbers(text: str) -> List[int]:
+    return [_WEEKDAYS.index(m.group(1).capitalize()) for m in _ROSTER_WEEKDAY_RE.finditer(text)]
+
+def _roster_year(text: str, default: int) -> int:
+    m = re.search(r"\b(20\d\d)\b", text)
+    return int(m.group(1)) if m else default
+
+def _make_date(year: Any, month: Any, day: Any) -> "date":
+    from datetime import date
+    try:
+        return date(int(year), int(month), int(day))
+    except ValueError:
+        raise ValueError(f"Ungültiges Datum: {day}.{month}.{year}") from None
+
+def _week_days(year: int, kw: int) -> List["date"]:
+    from datetime import date
+    try:
+        return [date.fromisocalendar(year, kw, d) for d in range(1, 6)]
+    except ValueError:
+        raise ValueError(f"Ungültige Kalenderwoche: KW {kw}/{year}") from None
+
+def _span(a: "date", b: "date") -> List["date"]:
+    from datetime import timedelta
+    if b < a: a, b = b, a
+    return [a + timedelta(days=i) for i in range((b - a).days + 1)]
+
+def roster_dates(text: str, year: int, period: Sequence["date"] = ()) -> List["date"]:
+    # alle Daten, Zeiträume („3.-7.11.“, „28.12.-8.1.“) und Kalenderwochen („KW 52-2“) eines Textes;
+    # fehlt das Jahr, gilt das Jahr, in dem Monat bzw. KW im Planungszeitraum liegen, sonst year
+    from datetime import date
+    months = {d.month: d.year for d in period}
+    weeks = {d.isocalendar()[1]: d.isocalendar()[0] for d in period}
+    out: List[date] = []
+    for m in _ROSTER_DATE_RE.finditer(text):
+        if m.group(7):
+            out.append(_make_date(m.group(9) or months.get(int(m.group(8)), year), m.group(8), m.group(7)))
+        else:
+            y2 = m.group(6) or months.get(int(m.group(5)), year)
+            end = _make_date(y2, m.group(5), m.group(4))
+            start = _make_date(m.group(3) or y2, m.group(2) or m.group(5), m.group(1))
+            if start > end and not m.group(3): start = start.replace(year=start.year - 1)  # über den Jahreswechsel
+            out.extend(_span(start, end))
+    for m in _ROSTER_KW_RE.finditer(text):
+        first, last = int(m.group(1)), int(m.group(2) or m.group(1))
+        y = weeks.get(first, year)
+        if last >= first:
+            kws = [(y, kw) for kw in range(first, last + 1)]
+        else:  # über den Jahreswechsel, z. B. KW 52-2
+            kws = [(y, kw) for kw in range(first, date(y, 12, 28).isocalendar()[1] + 1)] + [(y + 1, kw) for kw in range(1, last + 1)]
+        for wy, kw in kws: out.extend(_week_days(wy, kw))
+    return out
+
+def parse_period(text: str, today: Optional["date"] = None) -> List["date"]:
+    # Arbeitstage (Mo–Fr) des Planungszeitraums
+    import calendar
+    from datetime import date
+    year = _roster_year(text, (today or date.today()).year)
+    days = roster_dates(text, year)
+    if not days:
+        m = _ROSTER_MONTH_RE.search(text)
+        num = re.search(r"\b(\d{1,2})\s*/\s*(\d{4})\b|\b(\d{4})-(\d{1,2})\b", text)
+        if m:
+            month = _MONTH_NUMBERS[m.group(1).lower().replace("maer", "mär")[:3]]
+        elif num:
+            month, year = (int(num.group(1)), int(num.group(2))) if num.group(1) else (int(num.group(4)), int(num.group(3)))
+        else:
+            raise ValueError(f"Planungszeitraum nicht erkannt: „{text}“ (z. B. „KW 45-48 2026“ oder „November 2026“)")
+        days = _span(_make_date(year, month, 1), _make_date(year, month, calendar.monthrange(year, month)[1]))
+    return sorted({d for d in days if d.weekday() < 5})
+
+@dataclass(frozen=True)
+class RosterModel:
+    days: Tuple[Any, ...]  # Arbeitstage (datetime.date) ohne Schließtage
+    shifts: Tuple[str, ...]
+    minutes: Tuple[int, ...]  # je Schicht
+    demand: Tuple[int, ...]  # je Slot (Tag * Schichten + Schicht)
+    avail: Tuple[int, ...]  # je Slot: Bitmaske der Personen, die ihn übernehmen dürfen
+    week_of: Tuple[int, ...]  # je Tag: Index der Kalenderwoche im Zeitraum
+    cap: Tuple[int, ...]  # je Person: Minuten pro Woche
+    max_days: Tuple[int, ...]  # je Person: Arbeitstage pro Woche
+    closed: Tuple[Any, ...] = ()
+    unparsed: Tuple[str, ...] = ()  # Klauseln, aus denen nichts übernommen wurde
+
+    @property
+    def staff(self) -> int:
+        return len(self.cap)
+
+def _clauses(text: str) -> List[str]:
+    return [c.strip() for c in _ROSTER_CLAUSE_RE.split(text or "") if c.strip()]
+
+def roster_model(selections: Dict[str, Any], today: Optional["date"] = None) -> RosterModel:
+    def text(key: str) -> str:
+        return _format_value(selections.get(key)).strip()
+    days = parse_period(text("Planungszeitraum (KW/Monat)"), today)
+    year = days[0].year if days else (today.year if today else 0)
+    wanted = selections.get("Schichtmodell")
+    wanted = set(wanted if isinstance(wanted, list) else [wanted])
+    shifts = tuple(s for s in ROSTER_SHIFTS if s in wanted)
+    if not shifts:
+        raise ValueError("Schichtmodell fehlt")
+    closed = sorted(set(roster_dates(text("Schließtage/Termine"), year, days)) & set(days))
+    days = [d for d in days if d not in set(closed)]
+    if not days:
+        raise ValueError("Im Planungszeitraum bleibt kein Arbeitstag übrig")
+    S = len(shifts)
+
+    # Mindestbesetzung je (Wochentag, Schicht); spätere Angaben überschreiben frühere
+    per_weekday = [[1] * S for _ in range(5)]
+    raw = text("Mindestbesetzung je Zeitslot")
+    unparsed: List[str] = []
+    for clause in _clauses(raw):
+        numbers = re.findall(r"\d+", clause)
+        if not numbers:
+            unparsed.append(clause); continue
+        n = int(numbers[-1])
+        for wd in _weekday_numbers(clause) or range(5):
+            for name in _shift_names(clause) or shifts:
+                if name in shifts: per_weekday[wd][shifts.index(name)] = n
+    if raw and not re.search(r"\d", raw):
+        raise ValueError(f"Mindestbesetzung ohne Zahl: „{raw}“")
+    demand = tuple(per_weekday[d.weekday()][s] for d in days for s in range(S))
+
+    # Teamgröße: Angabe in den Restriktionen, sonst höchste MA-Nummer bzw. Tagesbedarf + 25 %
+    rules = text("Restriktionen/Wünsche")
+    absences = text("Abwesenheiten (Urlaub/Krankheit)")
+    team = next((int(m.group(1) or m.group(2)) for m in _ROSTER_TEAM_RE.finditer(rules)), 0)
+    if not team:
+        mentioned = [int(n) for n in _ROSTER_STAFF_RE.findall(rules + "\n" + absences)]
+        peak = max(sum(demand[d * S:(d + 1) * S]) for d in range(len(days)))
+        team = max(mentioned + [-(-peak * 5 // 4)])
+    cap = [ROSTER_WEEK_MINUTES] * team
+    max_days = [5] * team
+    shift_ok = [(1 << S) - 1] * team
+    day_ok = [0b11111] * team
+    def person(n: str) -> int:
+        p = int(n) - 1
+        if not 0 <= p < team:
+            raise ValueError(f"MA{n} gibt es nicht (Team: {team} Personen)")
+        return p
+    def apply(clause: str, people: Iterable[int]) -> None:
+        hours = _ROSTER_HOURS_RE.search(clause)
+        limit = _ROSTER_DAYS_RE.search(clause)
+        names = [shifts.index(s) for s in _shift_names(clause) if s in shifts]
+        weekdays = _weekday_numbers(clause)
+        only, neg = _ROSTER_ONLY_RE.search(clause), _ROSTER_NEG_RE.search(clause)
+        if not (hours or limit or ((only or neg) and (names or weekdays))):
+            unparsed.append(clause); return
+        for p in people:
+            if hours: cap[p] = round(float(hours.group(1).replace(",", ".")) * 60)
+            if limit: max_days[p] = min(5, int(limit.group(1)))
+            if only:
+                if names: shift_ok[p] = sum(1 << s for s in names)
+                if weekdays: day_ok[p] = sum(1 << wd for wd in weekdays)
+            elif neg:
+                for s in names: shift_ok[p] &= ~(1 << s)
+                for wd in weekdays: day_ok[p] &= ~(1 << wd)
+    clauses = [(c, [person(n) for n in _ROSTER_STAFF_RE.findall(c)]) for c in _clauses(rules)]
+    for clause, people in clauses:
+        if people or _ROSTER_TEAM_RE.search(clause): continue
+        if _ROSTER_NAME_RE.match(clause): unparsed.append(clause)
+        else: apply(clause, range(team))
+    for clause, people in clauses:
+        if people: apply(clause, people)
+
+    # Abwesenheiten: Daten gehören zu den zuletzt genannten MA (auch über Kommas hinweg)
+    absent: List[Set[Any]] = [set() for _ in range(team)]
+    current: List[int] = []
+    for clause in _clauses(absences):
+        people = [person(n) for n in _ROSTER_STAFF_RE.findall(clause)]
+        if not people and _ROSTER_NAME_RE.match(clause): current = []
+        current = people or current
+        dates = roster_dates(_ROSTER_STAFF_RE.sub(" ", clause), year, days)
+        if not current or not (dates or people): unparsed.append(clause)
+        for d in dates:
+            for p in current: absent[p].add(d)
+
+    weeks: Dict[Tuple[int, int], int] = {}
+    week_of = tuple(weeks.setdefault(tuple(d.isocalendar())[:2], len(weeks)) for d in days)
+    avail: List[int] = []
+    for d in days:
+        wd = d.weekday()
+        free = [p for p in range(team) if day_ok[p] >> wd & 1 and d not in absent[p]]
+        for s in range(S):
+            avail.append(sum(1 << p for p in free if shift_ok[p] >> s & 1))
+    return RosterModel(days=tuple(days), shifts=shifts, minutes=tuple(ROSTER_SHIFTS[s][1] for s in shifts),
+                       demand=demand, avail=tuple(avail), week_of=week_of, cap=tuple(cap),
+                       max_days=tuple(max_days), closed=tuple(closed), unparsed=tuple(unparsed))
+
+class RosterDraft(NamedTuple):
+    model: RosterModel
+    shift_of: List[List[int]]  # [Person][Tag] -> Schichtindex, -1 = frei
+    cover: List[int]  # je Slot: Bitmaske der eingeteilten Personen
+    shortfalls: List[Tuple[int, int, int]]  # (Tag, Schicht, fehlende Personen)
+    seconds: float
+
+    def minutes(self, p: int) -> int:
+        m = self.model.minutes
+        return sum(m[s] for s in self.shift_of[p] if s >= 0)
+
+def solve_roster(model: RosterModel, time_limit: float = 0.5) -> RosterDraft:
+    t0 = time.perf_counter()
+    deadline = t0 + time_limit
+    days, S, P = model.days, len(model.shifts), model.staff
+    D = len(days)
+    minutes, demand, avail, week_of = model.minutes, model.demand, model.avail, model.week_of
+    cap, max_days = model.cap, model.max_days
+    W = max(week_of) + 1
+    shift_of = [[-1] * D for _ in range(P)]
+    cover = [0] * (D * S)
+    busy = [0] * D  # je Tag: Bitmaske der Personen mit Schicht
+    load = [0] * (W * P)  # Minuten je (Woche, Person)
+    worked = [0] * (W * P)  # Arbeitstage je (Woche, Person)
+    total = [0] * P
+    norm = [ROSTER_WEEK_MINUTES / c if c else float("inf") for c in cap]  # Auslastung relativ zu Vollzeit
+    week_days = [[d for d in range(D) if week_of[d] == w] for w in range(W)]
+
+    def assign(p: int, d: int, s: int) -> None:
+        k = week_of[d] * P + p
+        shift_of[p][d] = s
+        cover[d * S + s] |= 1 << p
+        busy[d] |= 1 << p
+        load[k] += minutes[s]; worked[k] += 1; total[p] += minutes[s]
+
+    def unassign(p: int, d: int) -> int:
+        s = shift_of[p][d]
+        k = week_of[d] * P + p
+        shift_of[p][d] = -1
+        cover[d * S + s] &= ~(1 << p)
+        busy[d] &= ~(1 << p)
+        load[k] -= minutes[s]; worked[k] -= 1; total[p] -= minutes[s]
+        return s
+
+    def missing(slot: int) -> int:
+        return demand[slot] - bin(cover[slot]).count("1")
+
+    def pick(d: int, s: int, exclude: int = -1) -> int:
+        # freie Person mit Kapazität und geringster Auslastung; -1 = niemand
+        best, best_key = -1, None
+        m, w = minutes[s], week_of[d] * P
+        for p in _bits(avail[d * S + s] & ~busy[d]):
+            if p == exclude or load[w + p] + m > cap[p] or worked[w + p] >= max_days[p]: continue
+            key = (total[p] * norm[p], (p - d) % P)
+            if best_key is None or key < best_key: best, best_key = p, key
+        return best
+
+    # gierig: knappe Slots (wenige Verfügbare je benötigter Person) zuerst
+    order = sorted((slot for slot in range(D * S) if demand[slot]),
+                   key=lambda slot: (bin(avail[slot]).count("1") / demand[slot], slot))
+    for slot in order:
+        d, s = divmod(slot, S)
+        for _ in range(demand[slot]):
+            p = pick(d, s)
+            if p < 0: break
+            assign(p, d, s)
+
+    def repair(d: int, s: int) -> bool:
+        slot = d * S + s
+        p = pick(d, s)
+        if p >= 0:
+            assign(p, d, s); return True
+        w = week_of[d] * P
+        # Verschieben am selben Tag: aus überbesetzter Schicht, sonst Ringtausch mit Ersatz
+        for p in _bits(avail[slot] & busy[d]):
+            v = shift_of[p][d]
+            if load[w + p] - minutes[v] + minutes[s] > cap[p]: continue
+            if missing(d * S + v) < 0:
+                unassign(p, d); assign(p, d, s); return True
+            unassign(p, d)
+            r = pick(d, v, exclude=p)
+            if r >= 0:
+                assign(r, d, v); assign(p, d, s); return True
+            assign(p, d, v)
+        # Woche voll: eine andere Schicht dieser Woche abgeben (an Ersatz oder aus Überbesetzung)
+        for p in _bits(avail[slot] & ~busy[d]):
+            for d2 in week_days[week_of[d]]:
+                v2 = shift_of[p][d2]
+                if v2 < 0: continue
+                unassign(p, d2)
+                if load[w + p] + minutes[s] <= cap[p] and worked[w + p] < max_days[p]:
+                    if missing(d2 * S + v2) < 0:
+                        assign(p, d, s); return True
+                    r = pick(d2, v2, exclude=p)
+                    if r >= 0:
+                        assign(r, d2, v2); assign(p, d, s); return True
+                assign(p, d2, v2)
+        return False
+
+    progress = True
+    while progress and time.perf_counter() < deadline:
+        progress = False
+        for slot in order:
+            d, s = divmod(slot, S)
+            while missing(slot) > 0 and repair(d, s): progress = True
+
+    # Ausgleich: Schicht an eine weniger ausgelastete Person abgeben, solange das die Spanne verkleinert
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        for slot in order:
+            d, s = divmod(slot, S)
+            m, w = minutes[s], week_of[d] * P
+            for p in _bits(cover[slot]):
+                for r in _bits(avail[slot] & ~busy[d]):
+                    if load[w + r] + m > cap[r] or worked[w + r] >= max_days[r]: continue
+                    if (total[r] + m) * norm[r] < total[p] * norm[p]:
+                        unassign(p, d); assign(r, d, s); improved = True
+                        break
+    shortfalls = [(slot // S, slot % S, missing(slot)) for slot in range(D * S) if missing(slot) > 0]
+    return RosterDraft(model, shift_of, cover, shortfalls, time.perf_counter() - t0)
+
+def _hours(minutes: int) -> str:
+    return f"{minutes / 60:.1f}".rstrip("0").rstrip(".").replace(".", ",")
+
+def render_roster(draft: RosterDraft) -> str:
+    m = draft.model
+    S = len(m.shifts)
+    def day(d: Any) -> str:
+        return f"{_WEEKDAYS[d.weekday()]} {d:%d.%m.}"
+    lines = [f"Dienstplan-Entwurf (lokal vorberechnet, {m.days[0]:%d.%m.%Y}–{m.days[-1]:%d.%m.%Y}, "
+             f"{m.staff} Personen; " + ", ".join(f"{s} {ROSTER_SHIFTS[s][0]}" for s in m.shifts) + "):"]
+    for d, date_ in enumerate(m.days):
+        lines.append(f"{day(date_)}: " + " | ".join(
+            f"{name} " + (" ".join(f"MA{p + 1}" for p in _bits(draft.cover[d * S + s])) or "–")
+            for s, name in enumerate(m.shifts)))
+    if m.closed:
+        lines.append("Schließtage: " + ", ".join(day(d) for d in m.closed))
+    if draft.shortfalls:
+        lines.append("Unterdeckung (nicht lösbar mit den Angaben): " +
+                     "; ".join(f"{day(m.days[d])} {m.shifts[s]} −{n}" for d, s, n in draft.shortfalls))
+    else:
+        lines.append("Mindestbesetzung in allen Slots erfüllt.")
+    lines.append("Stunden im Zeitraum: " + ", ".join(f"MA{p + 1} {_hours(draft.minutes(p))}" for p in range(m.staff)))
+    return "\n".join(lines)
+
+def embed_roster(prompt: str, roster_text: str) -> str:
+    # Entwurf vor den Aufgabenteil, damit das LLM ihn prüft statt neu zu planen
+    head, sep, tail = prompt.partition("\n\nAufgabe:")
+    note = "\nBitte den Entwurf prüfen, Unterdeckungen lösen und begründet anpassen statt neu zu planen."
+    return f"{head}\n\n{roster_text}{note}{sep}{tail}"
+
+def fit_roster_budget(ws: WizardState, roster_text: str, budget: int) -> Tuple[BudgetFit, bool]:
+    # der Entwurf zählt mit: Freitexte werden auf (Budget - Entwurf) gekürzt; passt es auch dann
+    # nicht, entfällt der Entwurf und der Prompt allein wird auf das volle Budget gebracht
+    extra = estimate_tokens(embed_roster("", roster_text))
+    if extra < budget:
+        fit = ws.fit_budget(budget - extra)
+        if fit.report.total + extra <= budget:
+            return fit._replace(prompt=embed_roster(fit.prompt, roster_text)), True
+    return ws.fit_budget(budget), False
+
+def roster_draft(selections: Dict[str, Any], time_limit: float = 0.5) -> Optional[RosterDraft]:
+    if selections.get("Auftrag") != ROSTER_AUFTRAG: return None
+    return solve_roster(roster_model(selections), time_limit)
+
+def roster_instance(seed: int, staff: int = 30, year: int = 2026, month: int = 11) -> Dict[str, Any]:
+    # erzeugte Benchmark-Instanz: Teilzeit, Urlaube, Krankheitstage, Sperren, ein Schließtag
+    import calendar, random
+    rng = random.Random(seed)
+    last = calendar.monthrange(year, month)[1]
+    workdays = [d for d in range(1, last + 1) if calendar.weekday(year, month, d) < 5]
+    absences = []
+    for p in rng.sample(range(1, staff + 1), staff // 3):
+        start = rng.randrange(len(workdays) - 4)
+        end = start + rng.randrange(5)
+        span = f"{workdays[start]:02d}.{month:02d}." + (f"-{workdays[end]:02d}.{month:02d}." if end > start else "")
+        absences.append(f"MA{p} {span}")
+    for p in rng.sample(range(1, staff + 1), staff // 6):
+        absences.append(f"MA{p} {rng.choice(workdays):02d}.{month:02d}.")
+    rules = [f"Team {staff}"]
+    for p in rng.sample(range(1, staff + 1), staff * 3 // 10):
+        rules.append(f"MA{p} {rng.choice((20, 25, 30))}h")
+    for p in rng.sample(range(1, staff + 1), staff // 5):
+        rules.append(rng.choice((f"MA{p} kein Spät", f"MA{p} nur Früh", f"MA{p} frei Mi", f"MA{p} keine Randzeiten")))
+    scale = staff / 30
+    return {"Bereich": DOMAIN_INDEX.bereich, "Rolle": "Kita-Leitung", "Auftrag": ROSTER_AUFTRAG, "Rahmen": "Regelbetrieb",
+            "Planungszeitraum (KW/Monat)": f"{month:02d}/{year}",
+            "Schichtmodell": list(ROSTER_SHIFTS),
+            "Mindestbesetzung je Zeitslot": f"Früh {round(6 * scale)}, Kernzeit {round(7 * scale)}, "
+                                            f"Spät {round(5 * scale)}, Randzeiten {round(2 * scale)}; Fr Spät {round(3 * scale)}",
+            "Abwesenheiten (Urlaub/Krankheit)": "; ".join(absences),
+            "Schließtage/Termine": f"Teamtag {rng.choice(workdays):02d}.{month:02d}.",
+            "Restriktionen/Wünsche": "; ".join(rules)}
+
+def _cli_roster(args: argparse.Namespace) -> int:
+    if args.instances:
+        times: List[float] = []
+        short = 0
+        for seed in range(args.instances):
+            t0 = time.perf_counter()
+            draft = solve_roster(roster_model(roster_instance(seed, args.staff)), args.time_limit)
+            times.append(time.perf_counter() - t0)
+            short += sum(n for _, _, n in draft.shortfalls)
+        times.sort()
+        print(f"{args.instances} Instanzen, {args.staff} Personen, ein Monat: p50 {times[len(times) // 2] * 1000:.0f} ms · "
+              f"max {times[-1] * 1000:.0f} ms · offene Slot-Besetzungen gesamt {short}")
+        return 0 if times[-1] < 1.0 else 1
+    try:
+        src = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+        try:
+            sel = json.load(src)
+        finally:
+            if src is not sys.stdin: src.close()
+    except (OSError, ValueError) as e:
+        print(f"Fehler: {args.input}: {e}", file=sys.stderr); return 2
+    if not isinstance(sel, dict):
+        print("Fehler: Eingabe muss ein JSON-Objekt mit den Auswahlen sein", file=sys.stderr); return 2
+    sel.setdefault("Auftrag", ROSTER_AUFTRAG)
+    try:
+        draft = roster_draft(sel, args.time_limit)
+    except ValueError as e:
+        print(f"Fehler: {e}", file=sys.stderr); return 2
+    if draft is None:
+        print(f"Fehler: Auftrag ist nicht „{ROSTER_AUFTRAG}“", file=sys.stderr); return 2
+    if draft.model.unparsed:
+        print("Warnung: nicht erkannt und ignoriert: " + "; ".join(draft.model.unparsed), file=sys.stderr)
+    text = render_roster(draft)
+    print(embed_roster(render_prompt(sel), text) if args.prompt else text)
+    return 0
+
+# -------------------- HTTP service --------------------
+# Asyncio-HTTP/1.1 mit Keep-Alive, nur Standardbibliothek (kein Streamlit-Import).
+#   POST /validate  {selections}  -> {"issues": [...], "progress": [done, total]}
+#   POST /compose   {selections}  -> {"ok": true, "prompt": "..."} bzw. 422 mit issues
+#   GET  /schema[?bereich=…]      -> {"tree": …, "meta": …, "bereiche": [...]} (Standard: eingebauter Bereich)
+_HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                 413: "Payload Too Large", 422: "Unprocessable Entity", 500: "Internal Server Error"}
+
+def _json_bytes(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def normalized_selections(selections: Dict[str, Any]) -> bytes:
+    # leere Strings/None verhalten sich in validate() und compose_prompt() wie fehlende Felder
+    return _json_bytes({k: selections[k] for k in sorted(selections) if selections[k] not in ("", None)})
+
+class ComposeService:
+    def __init__(self, cache_size: int = 4096, max_body: int = 8 << 20) -> None:
+        from collections import OrderedDict
+        self.cache_size = cache_size
+        self.max_body = max_body
+        self.hits = 0
+        self.misses = 0
+        self._cache: "OrderedDict[bytes, Tuple[int, bytes]]" = OrderedDict()
+        self._schemas: Dict[str, Tuple[TemplatePack, Dict[str, Any]]] = {}  # Bereich -> (Pack, Schema)
+        self._packs: Dict[str, TemplatePack] = {}  # Bereich -> Pack, mit dem der Cache gefüllt wurde
+
+    def schema(self, bereich: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        names = bereiche()
+        bereich = bereich or BUILTIN_PACK.bereich
+        if bereich not in names: return None
+        pack = pack_for(bereich)
+        cached = self._schemas.get(bereich)
+        if cached is None or cached[0] is not pack:  # Pack neu geladen -> Schema neu bauen
+            if pack is BUILTIN_PACK:
+                tree, meta = DOMAIN_TREE, DOMAIN_META
+            else:
+                data = pack.to_data()
+                tree, meta = {"Bereich": {bereich: {"Rolle": data["Rolle"]}}}, data["meta"]
+            cached = self._schemas[bereich] = (pack, {"tree": tree, "meta": meta})
+        return {**cached[1], "bereiche": names}
+
+    def handle(self, method: str, target: str, body: bytes) -> Tuple[int, bytes]:
+        import hashlib
+        route, _, query = target.partition("?")
+        if route == "/schema":
+            if method != "GET": return 405, _json_bytes({"error": "GET erwartet"})
+            from urllib.parse import parse_qs
+            bereich = (parse_qs(query).get("bereich") or [None])[0]
+            schema = self.schema(bereich)
+            if schema is None: return 404, _json_bytes({"error": f"Unbekannter Bereich: {bereich}"})
+            return 200, _json_bytes(schema)
+        if route not in ("/validate", "/compose"):
+            return 404, _json_bytes({"error": f"Unbekannter Pfad: {route}"})
+        if method != "POST":
+            return 405, _json_bytes({"error": "POST erwartet"})
+        try:
+            sel = json.loads(body or b"{}")
+        except ValueError as e:
+            return 400, _json_bytes({"error": f"Ungültiges JSON: {e}"})
+        if not isinstance(sel, dict):
+            return 400, _json_bytes({"error": "JSON-Objekt erwartet"})
+        compact = "compact=1" in query.split("&")
+        pack = pack_for(sel.get("Bereich"))
+        if self._packs.setdefault(pack.bereich, pack) is not pack:  # Pack neu geladen: Antworten veraltet
+            self._cache.clear()
+            self._packs[pack.bereich] = pack
+        key = hashlib.blake2b(f"{route}|{compact}|".encode() + normalized_selections(sel), digest_size=16).digest()
+        cached = self._cache.get(key)
+        if cached is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return cached
+        self.misses += 1
+        res = validator_for(sel.get("Auftrag"), sel.get("Bereich")).check(sel)
+        if route == "/validate":
+            out = (200, _json_bytes({"issues": res.issues, "progress": [res.done, res.total]}))
+        elif res.issues:
+            out = (422, _json_bytes({"ok": False, "issues": res.issues}))
+        else:
+            out = (200, _json_bytes({"ok": True, "prompt": render_prompt(sel, compact)}))
+        self._cache[key] = out
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return out
+
+def _http_response(status: int, payload: bytes, keep_alive: bool) -> bytes:
+    head = (f"HTTP/1.1 {status} {_HTTP_REASONS.get(status, '')}\r\n"
+            f"Content-Type: application/json; charset=utf-8\r\nContent-Length: {len(payload)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    return head.encode("latin-1") + payload
+
+async def _serve_connection(service: ComposeService, reader: Any, writer: Any) -> None:
+    import asyncio
+    try:
+        while True:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                break
+            lines = head.decode("latin-1").split("\r\n")
+            parts = lines[0].split(" ")
+            if len(parts) != 3:
+                writer.write(_http_response(400, _json_bytes({"error": "Ungültige Anfragezeile"}), False)); break
+            method, target, version = parts
+            headers: Dict[str, str] = {}
+            for line in lines[1:]:
+                if line:
+                    k, _, v = line.partition(":")
+                    headers[k.strip().lower()] = v.strip().lower()
+            try:
+                length = int(headers.get("content-length") or 0)
+            except ValueError:
+                length = -1
+            if not 0 <= length <= service.max_body:
+                writer.write(_http_response(413 if length > 0 else 400, _json_bytes({"error": "Content-Length ungültig"}), False)); break
+            body = await reader.readexactly(length) if length else b""
+            conn = headers.get("connection", "")
+            keep_alive = conn != "close" if version == "HTTP/1.1" else conn == "keep-alive"
+            try:
+                status, payload = service.handle(method, target, body)
+            except Exception as e:  # z. B. defektes Template-Pack: 500 senden, Verbindung bleibt offen
+                print(f"Prompt-Service: {method} {target}: {e!r}", file=sys.stderr)
+                status, payload = 500, _json_bytes({"error": f"Interner Fehler: {e}"})
+            writer.write(_http_response(status, payload, keep_alive))
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def _start_http_server(service: ComposeService, host: str, port: int) -> Any:
+    import asyncio
+    return await asyncio.start_server(lambda r, w: _serve_connection(service, r, w), host, port, limit=service.max_body)
+
+def run_server(host: str = "127.0.0.1", port: int = 8765, cache_size: int = 4096) -> int:
+    import asyncio
+    start_metrics_server()
+    async def main() -> None:
+        server = await _start_http_server(ComposeService(cache_size), host, port)
+        print(f"Prompt-Service auf http://{host}:{port} (POST /validate, POST /compose, GET /schema)", file=sys.stderr)
+        async with server:
+            await server.serve_forever()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+async def _http_request(reader: Any, writer: Any, method: str, target: str, body: bytes = b"") -> Tuple[int, bytes]:
+    writer.write(f"{method} {target} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body)
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    length = next(int(l.split(":", 1)[1]) for l in lines if l.lower().startswith("content-length:"))
+    return int(lines[0].split(" ")[1]), await reader.readexactly(length)
+
+def run_loadtest(host: str = "127.0.0.1", port: int = 8765, endpoint: str = "/compose", connections: int = 32,
+                 requests: int = 20000, unique: float = 0.1) -> Dict[str, float]:
+    # Lasttest gegen einen lokal laufenden Service; `unique` = Anteil nicht cachebarer Anfragen
+    import asyncio
+    auftrag = "Konzept Kinderaktivität"
+    base = {"Bereich": "Elementarpädagogik", "Rolle": "Erzieher:in", "Auftrag": auftrag, "Zielgruppe": "U3",
+            "Thema": ["Musik"], "Rahmen": ["Drinnen"], "Dauer (Minuten)": "30", "Materialien": "Trommeln"}
+    hot = _json_bytes(base)
+    latencies: List[float] = []
+    errors = 0
+    per_conn = max(1, requests // connections)
+    async def client(cid: int) -> None:
+        nonlocal errors
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for i in range(per_conn):
+                body = hot if (i * 7919 + cid) % 1000 >= unique * 1000 else _json_bytes({**base, "Besonderheiten": f"{cid}-{i}"})
+                t0 = time.perf_counter()
+                status, _ = await _http_request(reader, writer, "POST", endpoint, body)
+                latencies.append(time.perf_counter() - t0)
+                if status >= 500: errors += 1
+        finally:
+            writer.close()
+    async def main() -> float:
+        t0 = time.perf_counter()
+        await asyncio.gather(*(client(c) for c in range(connections)))
+        return time.perf_counter() - t0
+    secs = asyncio.run(main())
+    latencies.sort()
+    def pct(p: float) -> float:
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+    return {"requests": len(latencies), "seconds": secs, "rps": len(latencies) / secs, "errors": errors,
+            "p50_ms": pct(0.50), "p95_ms": pct(0.95), "p99_ms": pct(0.99)}
+
+def _cli_loadtest(args: argparse.Namespace) -> int:
+    import socket, subprocess
+    proc = None
+    if args.spawn:
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "serve", "--host", args.host, "--port", str(args.port)])
+        for _ in range(100):
+            try:
+                socket.create_connection((args.host, args.port), timeout=0.1).close(); break
+            except OSError:
+                time.sleep(0.05)
+    try:
+        res = run_loadtest(args.host, args.port, args.endpoint, args.connections, args.requests, args.unique)
+    finally:
+        if proc is not None:
+            proc.terminate(); proc.wait()
+    print(f"{res['requests']} Anfragen in {res['seconds']:.2f}s: {res['rps']:,.0f}/s · "
+          f"p50 {res['p50_ms']:.2f} ms · p95 {res['p95_ms']:.2f} ms · p99 {res['p99_ms']:.2f} ms · Fehler {res['errors']}")
+    return 1 if res["errors"] else 0
+
+# -------------------- Draft store --------------------
+# Optionaler SQLite-Entwurfsspeicher (WAL). autosave() legt nur den neuesten Stand je
+# Entwurf im Speicher ab; ein Schreib-Thread sammelt `debounce` Sekunden lang und schreibt
+# alle offenen Entwürfe in einer Transaktion. Tippen erzeugt so keinen Schreibvorgang je
+# Tastendruck, und viele Sitzungen teilen sich wenige Transaktionen.
+DRAFTS_ENV = "PROMPT_BUILDER_DRAFTS"
+_DRAFT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS drafts (
+    user TEXT NOT NULL,
+    draft_id TEXT NOT NULL,
+    updated REAL NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (user, draft_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS drafts_user_updated ON drafts (user, updated DESC);
+"""
+_DRAFT_UPSERT = ("INSERT INTO drafts (user, draft_id, updated, data) VALUES (?, ?, ?, ?) "
+                 "ON CONFLICT (user, draft_id) DO UPDATE SET updated = excluded.updated, data = excluded.data")
+
+def encode_draft(selections: Dict[str, Any]) -> bytes:
+    # 1 Byte Format + kompaktes JSON, zlib-komprimiert sobald es kleiner wird
+    import zlib
+    raw = json.dumps(selections, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    packed = zlib.compress(raw, 6)
+    return b"\x01" + packed if len(packed) < len(raw) else b"\x00" + raw
+
+def decode_draft(blob: bytes) -> Dict[str, Any]:
+    import zlib
+    if blob[:1] == b"\x01": return json.loads(zlib.decompress(blob[1:]))
+    if blob[:1] == b"\x00": return json.loads(blob[1:])
+    raise ValueError(f"Unbekanntes Entwurfsformat: {blob[:1]!r}")
+
+class DraftStore:
+    def __init__(self, path: str, debounce: float = 0.5) -> None:
+        import threading
+        from collections import deque
+        self.path = path
+        self.debounce = debounce
+        self.rows_written = 0
+        self.transactions = 0
+        self.latencies: "deque[float]" = deque(maxlen=100_000)  # erste ungespeicherte Änderung -> Commit
+        self._pending: Dict[Tuple[str, str], Tuple[Dict[str, Any], float]] = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = False
+        self._local = threading.local()
+        conn = self._connect()
+        conn.executescript(_DRAFT_SCHEMA)
+        self._writer_conn = conn
+        self._writer = threading.Thread(target=self._run, name="draft-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> Any:
+        import sqlite3
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _reader(self) -> Any:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def autosave(self, user: str, draft_id: str, selections: Dict[str, Any]) -> None:
+        now = time.monotonic()
+        with self._lock:
+            prev = self._pending.get((user, draft_id))
+            self._pending[(user, draft_id)] = (selections, prev[1] if prev else now)
+
+    def _write_pending(self) -> int:
+        with self._write_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch: return 0
+            now = time.time()
+            rows = [(u, d, now, encode_draft(sel)) for (u, d), (sel, _) in batch.items()]
+            conn = self._writer_conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(_DRAFT_UPSERT, rows)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                with self._lock:  # nicht verlieren: neuere Stände behalten Vorrang
+                    for key, item in batch.items(): self._pending.setdefault(key, item)
+                raise
+            done = time.monotonic()
+            self.latencies.extend(done - t0 for _, t0 in batch.values())
+            self.rows_written += len(rows)
+            self.transactions += 1
+            return len(rows)
+
+    def _run(self) -> None:
+        while not self._stop:
+            self._wake.wait(self.debounce)
+            self._wake.clear()
+            try:
+                self._write_pending()
+            except Exception as e:  # z. B. gesperrte Datei: beim nächsten Durchlauf erneut
+                print(f"Entwurfsspeicher: {e}", file=sys.stderr)
+
+    def flush(self) -> int:
+        return self._write_pending()
+
+    def load(self, user: str, draft_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            pending = self._pending.get((user, draft_id))
+        if pending is not None:
+            return dict(pending[0])
+        row = self._reader().execute("SELECT data FROM drafts WHERE user = ? AND draft_id = ?", (user, draft_id)).fetchone()
+        return decode_draft(row[0]) if row else None
+
+    def list_drafts(self, user: str, limit: int = 20) -> List[Tuple[str, float]]:
+        return self._reader().execute("SELECT draft_id, updated FROM drafts WHERE user = ? ORDER BY updated DESC LIMIT ?",
+                                      (user, limit)).fetchall()
+
+    def iter_drafts(self, user: str) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        # Cursor-weise, damit auch viele Entwürfe nicht gemeinsam im Speicher liegen
+        self.flush()
+        cur = self._connect().execute("SELECT draft_id, data FROM drafts WHERE user = ? ORDER BY updated DESC", (user,))
+        try:
+            for draft_id, data in cur: yield draft_id, decode_draft(data)
+        finally:
+            cur.connection.close()
+
+    def delete(self, user: str, draft_id: str) -> None:
+        with self._lock:
+            self._pending.pop((user, draft_id), None)
+        with self._write_lock:
+            self._writer_conn.execute("DELETE FROM drafts WHERE user = ? AND draft_id = ?", (user, draft_id))
+
+    def close(self) -> None:
+        self._stop = True
+        self._wake.set()
+        self._writer.join()
+        self.flush()
+        self._writer_conn.close()
+
+def run_draft_stress(path: str, sessions: int = 300, seconds: float = 5.0, rate: float = 8.0,
+                     debounce: float = 0.5) -> Dict[str, float]:
+    # jede Sitzung "tippt" mit `rate` Zeichen/s in ein Freitextfeld und ruft autosave() je Zeichen
+    import random, threading
+    store = DraftStore(path, debounce)
+    call_lat: List[float] = []
+    lat_lock = threading.Lock()
+    stop = threading.Event()
+    def session(i: int) -> None:
+        rng = random.Random(i)
+        sel = bench_selections(rng.choice(list(DOMAIN_META)), 200)
+        local: List[float] = []
+        text = ""
+        while not stop.is_set():
+            text += rng.choice("abcdefghij ")
+            t0 = time.perf_counter()
+            store.autosave("stress", f"entwurf-{i}", {**sel, "Besonderheiten": text})
+            local.append(time.perf_counter() - t0)
+            stop.wait(rng.uniform(0.5, 1.5) / rate)
+        with lat_lock: call_lat.extend(local)
+    threads = [threading.Thread(target=session, args=(i,)) for i in range(sessions)]
+    t0 = time.perf_counter()
+    for t in threads: t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads: t.join()
+    store.close()
+    secs = time.perf_counter() - t0
+    lat = sorted(store.latencies)
+    call_lat.sort()
+    def pct(xs: List[float], p: float) -> float:
+        return xs[min(len(xs) - 1, int(p * len(xs)))] * 1000 if xs else 0.0
+    size = os.path.getsize(path)
+    return {"sessions": sessions, "seconds": secs, "autosave_calls": len(call_lat), "calls_per_s": len(call_lat) / secs,
+            "rows_written": store.rows_written, "rows_per_s": store.rows_written / secs, "transactions": store.transactions,
+            "persist_p50_ms": pct(lat, 0.5), "persist_p99_ms": pct(lat, 0.99), "call_p99_ms": pct(call_lat, 0.99),
+            "db_bytes": size}
+
+def _cli_drafts_stress(args: argparse.Namespace) -> int:
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        res = run_draft_stress(args.db or os.path.join(tmp, "drafts.sqlite3"), args.sessions, args.seconds, args.rate, args.debounce)
+    print(f"{res['sessions']} Sitzungen, {res['seconds']:.1f}s: {res['autosave_calls']} autosave() "
+          f"({res['calls_per_s']:,.0f}/s, p99 {res['call_p99_ms']:.3f} ms je Aufruf)")
+    print(f"geschrieben: {res['rows_written']} Zeilen in {res['transactions']} Transaktionen ({res['rows_per_s']:,.0f} Zeilen/s)")
+    print(f"Autosave-Latenz bis Commit: p50 {res['persist_p50_ms']:.0f} ms · p99 {res['persist_p99_ms']:.0f} ms")
+    return 0
+
+# -------------------- Export --------------------
+# Exporte werden erst auf Anforderung gebaut. Ein Bundle schreibt Eintrag für Eintrag in
+# den Ziel-Stream (auch nicht-seekbar, z. B. stdout) und hält nie das ganze Archiv im Speicher.
+EXPORT_FORMATS: Dict[str, Tuple[str, str, str]] = {  # Kürzel -> (Label, Dateiendung, MIME)
+    "txt": ("TXT", "txt", "text/plain"),
+    "json": ("JSON", "json", "application/json"),
+    "md": ("Markdown", "md", "text/markdown"),
+}
+
+def export_payload(fmt: str, prompt_text: str, selections: Dict[str, Any]) -> bytes:
+    if fmt == "txt": return prompt_text.encode("utf-8")
+    if fmt == "json": return json.dumps(selections, ensure_ascii=False, indent=2).encode("utf-8")
+    if fmt == "md": return f"## Prompt\n\n````\n{prompt_text}\n````\n".encode("utf-8")
+    raise ValueError(f"Unbekanntes Exportformat: {fmt}")
+
+def _bundle_name(name: str) -> str:
+    return re.sub(r"[^\w.-]+", "_", name).strip("._") or "prompt"
+
+def write_export_bundle(items: Iterable[Tuple[str, Optional[str], Dict[str, Any]]], dst: IO[bytes],
+                        formats: Iterable[str] = ("txt", "json"), compact: bool = False) -> int:
+    # items: (Name, Prompt oder None = aus der Auswahl erzeugen, Auswahl)
+    import zipfile
+    fmts = list(formats)
+    for fmt in fmts: export_payload(fmt, "", {})  # unbekannte Formate vor dem ersten Schreiben melden
+    count = 0
+    seen: Set[str] = set()
+    with zipfile.ZipFile(dst, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for name, prompt_text, sel in items:
+            base = _bundle_name(name)
+            if base in seen: base = f"{base}_{count}"
+            seen.add(base)
+            if prompt_text is None: prompt_text = render_prompt(sel, compact)
+            for fmt in fmts:
+                if fmt == "json" and not sel: continue  # Batch-Ausgabe enthält keine Auswahl
+                with zf.open(f"{base}.{EXPORT_FORMATS[fmt][1]}", "w") as entry:
+                    entry.write(export_payload(fmt, prompt_text, sel))
+            count += 1
+    return count
+
+def iter_jsonl_prompts(src: IO[str]) -> Iterator[Tuple[str, Optional[str], Dict[str, Any]]]:
+    # Batch-Ausgabe ({"line", "ok", "prompt"}) oder reine Auswahlen; ungültige Zeilen werden übersprungen
+    for n, line in enumerate(src, 1):
+        if not line.strip(): continue
+        try:
+            rec = json.loads(line)
+        except ValueError:
+            continue
+        if not isinstance(rec, dict): continue
+        if "ok" in rec and "line" in rec:
+            if rec.get("ok") and isinstance(rec["line"], int) and isinstance(rec.get("prompt"), str):
+                yield f"prompt_{rec['line']:06d}", rec["prompt"], {}
+        elif not validate(rec):
+            yield f"prompt_{n:06d}", None, rec
+
+def _cli_export_bundle(args: argparse.Namespace) -> int:
+    formats = [f.strip() for f in args.formats.split(",") if f.strip()]
+    unknown = [f for f in formats if f not in EXPORT_FORMATS]
+    if unknown or not formats:
+        print(f"Fehler: Unbekanntes Exportformat: {', '.join(unknown) or '(leer)'} "
+              f"(möglich: {', '.join(EXPORT_FORMATS)})", file=sys.stderr); return 2
+    # Eingabe vor der Ausgabe öffnen: ein Fehler hinterlässt keine leere ZIP-Datei
+    try:
+        src = None if args.drafts else sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    except OSError as e:
+        print(f"Fehler: {e}", file=sys.stderr); return 2
+    try:
+        try:
+            dst = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+        except OSError as e:
+            print(f"Fehler: {e}", file=sys.stderr); return 2
+        try:
+            if src is None:
+                store = DraftStore(args.drafts)
+                try:
+                    count = write_export_bundle(((d, None, sel) for d, sel in store.iter_drafts(args.user)
+                                                 if not validate(sel)), dst, formats, args.compact)
+                finally:
+                    store.close()
+            else:
+                count = write_export_bundle(iter_jsonl_prompts(src), dst, formats, args.compact)
+        finally:
+            if dst is not sys.stdout.buffer: dst.close()
+    finally:
+        if src is not None and src is not sys.stdin: src.close()
+    print(f"{count} Prompts exportiert", file=sys.stderr)
+    return 0
+
+# -------------------- LLM dispatch --------------------
+# Optionaler "Senden"-Schritt an einen OpenAI-kompatiblen Endpunkt (POST …/chat/completions,
+# SSE-Streaming). Aktiv nur mit PROMPT_BUILDER_LLM_URL. Nur Standardbibliothek:
+#   - Keep-Alive-Verbindungspool (http.client), LIFO, damit warme Verbindungen zuerst genutzt werden
+#   - Antwort-Cache auf der Platte mit LRU-Verdrängung, Schlüssel = Hash des normalisierten Prompts
+#   - gleiche Prompts im Flug teilen sich einen Upstream-Aufruf; alle Aufrufer streamen mit
+# Der Upstream-Aufruf läuft in einem eigenen Thread: bricht ein Streamlit-Rerun das Lesen ab,
+# wird die Antwort trotzdem fertig geladen und gecacht.
+LLM_URL_ENV = "PROMPT_BUILDER_LLM_URL"  # z. B. http://127.0.0.1:8766/v1
+LLM_MODEL_ENV = "PROMPT_BUILDER_LLM_MODEL"
+LLM_KEY_ENV = "PROMPT_BUILDER_LLM_KEY"
+LLM_CACHE_ENV = "PROMPT_BUILDER_LLM_CACHE"  # Cache-Verzeichnis (Standard: .llm_cache)
+
+def normalized_prompt(prompt: str) -> str:
+    # Zeilenend-Leerzeichen und Leerzeilen-Folgen ändern die Antwort nicht, sollen also den Cache treffen
+    text = "\n".join(line.rstrip() for line in prompt.strip().splitlines())
+    return re.sub(r"\n{3,}", "\n\n", text)
+
+class ResponseCache:
+    def __init__(self, path: str, max_bytes: int = 64 << 20) -> None:
+        import threading
+        from collections import OrderedDict
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index: "OrderedDict[str, int]" = OrderedDict()  # Schlüssel -> Bytes, älteste zuerst
+        entries = [(e.stat(), e.name[:-4]) for e in os.scandir(path) if e.name.endswith(".txt")]
+        for st, key in sorted(entries, key=lambda x: x[0].st_mtime):
+            self._index[key] = st.st_size
+        self._size = sum(self._index.values())
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, key + ".txt")
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            if key not in self._index: return None
+            self._index.move_to_end(key)
+        try:
+            with open(self._file(key), encoding="utf-8") as f:
+                text = f.read()
+            os.utime(self._file(key))  # LRU-Reihenfolge übersteht Neustarts
+            return text
+        except FileNotFoundError:
+            with self._lock:
+                self._size -= self._index.pop(key, 0)
+            return None
+
+    def put(self, key: str, text: str) -> None:
+        data = text.encode("utf-8")
+        tmp = f"{self._file(key)}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self._file(key))
+        with self._lock:
+            self._size += len(data) - self._index.pop(key, 0)
+            self._index[key] = len(data)
+            while self._size > self.max_bytes and len(self._index) > 1:
+                old, size = self._index.popitem(last=False)
+                self._size -= size
+                try:
+                    os.remove(self._file(old))
+                except FileNotFoundError:
+                    pass
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+class _ConnectionPool:
+    def __init__(self, base_url: str, size: int = 4, timeout: float = 120.0) -> None:
+        import threading
+        from urllib.parse import urlsplit
+        url = urlsplit(base_url)
+        self.https = url.scheme == "https"
+        self.host = url.hostname or "localhost"
+        self.port = url.port
+        self.prefix = url.path.rstrip("/")
+        self.timeout = timeout
+        self.opened = 0
+        self._idle: List[Any] = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def request(self, method: str, path: str, body: bytes, headers: Dict[str, str]) -> Tuple[Any, Any]:
+        import http.client
+        self._slots.acquire()
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            reused = conn is not None
+            if conn is None:
+                cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+                conn = cls(self.host, self.port, timeout=self.timeout)
+                self.opened += 1
+            try:
+                conn.request(method, self.prefix + path, body, headers)
+                return conn, conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionError):
+                conn.close()
+                if reused: continue  # vom Server geschlossene Keep-Alive-Verbindung: neu verbinden
+                self._slots.release()
+                raise
+            except BaseException:
+                conn.close(); self._slots.release()
+                raise
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle: conn.close()
+
+    def release(self, conn: Any, resp: Any, reuse: bool = True) -> None:
+        if reuse and resp.isclosed() and not resp.will_close:
+            with self._lock: self._idle.append(conn)
         else:
-            if v: done+=1
-    return (done, len(req))
+            conn.close()
+        self._slots.release()
+
+class _Flight:
+    __slots__ = ("chunks", "done", "error", "cond")
+
+    def __init__(self) -> None:
+        import threading
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.cond = threading.Condition()
+
+    def push(self, chunk: str) -> None:
+        with self.cond:
+            self.chunks.append(chunk); self.cond.notify_all()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        with self.cond:
+            self.done, self.error = True, error; self.cond.notify_all()
+
+    def follow(self) -> Iterator[str]:
+        i = 0
+        while True:
+            with self.cond:
+                while i >= len(self.chunks) and not self.done:
+                    self.cond.wait()
+                new, done = self.chunks[i:], self.done
+            i += len(new)
+            yield from new
+            if done: break
+        if self.error is not None:
+            raise RuntimeError(f"LLM-Anfrage fehlgeschlagen: {self.error}")
+
+class LLMClient:
+    def __init__(self, base_url: str, model: str = "gpt-4o-mini", api_key: str = "",
+                 cache: Optional[ResponseCache] = None, pool_size: int = 4) -> None:
+        import threading
+        from collections import deque
+        self.model = model
+        self.api_key = api_key
+        self.cache = cache
+        self.pool = _ConnectionPool(base_url, pool_size)
+        self.requests = self.hits = self.coalesced = self.upstream = self.errors = 0
+        self.first_token: "deque[float]" = deque(maxlen=1000)  # Sekunden bis zum ersten Stück
+        self.total: "deque[float]" = deque(maxlen=1000)
+        self._inflight: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def cache_key(self, prompt: str) -> str:
+        import hashlib
+        return hashlib.blake2b(f"{self.model}\0{normalized_prompt(prompt)}".encode("utf-8"), digest_size=16).hexdigest()
+
+    def stream(self, prompt: str) -> Iterator[str]:
+        import threading
+        t0 = time.perf_counter()
+        key = self.cache_key(prompt)
+        with self._lock:
+            self.requests += 1
+            flight = self._inflight.get(key)
+            if flight is not None:
+                self.coalesced += 1
+        if flight is None:
+            cached = self.cache.get(key) if self.cache is not None else None
+            if cached is not None:
+                with self._lock: self.hits += 1
+                self.first_token.append(time.perf_counter() - t0); self.total.append(time.perf_counter() - t0)
+                yield cached
+                return
+            with self._lock:
+                flight = self._inflight.get(key)
+                if flight is None:
+                    flight = self._inflight[key] = _Flight()
+                    self.upstream += 1
+                    threading.Thread(target=self._fetch, args=(key, prompt, flight), daemon=True).start()
+                else:
+                    self.coalesced += 1
+        first = True
+        for chunk in flight.follow():
+            if first:
+                self.first_token.append(time.perf_counter() - t0); first = False
+            yield chunk
+        self.total.append(time.perf_counter() - t0)
+
+    def complete(self, prompt: str) -> str:
+        return "".join(self.stream(prompt))
+
+    def close(self) -> None:
+        self.pool.close()
+
+    def _fetch(self, key: str, prompt: str, flight: _Flight) -> None:
+        body = json.dumps({"model": self.model, "stream": True,
+                           "messages": [{"role": "user", "content": prompt}]}).encode("utf-8")
+        headers = {"Content-Type": "application/json", "Accept": "text/event-stream"}
+        if self.api_key: headers["Authorization"] = f"Bearer {self.api_key}"
+        error: Optional[BaseException] = None
+        try:
+            conn, resp = self.pool.request("POST", "/chat/completions", body, headers)
+            ok = False
+            try:
+                if resp.status != 200:
+                    raise RuntimeError(f"HTTP {resp.status}: {resp.read(300).decode('utf-8', 'replace')}")
+                for raw in resp:
+                    line = raw.strip()
+                    if not line.startswith(b"data:"): continue
+                    data = line[5:].strip()
+                    if data == b"[DONE]": break
+                    choice = (json.loads(data).get("choices") or [{}])[0]
+                    piece = (choice.get("delta") or {}).get("content")
+                    if piece: flight.push(piece)
+                resp.read()  # Rest lesen, damit die Verbindung wiederverwendbar bleibt
+                ok = True
+            finally:
+                self.pool.release(conn, resp, ok)
+            if self.cache is not None:
+                self.cache.put(key, "".join(flight.chunks))
+        except Exception as e:
+            error = e
+            with self._lock: self.errors += 1
+        finally:
+            with self._lock: self._inflight.pop(key, None)
+            flight.finish(error)
+
+    def metrics(self) -> Dict[str, float]:
+        def pct(xs: Iterable[float], p: float) -> float:
+            v = sorted(xs)
+            return v[min(len(v) - 1, int(p * len(v)))] * 1000 if v else 0.0
+        return {"requests": self.requests, "hits": self.hits, "coalesced": self.coalesced, "upstream": self.upstream,
+                "errors": self.errors, "hit_rate": self.hits / self.requests if self.requests else 0.0,
+                "connections": self.pool.opened, "first_token_p50_ms": pct(self.first_token, 0.5),
+                "total_p50_ms": pct(self.total, 0.5), "total_p95_ms": pct(self.total, 0.95)}
+
+def _build_llm_client() -> Optional[LLMClient]:
+    url = os.environ.get(LLM_URL_ENV)
+    if not url: return None
+    return LLMClient(url, os.environ.get(LLM_MODEL_ENV) or "gpt-4o-mini", os.environ.get(LLM_KEY_ENV, ""),
+                     ResponseCache(os.environ.get(LLM_CACHE_ENV) or ".llm_cache"))
+
+# Lokaler Stub für Tests und Demos: antwortet deterministisch und streamt Wort für Wort
+class LLMStub:
+    def __init__(self, delay: float = 0.01) -> None:
+        self.delay = delay
+        self.calls = 0
+
+    def reply(self, prompt: str) -> List[str]:
+        words = normalized_prompt(prompt).split()[:40]
+        return ["Stub-Antwort:"] + [" " + w for w in words]
+
+async def _serve_stub_connection(stub: LLMStub, reader: Any, writer: Any) -> None:
+    import asyncio
+    try:
+        while True:
+            head = await reader.readuntil(b"\r\n\r\n")
+            lines = head.decode("latin-1").split("\r\n")
+            headers = {k.strip().lower(): v.strip() for k, _, v in (l.partition(":") for l in lines[1:] if l)}
+            body = await reader.readexactly(int(headers.get("content-length") or 0))
+            if not lines[0].split(" ")[1].endswith("/chat/completions"):
+                writer.write(_http_response(404, _json_bytes({"error": "Unbekannter Pfad"}), True)); continue
+            req = json.loads(body or b"{}")
+            stub.calls += 1
+            pieces = stub.reply(req["messages"][-1]["content"])
+            if not req.get("stream"):
+                msg = {"choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(pieces)}}]}
+                writer.write(_http_response(200, _json_bytes(msg), True)); await writer.drain(); continue
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+            for piece in pieces:
+                event = b"data: " + _json_bytes({"choices": [{"index": 0, "delta": {"content": piece}}]}) + b"\n\n"
+                writer.write(b"%x\r\n%s\r\n" % (len(event), event))
+                await writer.drain()
+                await asyncio.sleep(stub.delay)
+            done = b"data: [DONE]\n\n"
+            writer.write(b"%x\r\n%s\r\n0\r\n\r\n" % (len(done), done))
+            await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+def start_llm_stub(stub: LLMStub, host: str = "127.0.0.1", port: int = 0) -> Tuple[str, Any]:
+    # Stub in eigenem Thread samt Event-Loop; liefert Basis-URL und Stop-Funktion
+    import asyncio, threading
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    box: Dict[str, Any] = {}
+    async def main() -> None:
+        box["server"] = await asyncio.start_server(lambda r, w: _serve_stub_connection(stub, r, w), host, port)
+        started.set()
+    thread = threading.Thread(target=lambda: (loop.run_until_complete(main()), loop.run_forever()), daemon=True)
+    thread.start()
+    started.wait()
+    bound = box["server"].sockets[0].getsockname()[1]
+    def stop() -> None:
+        async def shutdown() -> None:
+            box["server"].close()
+            conns = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for t in conns: t.cancel()  # offene Keep-Alive-Verbindungen
+            await asyncio.gather(*conns, return_exceptions=True)
+            await box["server"].wait_closed()
+        asyncio.run_coroutine_threadsafe(shutdown(), loop).result()
+        loop.call_soon_threadsafe(loop.stop); thread.join(); loop.close()
+    return f"http://{host}:{bound}/v1", stop
+
+def _cli_llm_stub(args: argparse.Namespace) -> int:
+    url, stop = start_llm_stub(LLMStub(args.delay), args.host, args.port)
+    print(f"LLM-Stub auf {url} (export {LLM_URL_ENV}={url})", file=sys.stderr)
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt:
+        stop()
+    return 0
+
+def _cli_send(args: argparse.Namespace) -> int:
+    client = _build_llm_client()
+    if client is None:
+        print(f"{LLM_URL_ENV} ist nicht gesetzt.", file=sys.stderr); return 2
+    try:
+        src = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+        try:
+            text = src.read()
+        finally:
+            if src is not sys.stdin: src.close()
+        sel = json.loads(text) if args.selections else None
+    except (OSError, ValueError) as e:
+        print(f"Fehler: {args.input}: {e}", file=sys.stderr); return 2
+    if args.selections:
+        if not isinstance(sel, dict):
+            print("Fehler: Eingabe muss ein JSON-Objekt mit den Auswahlen sein", file=sys.stderr); return 2
+        issues = validate(sel, privacy=True)
+        if issues:
+            print("\n".join(issues), file=sys.stderr); return 1
+        text = render_prompt(sel)
+    try:
+        for chunk in client.stream(text):
+            sys.stdout.write(chunk); sys.stdout.flush()
+    except (OSError, ValueError, RuntimeError) as e:  # Upstream nicht erreichbar, Zeitüberschreitung, kaputte Antwort
+        print(f"\nFehler: {e}" if isinstance(e, RuntimeError) else f"\nFehler: LLM-Anfrage fehlgeschlagen: {e}", file=sys.stderr)
+        return 2
+    m = client.metrics()
+    print(f"\n[{'Cache' if m['hits'] else 'upstream'} · erstes Stück {m['first_token_p50_ms']:.0f} ms · gesamt {m['total_p50_ms']:.0f} ms]", file=sys.stderr)
+    return 0
+
+# -------------------- Similar entries --------------------
+# Vorschläge aus früheren Freitexten desselben Bereichs, Auftrags und Felds („Ziel des Gesprächs“,
+# „Materialien“ …). Archiviert und angeboten wird nur innerhalb eines Geltungsbereichs (eine
+# angemeldete Person bzw. deren Organisation); sensible Felder (Beobachtungen zu einzelnen
+# Kindern), Zahlenfelder und Texte mit Datenschutz-Funden nie. Jeder Text wird zu einem Vektor
+# aus Wörtern und Zeichen-Trigrammen (normalisiert wie die Suche, crc32-gehasht, L2-normiert).
+# Mit NumPy: Vorzeichen-Hashing auf SIMILAR_DIM Spalten, je Gruppe (Geltungsbereich, Bereich,
+# Auftrag, Feld) eine float32-Datei, die memory-mapped gelesen wird; eine Anfrage ist ein
+# Matrix-Vektor-Produkt über die Gruppe (= Kosinus) plus argpartition. Ohne NumPy: invertierter
+# Index über die ungefalteten Merkmale, sehr häufige Merkmale zählen bei Anfragen nicht mit.
+# Neue Texte werden angehängt (entries.jsonl + Vektordatei), der Index wird nie neu aufgebaut;
+# Gruppen werden erst bei der ersten Anfrage geladen.
+SIMILAR_ENV = "PROMPT_BUILDER_SIMILAR"  # Verzeichnis des Archiv-Index
+SIMILAR_SCOPE_ENV = "PROMPT_BUILDER_SIMILAR_SCOPE"  # "user" (Standard) oder "org" (Domain der E-Mail-Adresse)
+SIMILAR_DIM = 256
+SIMILAR_MIN_CHARS = 12  # kürzere Texte werden weder archiviert noch gesucht
+SIMILAR_MIN_SCORE = 0.35
+
+SimilarGroup = Tuple[str, str, str, str]  # (Geltungsbereich, Bereich, Auftrag, Feld)
+
+class SimilarEntry(NamedTuple):
+    text: str
+    score: float
+
+def _numpy() -> Any:
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+@lru_cache(maxsize=1 << 16)
+def _feature_hash(feature: str) -> int:
+    import zlib
+    return zlib.crc32(feature.encode("utf-8"))  # stabil über Prozesse, anders als hash()
+
+def similar_features(text: str) -> Dict[int, float]:
+    counts: Dict[int, float] = {}
+    for word in normalize_search(text).split():
+        padded = f" {word} "
+        for feature in [f"#{word}"] + [padded[j:j + 3] for j in range(len(padded) - 2)]:
+            h = _feature_hash(feature)
+            counts[h] = counts.get(h, 0.0) + 1.0
+    norm = sum(v * v for v in counts.values()) ** 0.5
+    return {h: v / norm for h, v in counts.items()} if norm else {}
+
+def _dense_rows(np: Any, features: List[Dict[int, float]]) -> Any:
+    rows = np.zeros((len(features), SIMILAR_DIM), dtype=np.float32)
+    sizes = [len(f) for f in features]
+    if sum(sizes):
+        hs = np.fromiter((h for f in features for h in f), dtype=np.uint32, count=sum(sizes))
+        ws = np.fromiter((w for f in features for w in f.values()), dtype=np.float32, count=sum(sizes))
+        at = np.repeat(np.arange(len(features)), sizes)
+        np.add.at(rows, (at, hs % SIMILAR_DIM), np.where(hs >> 31, ws, -ws))
+        norms = np.linalg.norm(rows, axis=1, keepdims=True)
+        np.divide(rows, norms, out=rows, where=norms > 0)  # nach dem Falten neu normieren
+    return rows
+
+class _DenseGroup:
+    # Vektoren einer Gruppe: memory-mapped Datei plus Puffer für seither angehängte Zeilen
+    def __init__(self, np: Any, path: Optional[str] = None) -> None:
+        self.np, self.path = np, path
+        self._mapped = np.zeros((0, SIMILAR_DIM), dtype=np.float32)
+        self._tail = np.empty((64, SIMILAR_DIM), dtype=np.float32)
+        self._n_tail = 0
+        if path is not None and os.path.exists(path): self._remap()
+
+    def __len__(self) -> int:
+        return len(self._mapped) + self._n_tail
+
+    def _remap(self) -> None:
+        rows = os.path.getsize(self.path) // (SIMILAR_DIM * 4)  # type: ignore[arg-type]
+        if rows:
+            self._mapped = self.np.memmap(self.path, dtype=self.np.float32, mode="r", shape=(rows, SIMILAR_DIM))
+        self._n_tail = 0
+
+    def truncate(self, rows: int) -> None:
+        # Datei länger als entries.jsonl (Abbruch zwischen beiden Schreibvorgängen)
+        self._mapped = self.np.zeros((0, SIMILAR_DIM), dtype=self.np.float32)
+        os.truncate(self.path, rows * SIMILAR_DIM * 4)  # type: ignore[arg-type]
+        self._remap()
+
+    def add(self, rows: Any) -> None:
+        if self.path is not None:
+            with open(self.path, "ab") as f: f.write(rows.tobytes())
+        need = self._n_tail + len(rows)
+        if need > len(self._tail):
+            grown = self.np.empty((max(need, 2 * len(self._tail)), SIMILAR_DIM), dtype=self.np.float32)
+            grown[:self._n_tail] = self._tail[:self._n_tail]
+            self._tail = grown
+        self._tail[self._n_tail:need] = rows
+        self._n_tail = need
+        if self.path is not None and self._n_tail >= 4096: self._remap()
+
+    def scores(self, query: Any) -> Any:
+        parts = [part @ query for part in (self._mapped, self._tail[:self._n_tail]) if len(part)]
+        return self.np.concatenate(parts) if len(parts) > 1 else parts[0]
+
+class _SparseGroup:
+    def __init__(self) -> None:
+        self.rows = 0
+        self.postings: Dict[int, Tuple[Any, Any]] = {}  # Merkmal -> (Zeilen, Gewichte)
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def add(self, features: Dict[int, float]) -> None:
+        from array import array
+        row, postings = self.rows, self.postings
+        self.rows += 1
+        for h, w in features.items():
+            post = postings.get(h)
+            if post is None: post = postings[h] = (array("I"), array("f"))
+            post[0].append(row); post[1].append(w)
+
+    def top(self, features: Dict[int, float], k: int) -> List[Tuple[int, float]]:
+        import heapq
+        limit = max(256, self.rows // 8)  # Stoppwort-artige Merkmale überspringen
+        scores: Dict[int, float] = {}
+        get = scores.get
+        for h, wq in features.items():
+            post = self.postings.get(h)
+            if post is None or len(post[0]) > limit: continue
+            for r, w in zip(*post): scores[r] = get(r, 0.0) + wq * w
+        return heapq.nlargest(k, scores.items(), key=lambda kv: kv[1])
+
+class SimilarityIndex:
+    def __init__(self, directory: Optional[str] = None, use_numpy: Optional[bool] = None) -> None:
+        import threading
+        self.np = _numpy() if use_numpy is not False else None
+        if use_numpy and self.np is None:
+            raise RuntimeError("NumPy ist nicht installiert")
+        self.directory = directory
+        self._texts: Dict[SimilarGroup, List[str]] = {}  # Texte je Gruppe in Zeilenreihenfolge
+        self._seen: Dict[SimilarGroup, Set[int]] = {}
+        self._groups: Dict[SimilarGroup, Any] = {}
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            try:
+                with open(os.path.join(directory, "entries.jsonl"), encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            rec = json.loads(line)
+                            group_key = tuple(rec["g"])
+                            if len(group_key) != 4: continue
+                            self._remember(group_key, rec["t"])  # type: ignore[arg-type]
+                        except (ValueError, KeyError, TypeError):
+                            continue  # abgebrochene letzte Zeile
+            except FileNotFoundError:
+                pass
+
+    def __len__(self) -> int:
+        return sum(map(len, self._texts.values()))
+
+    def _remember(self, key: SimilarGroup, text: str) -> bool:
+        h = hash(" ".join(text.casefold().split()))  # billig genug für 100k Einträge beim Start
+        seen = self._seen.setdefault(key, set())
+        if h in seen: return False
+        seen.add(h)
+        self._texts.setdefault(key, []).append(text)
+        return True
+
+    def _group(self, key: SimilarGroup) -> Any:
+        group = self._groups.get(key)
+        if group is not None: return group
+        texts = self._texts.get(key, [])
+        if self.np is None:
+            group = _SparseGroup()
+            for text in texts: group.add(similar_features(text))
+        else:
+            path = None
+            if self.directory is not None:
+                import hashlib
+                name = hashlib.blake2b("\0".join(key).encode("utf-8"), digest_size=8).hexdigest()
+                path = os.path.join(self.directory, f"{name}.f32")
+            group = _DenseGroup(self.np, path)
+            if len(group) > len(texts): group.truncate(len(texts))
+            if len(group) < len(texts):  # fehlende Vektoren nachtragen
+                group.add(_dense_rows(self.np, [similar_features(t) for t in texts[len(group):]]))
+        self._groups[key] = group
+        return group
+
+    def add_many(self, items: Iterable[Tuple[SimilarGroup, str]]) -> int:
+        # items: (Gruppe, Text); Dubletten und zu kurze Texte werden übersprungen
+        added: Dict[SimilarGroup, List[str]] = {}
+        with self._lock:
+            for group_key, text in items:
+                text = text.strip()
+                if len(text) < SIMILAR_MIN_CHARS: continue
+                self._group(group_key)  # Gruppe auf dem alten Stand laden, bevor sie wächst
+                if self._remember(group_key, text): added.setdefault(group_key, []).append(text)
+            if not added: return 0
+            if self.directory is not None:
+                with open(os.path.join(self.directory, "entries.jsonl"), "a", encoding="utf-8") as f:
+                    f.writelines(json.dumps({"g": g, "t": t}, ensure_ascii=False) + "\n"
+                                 for g, texts in added.items() for t in texts)
+            for group_key, texts in added.items():
+                features = [similar_features(t) for t in texts]
+                group = self._groups[group_key]
+                if self.np is None:
+                    for f in features: group.add(f)
+                else:
+                    group.add(_dense_rows(self.np, features))
+        return sum(map(len, added.values()))
+
+    def add(self, group_key: SimilarGroup, text: str) -> bool:
+        return self.add_many([(group_key, text)]) == 1
+
+    def similar(self, group_key: SimilarGroup, text: str, k: int = 3) -> List[SimilarEntry]:
+        texts = self._texts.get(group_key)
+        if not texts or len(text.strip()) < SIMILAR_MIN_CHARS: return []
+        features = similar_features(text)
+        if not features: return []
+        with self._lock:
+            group = self._group(group_key)
+            if self.np is None:
+                pairs = group.top(features, k + 1)
+            else:
+                np = self.np
+                sims = group.scores(_dense_rows(np, [features])[0])
+                n = min(k + 1, len(sims))
+                idx = np.argpartition(sims, len(sims) - n)[len(sims) - n:]
+                idx = idx[np.argsort(-sims[idx], kind="stable")]
+                pairs = [(int(i), float(sims[i])) for i in idx]
+        own = " ".join(text.casefold().split())
+        out = [SimilarEntry(texts[i], round(s, 3)) for i, s in pairs
+               if s >= SIMILAR_MIN_SCORE and " ".join(texts[i].casefold().split()) != own]
+        return out[:k]
+
+def similar_scope(identity: Optional[str]) -> Optional[str]:
+    # ohne Anmeldung kein Archiv, sonst sähe jede Sitzung die Texte aller anderen
+    if not identity: return None
+    if os.environ.get(SIMILAR_SCOPE_ENV, "user") == "org":
+        return "org:" + identity.rpartition("@")[2].casefold()
+    return "user:" + identity
+
+def similar_group(scope: str, selections: Dict[str, Any], key: str) -> SimilarGroup:
+    return (scope, pack_for(selections.get("Bereich")).bereich, str(selections.get("Auftrag") or ""), key)
+
+def similar_field(spec: Optional[FieldSpec]) -> bool:
+    # nur unkritische Freitextfelder: keine Zahlen, keine Beobachtungen zu einzelnen Kindern
+    return spec is not None and spec.freitext and spec.numeric is None and not spec.sensitive
+
+def archive_selections(index: SimilarityIndex, scope: Optional[str], selections: Dict[str, Any]) -> int:
+    # Freitexte einer erzeugten Auswahl archivieren; sensible Felder, Zahlen und Datenschutz-Funde nicht
+    auftrag = selections.get("Auftrag")
+    if scope is None or not isinstance(auftrag, str) or not auftrag: return 0
+    specs = pack_for(selections.get("Bereich")).index.specs.get(auftrag, _NO_SPECS)
+    items = [(similar_group(scope, selections, key), text) for key, text in _freetext_items(selections)
+             if similar_field(specs.get(key)) and not scan_text(text)]
+    return index.add_many(items)
+
+def _build_similarity_index() -> Optional[SimilarityIndex]:
+    directory = os.environ.get(SIMILAR_ENV)
+    return SimilarityIndex(directory) if directory else None
+
+_SIMILAR_WORDS = ("Kind", "Gruppe", "Morgenkreis", "Konflikt", "Spielecke", "Bauecke", "Garten", "Mittagessen", "Ruhephase",
+                  "Eltern", "Bezugsperson", "Sprache", "Bewegung", "Streit", "Rückzug", "Übergang", "Abholung", "Bringzeit",
+                  "zeigt", "sucht", "vermeidet", "reagiert", "beobachtet", "teilt", "weint", "lacht", "spielt", "beginnt",
+                  "häufig", "selten", "zunehmend", "deutlich", "kaum", "gemeinsam", "allein", "ruhig", "unruhig", "sicher",
+                  "Kontakt", "Material", "Regeln", "Aufmerksamkeit", "Unterstützung", "Hilfe", "Freude", "Interesse", "Ziel")
+
+def _synthetic_texts(n: int, seed: int = 1) -> List[str]:
+    import random
+    rng = random.Random(seed)
+    vocab = list(_SIMILAR_WORDS) + [f"{w}{s}" for w in _SIMILAR_WORDS[:24] for s in ("n", "s", "en", "ung", "lich")]
+    return [" ".join(rng.choice(vocab) for _ in range(rng.randint(10, 30))) + f" ({i})" for i in range(n)]
+
+def _cli_similar(args: argparse.Namespace) -> int:
+    if args.synthetic:
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp:
+            index = SimilarityIndex(tmp, use_numpy=False if args.no_numpy else None)
+            texts = _synthetic_texts(args.synthetic)
+            t0 = time.perf_counter()
+            group_key = ("bench", BUILTIN_PACK.bereich, "Elternabend planen", "Ziel des Gesprächs")
+            index.add_many((group_key, t) for t in texts)
+            built = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            index = SimilarityIndex(tmp, use_numpy=False if args.no_numpy else None)  # Neustart: Datei statt Aufbau
+            index.similar(group_key, texts[0])
+            reopened = time.perf_counter() - t0
+            samples: List[float] = []
+            for i in range(200):
+                query = " ".join(texts[(i * 7919) % len(texts)].split()[1:-1])  # abgewandelter Archivtext
+                t = time.perf_counter_ns()
+                index.similar(group_key, query, args.k)
+                samples.append((time.perf_counter_ns() - t) / 1e6)
+            samples.sort()
+            print(f"{len(index):,} Einträge ({'NumPy, memory-mapped' if index.np is not None else 'ohne NumPy'}): "
+                  f"Aufbau {built:.1f} s · Neustart + erste Anfrage {reopened * 1000:.0f} ms · "
+                  f"Anfrage p50 {samples[len(samples) // 2]:.1f} ms · p99 {samples[int(len(samples) * 0.99)]:.1f} ms")
+        return 0
+    directory = args.dir or os.environ.get(SIMILAR_ENV)
+    if not directory:
+        print(f"Fehler: --dir oder {SIMILAR_ENV} angeben", file=sys.stderr); return 2
+    index = SimilarityIndex(directory, use_numpy=False if args.no_numpy else None)
+    if not args.scope:
+        print("Fehler: --scope angeben (z. B. user:name@kita.example oder org:kita.example)", file=sys.stderr); return 2
+    if args.add:
+        src = sys.stdin if args.add == "-" else open(args.add, encoding="utf-8")
+        try:
+            added = sum(archive_selections(index, args.scope, json.loads(line)) for line in src if line.strip())
+        finally:
+            if src is not sys.stdin: src.close()
+        print(f"{added} Texte archiviert, {len(index)} insgesamt", file=sys.stderr)
+        return 0
+    if not (args.text and args.auftrag and args.field):
+        print("Fehler: Text, --auftrag und --field angeben", file=sys.stderr); return 2
+    sel = {"Bereich": args.bereich, "Auftrag": args.auftrag}
+    for hit in index.similar(similar_group(args.scope, sel, args.field), args.text, args.k):
+        print(f"{hit.score:.2f}  {hit.text}")
+    return 0
+
+# -------------------- Instrumentation --------------------
+# Opt-in über PROMPT_BUILDER_METRICS, z. B. "prometheus:9464", "jsonl:metrics.jsonl" oder beides
+# mit Komma getrennt. Ohne Variable bleibt alles unverändert: Hot-Path-Funktionen werden nur
+# bei aktivierter Messung umhüllt, phase() liefert einen geteilten No-op-Kontextmanager.
+METRICS_ENV = "PROMPT_BUILDER_METRICS"
+_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+class _PhaseTimer:
+    __slots__ = ("metrics", "name", "t0")
+
+    def __init__(self, metrics: "PhaseMetrics", name: str) -> None:
+        self.metrics, self.name = metrics, name
+
+    def __enter__(self) -> None:
+        self.t0 = time.perf_counter()
+
+    def __exit__(self, *exc: Any) -> None:
+        self.metrics.observe(self.name, time.perf_counter() - self.t0)
+
+class PhaseMetrics:
+    def __init__(self, log_path: Optional[str] = None, flush_every: int = 256) -> None:
+        import threading
+        self.log_path = log_path
+        self.flush_every = flush_every
+        self.counts: Dict[str, List[int]] = {}  # Phase -> Zähler je Bucket (+Inf zuletzt)
+        self.sums: Dict[str, float] = {}
+        self._buf: List[str] = []
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, secs: float) -> None:
+        from bisect import bisect_left
+        with self._lock:
+            counts = self.counts.get(name)
+            if counts is None:
+                counts = self.counts[name] = [0] * (len(_BUCKETS) + 1)
+                self.sums[name] = 0.0
+            counts[bisect_left(_BUCKETS, secs)] += 1
+            self.sums[name] += secs
+            if self.log_path is not None:
+                self._buf.append(f'{{"t":{time.time():.3f},"phase":{json.dumps(name)},"ms":{secs * 1000:.4f}}}\n')
+                if len(self._buf) >= self.flush_every: self._flush_locked()
+
+    def _flush_locked(self) -> None:
+        if self._buf and self.log_path is not None:
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write("".join(self._buf))
+            self._buf.clear()
+
+    def flush(self) -> None:
+        with self._lock: self._flush_locked()
+
+    def time(self, name: str) -> _PhaseTimer:
+        return _PhaseTimer(self, name)
+
+    def prometheus(self) -> str:
+        out = ["# HELP prompt_builder_phase_seconds Dauer je Phase eines Reruns bzw. Aufrufs",
+               "# TYPE prompt_builder_phase_seconds histogram"]
+        with self._lock:
+            snapshot = [(name, list(c), self.sums[name]) for name, c in sorted(self.counts.items())]
+        for name, counts, total in snapshot:
+            label = name.replace("\\", "\\\\").replace('"', '\\"')
+            acc = 0
+            for le, n in zip(_BUCKETS + (float("inf"),), counts):
+                acc += n
+                out.append(f'prompt_builder_phase_seconds_bucket{{phase="{label}",le="{"+Inf" if le == float("inf") else le}"}} {acc}')
+            out.append(f'prompt_builder_phase_seconds_sum{{phase="{label}"}} {total:.6f}')
+            out.append(f'prompt_builder_phase_seconds_count{{phase="{label}"}} {acc}')
+        return "\n".join(out) + "\n"
+
+    def serve(self, host: str = "127.0.0.1", port: int = 9464) -> Any:
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404); return
+                body = metrics.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args: Any) -> None:
+                pass
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        return server
+
+def _metrics_targets() -> Dict[str, str]:
+    spec = os.environ.get(METRICS_ENV) or ""
+    return dict(part.strip().partition(":")[::2] for part in spec.split(",") if part.strip())
+
+def _build_metrics() -> Optional[PhaseMetrics]:
+    targets = _metrics_targets()
+    if not targets: return None
+    import atexit
+    metrics = PhaseMetrics(targets.get("jsonl") or None)
+    atexit.register(metrics.flush)
+    return metrics
+
+def _build_metrics_server() -> Any:
+    # Port erst in den Einstiegspunkten (UI, serve) binden, nie beim Import: Kindprozesse
+    # (loadtest --spawn, memsim, spawn-Pools) erben die Variable und importieren das Modul erneut
+    targets = _metrics_targets()
+    if METRICS is None or "prometheus" not in targets: return None
+    return METRICS.serve(port=int(targets["prometheus"] or 9464))
+
+def start_metrics_server() -> Any:
+    return _process_shared(_build_metrics_server)
+
+_NULL_PHASE = __import__("contextlib").nullcontext()
+
+def phase(name: str) -> Any:
+    return _NULL_PHASE if METRICS is None else METRICS.time(name)
+
+def _timed(metrics: PhaseMetrics, name: str, fn: Any) -> Any:
+    from functools import wraps
+    observe, clock = metrics.observe, time.perf_counter
+    @wraps(fn)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        t0 = clock()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            observe(name, clock() - t0)
+    wrapper.__wrapped_phase__ = name  # type: ignore[attr-defined]
+    return wrapper
+
+METRICS: Optional[PhaseMetrics] = _process_shared(_build_metrics)
+if METRICS is not None:
+    # nur bei aktivierter Messung: Hot Paths umhüllen (sonst bleibt kein einziger Zusatzaufruf)
+    DomainIndex.leaf = _timed(METRICS, "domain_lookup", DomainIndex.leaf)  # type: ignore[method-assign]
+    validate = _timed(METRICS, "validate", validate)
+    progress_ratio = _timed(METRICS, "progress_ratio", progress_ratio)
+    WizardState.compose_prompt = _timed(METRICS, "compose_prompt", WizardState.compose_prompt)  # type: ignore[method-assign]
+    export_payload = _timed(METRICS, "export_payload", export_payload)
+    scan_selections = _timed(METRICS, "privacy_scan", scan_selections)
+
+def metrics_report(lines: Iterable[str]) -> Dict[str, Dict[str, float]]:
+    samples: Dict[str, List[float]] = {}
+    for line in lines:
+        if not line.strip(): continue
+        rec = json.loads(line)
+        samples.setdefault(rec["phase"], []).append(float(rec["ms"]))
+    out: Dict[str, Dict[str, float]] = {}
+    for name, xs in samples.items():
+        xs.sort()
+        def pct(p: float) -> float:
+            return xs[min(len(xs) - 1, int(p * len(xs)))]
+        out[name] = {"n": len(xs), "p50": pct(0.50), "p95": pct(0.95), "p99": pct(0.99), "max": xs[-1]}
+    return out
+
+def _cli_metrics_report(args: argparse.Namespace) -> int:
+    with open(args.log, encoding="utf-8") as f:
+        report = metrics_report(f)
+    width = max((len(n) for n in report), default=5)
+    print(f"{'Phase':<{width}}  {'n':>8}  {'p50 ms':>9}  {'p95 ms':>9}  {'p99 ms':>9}  {'max ms':>9}")
+    for name, r in sorted(report.items(), key=lambda kv: -kv[1]["p99"]):
+        print(f"{name:<{width}}  {int(r['n']):>8}  {r['p50']:>9.3f}  {r['p95']:>9.3f}  {r['p99']:>9.3f}  {r['max']:>9.3f}")
+    return 0
 
 # -------------------- Streamlit UI --------------------
+def _fragment(st: Any, name: str) -> Any:
+    # st.fragment (ab Streamlit 1.37) mit Laufzeitmessung; ältere Versionen rendern ohne Fragmente
+    frag = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda fn: fn)
+    def deco(fn: Any) -> Any:
+        def timed() -> None:
+            t0 = time.perf_counter()
+            try:
+                fn()
+            finally:
+                if METRICS is not None: METRICS.observe(f"fragment:{name}", time.perf_counter() - t0)
+                perf = st.session_state.perf
+                perf["ms"][name] = (time.perf_counter() - t0) * 1000
+                perf["runs"][name] = perf["runs"].get(name, 0) + 1
+        timed.__name__ = timed.__qualname__ = f"fragment_{name}"
+        return frag(timed)
+    return deco
+
+USER_HEADER_ENV = "PROMPT_BUILDER_USER_HEADER"  # z. B. X-Forwarded-User hinter einem Auth-Proxy
+
+def session_identity(st: Any) -> Optional[str]:
+    # angemeldete Person (Streamlit-Login oder vom Proxy gesetzter Header); ?user= in der URL zählt nicht
+    user = getattr(st, "user", None) or getattr(st, "experimental_user", None)
+    if getattr(user, "is_logged_in", False):
+        ident = getattr(user, "email", None) or getattr(user, "sub", None)
+        if ident: return str(ident)
+    header = os.environ.get(USER_HEADER_ENV)
+    if header:
+        headers = getattr(getattr(st, "context", None), "headers", None) or {}
+        ident = headers.get(header)
+        if ident: return str(ident).strip() or None
+    return None
+
 def run_streamlit_app() -> None:
     import streamlit as st
     import streamlit.components.v1 as components
 
+    t_start = time.perf_counter()
     st.set_page_config(page_title="Prompt-Builder", page_icon="🧭", layout="wide", initial_sidebar_state="expanded")
     st.markdown("""
     <div style="border:2px solid #ef4444; background:#fee2e2; color:#991b1b; padding:12px 16px; border-radius:8px; font-weight:700; margin:12px 0;">
@@ -352,136 +3552,278 @@ def run_streamlit_app() -> None:
       dass ein Rückschluss auf ein bestimmtes Kind möglich ist.
     </div>
     """, unsafe_allow_html=True)
-    st.title("🧭 Geführter Prompt-Builder — Elementarpädagogik")
 
+    store: Optional[DraftStore] = _process_shared(_build_draft_store)
+    llm: Optional[LLMClient] = _process_shared(_build_llm_client)
+    start_metrics_server()
+    similar: Optional[SimilarityIndex] = _process_shared(_build_similarity_index)
+    identity = session_identity(st)
+    similar_scope_id = similar_scope(identity)
+    if store is not None and "draft_id" not in st.session_state:
+        # Entwurf über die URL (?user=…&draft=…) fortsetzen bzw. neu anlegen; angemeldet gilt die Anmeldung
+        user = identity or st.query_params.get("user") or "anonym"
+        draft_id = st.query_params.get("draft")
+        loaded = store.load(user, draft_id) if draft_id else None
+        if loaded is not None:
+            st.session_state.state = WizardState(selections=loaded)
+        if not draft_id:
+            import uuid
+            draft_id = st.query_params["draft"] = uuid.uuid4().hex[:12]
+        st.session_state.draft_user, st.session_state.draft_id = user, draft_id
     if "state" not in st.session_state:
         st.session_state.state = WizardState()
-    state: WizardState = st.session_state.state
+    st.title(f"🧭 Geführter Prompt-Builder — {st.session_state.state.selections.get('Bereich') or BUILTIN_PACK.bereich}")
+    if "perf" not in st.session_state:
+        st.session_state.perf = {"full_runs": 0, "full_ms": 0.0, "ms": {}, "runs": {}}
+    st.session_state.full_run = True
 
-    with st.sidebar:
-        st.subheader("⚙️ Optionen")
-        d,t = progress_ratio(state.selections)
-        st.progress((d/t) if t else 0.0)
-        st.caption(f"Fortschritt Pflichtfelder: {d}/{t}" if t else "Noch kein Auftrag gewählt")
-        st.markdown("---")
-        if st.checkbox("Eingaben als JSON anzeigen"):
-            st.json(state.selections)
+    def index() -> DomainIndex:
+        return pack_for(state().selections.get("Bereich")).index
 
-    col_left, col_right = st.columns([2,1], gap="large")
+    def state() -> WizardState:
+        return st.session_state.state
 
-    with col_left:
-        st.subheader("Schritte")
+    def show_timings() -> bool:
+        return bool(st.session_state.get("show_timings"))
 
-        with st.container(border=True):
-            st.markdown("**Zwischenstand**")
-            if state.selections:
-                st.write("\n".join("• "+line for line in state.to_preview_lines()))
-            else:
-                st.caption("Noch nichts erfasst.")
+    def autosave() -> None:
+        sel = state().selections
+        if store is None or st.session_state.get("saved_version") == (id(sel), sel.version): return
+        st.session_state.saved_version = (id(sel), sel.version)
+        store.autosave(st.session_state.draft_user, st.session_state.draft_id, sel.to_dict())
+
+    def jump(hit: SearchHit) -> None:
+        # Callback läuft vor dem Rerun: Suchfeld leeren ist hier noch erlaubt
+        st.session_state.search_jumped = state().jump_to(hit) or st.session_state.get("search_jumped", False)
+        st.session_state.search_query = ""
+
+    # Rolle/Auftrag: eine Änderung baut die Details neu auf -> voller Rerun
+    @_fragment(st, "auswahl")
+    def selection_fragment() -> None:
+        sel = state().selections
+        options = bereiche()
+        if not sel.get("Bereich"): sel["Bereich"] = BUILTIN_PACK.bereich
+        if len(options) > 1:
+            current = sel["Bereich"]
+            chosen = st.selectbox("Bereich", options=options, index=options.index(current) if current in options else 0)
+            try:
+                pack_for(chosen)  # Pack erst jetzt laden
+            except (ValueError, OSError) as e:
+                st.error(f"Template-Pack „{chosen}“ kann nicht geladen werden: {e}")
+                chosen = BUILTIN_PACK.bereich
+            changed_bereich = state().set_bereich(chosen)
+            if PACKS is not None and chosen in PACKS.errors:
+                st.warning(f"Änderung am Pack „{chosen}“ nicht übernommen: {PACKS.errors[chosen]}")
+        else:
+            st.caption(f"Bereich: **{sel['Bereich']}** (fest)")
+            changed_bereich = False
+        idx = index()
+
+        query = st.text_input("🔎 Suche", key="search_query", placeholder="Rolle, Auftrag, Feld oder Option …")
+        if query:
+            hits = search(query, sel.get("Bereich"))
+            if not hits: st.caption("Keine Treffer.")
+            for i, hit in enumerate(hits):
+                st.button(hit.display(), key=f"search_hit_{i}", on_click=jump, args=(hit,))
 
-        state.selections.setdefault("Bereich","Elementarpädagogik")
-        st.caption("Bereich: **Elementarpädagogik** (fest)")
-
-        rollen = list(DOMAIN_TREE["Bereich"]["Elementarpädagogik"]["Rolle"].keys())
-        sel_rolle = st.selectbox("Rolle", options=[""]+rollen,
-                                 index=(rollen.index(state.selections.get("Rolle"))+1) if state.selections.get("Rolle") in rollen else 0)
-        if sel_rolle != state.selections.get("Rolle"):
-            state.selections["Rolle"] = sel_rolle or ""
-            for k in list(state.selections.keys()):
-                if k not in {"Bereich","Rolle","Auftrag"}: state.selections.pop(k, None)
-            state.selections.pop("Auftrag", None)
-
-        auftraege = list(DOMAIN_TREE["Bereich"]["Elementarpädagogik"]["Rolle"].get(state.selections.get("Rolle") or "", {}).get("Auftrag", {}).keys())
-        sel_auftrag = st.selectbox("Auftrag", options=[""]+auftraege,
-                                   index=(auftraege.index(state.selections.get("Auftrag"))+1) if state.selections.get("Auftrag") in auftraege else 0)
-        if sel_auftrag != state.selections.get("Auftrag"):
-            state.selections["Auftrag"] = sel_auftrag or ""
-            for k in list(state.selections.keys()):
-                if k not in {"Bereich","Rolle","Auftrag"}: state.selections.pop(k, None)
-
-        leaf = {}
-        if state.selections.get("Rolle") and state.selections.get("Auftrag"):
-            leaf = DOMAIN_TREE["Bereich"]["Elementarpädagogik"]["Rolle"][state.selections["Rolle"]]["Auftrag"][state.selections["Auftrag"]]
-        meta = DOMAIN_META.get(state.selections.get("Auftrag",""), {"multi":[],"required":[],"numeric":{}})
-        sensitive = {"Kind-Profil (Stärken/Bedarfe)","Situation","Interpretation"}
-
-        if leaf:
+        sel_rolle = st.selectbox("Rolle", options=("",)+idx.rollen,
+                                 index=idx.rolle_pos.get(sel.get("Rolle") or "", -1)+1)
+        changed = state().set_rolle(sel_rolle) or changed_bereich
+
+        rolle = sel.get("Rolle") or ""
+        sel_auftrag = st.selectbox("Auftrag", options=("",)+idx.auftraege.get(rolle, ()),
+                                   index=idx.auftrag_pos.get((rolle, sel.get("Auftrag") or ""), -1)+1)
+        changed = state().set_auftrag(sel_auftrag) or changed
+        changed = st.session_state.pop("search_jumped", False) or changed
+        autosave()
+        if changed and not st.session_state.full_run:
+            st.rerun()
+
+    # Details: Tippen rerendert nur dieses Fragment, daher stehen Zwischenstand, Token-Schätzung
+    # und JSON-Ansicht hier; ein voller Rerun (Sidebar-Fortschritt) erfolgt nur, wenn sich die
+    # Zahl der erfüllten Pflichtfelder ändert.
+    @_fragment(st, "details")
+    def details_fragment() -> None:
+        ws = state()
+        sel = ws.selections
+        specs = index().leaf(sel.get("Rolle"), sel.get("Auftrag"))
+        summary = st.container(border=True)  # erst nach den Eingaben gefüllt: zeigt den Stand dieses Durchlaufs
+
+        def suggest(spec: FieldSpec, text: str) -> None:
+            # ähnliche frühere Einträge (eigener Geltungsbereich, gleiches Feld) zum Übernehmen anbieten
+            if similar is None or similar_scope_id is None or not similar_field(spec): return
+            key = spec.key
+            with phase("similar"):
+                hits = similar.similar(similar_group(similar_scope_id, sel, key), text)
+            if hits:
+                with st.expander(f"💡 {len(hits)} ähnliche frühere Einträge"):
+                    for i, hit in enumerate(hits):
+                        st.caption(f"{hit.score:.0%} · {hit.text}")
+                        st.button("Übernehmen", key=f"similar_{key}_{i}", on_click=ws.set, args=(key, hit.text))
+
+        if specs:
             st.markdown("---"); st.subheader("Details")
-            for key, sub in leaf.items():
-                if isinstance(sub, list):
-                    options = sub
-                    current = state.selections.get(key)
-                    if key in meta.get("multi", []):
-                        default = current if isinstance(current, list) else ([current] if current else [])
-                        val = st.multiselect(key, options, default=default)
-                        state.selections[key] = val
-                        if key in meta.get("required", []) and not val:
-                            st.caption("Pflichtfeld: bitte mindestens eine Option wählen.")
-                    else:
-                        idx = (options.index(current)+1) if isinstance(current, str) and current in options else 0
-                        val = st.selectbox(key, options=[""]+options, index=idx)
-                        state.selections[key] = val or ""
-                        if key in meta.get("required", []) and not val:
-                            st.caption("Pflichtfeld: bitte auswählen.")
-                elif sub == "freitext":
-                    is_long = any(t in key.lower() for t in ["beschreibung","material","besonder","situation","interpretation","förder","profil","ziel","maßnahmen","planungs"])
-                    if key == "Dauer (Minuten)":
-                        raw = st.text_input(key, value=str(state.selections.get(key, "")))
-                        state.selections[key] = raw
-                        rng = meta.get("numeric", {}).get(key)
-                        if raw:
-                            try:
-                                num = float(str(raw).replace(",", "."))
-                                if rng and (num < rng.get("min", -1e9) or num > rng.get("max", 1e9)):
-                                    st.caption(f"Zahl außerhalb des gültigen Bereichs ({rng.get('min','?')}–{rng.get('max','?')}).")
-                            except Exception:
-                                st.caption("Bitte Zahl eingeben (z. B. 30).")
-                        elif key in meta.get("required", []):
-                            st.caption("Pflichtfeld: bitte ausfüllen.")
-                    elif is_long:
-                        val = st.text_area(key, value=state.selections.get(key,""), height=100)
-                        state.selections[key] = val
-                        if key in sensitive:
-                            st.caption("Hinweis Datenschutz: bitte neutral/abstrahiert formulieren, keine personenbezogenen Details.")
+            with phase("details_render"):
+                for spec in specs:
+                    key = spec.key
+                    if not spec.freitext:
+                        current = sel.get(key)
+                        if spec.multi:
+                            default = current if isinstance(current, list) else ([current] if current else [])
+                            val = st.multiselect(key, spec.options, default=default)
+                            ws.set(key, val)
+                            if spec.required and not val:
+                                st.caption("Pflichtfeld: bitte mindestens eine Option wählen.")
+                        else:
+                            idx_opt = (spec.positions.get(current, -1)+1) if isinstance(current, str) else 0
+                            val = st.selectbox(key, options=("",)+spec.options, index=idx_opt)
+                            ws.set(key, val or "")
+                            if spec.required and not val:
+                                st.caption("Pflichtfeld: bitte auswählen.")
                     else:
-                        val = st.text_input(key, value=state.selections.get(key,""))
-                        state.selections[key] = val
-                        if key in sensitive:
-                            st.caption("Hinweis Datenschutz: bitte neutral/abstrahiert formulieren, keine personenbezogenen Details.")
+                        rule = spec.numeric
+                        if rule is not None:
+                            raw = st.text_input(key, value=str(sel.get(key, "")))
+                            ws.set(key, raw)
+                            if raw:
+                                num = rule.parse(raw)
+                                if num is None:
+                                    st.caption("Bitte Zahl eingeben (z. B. 30).")
+                                elif not rule.in_range(num):
+                                    lo = rule.min if rule.min is not None else "?"
+                                    hi = rule.max if rule.max is not None else "?"
+                                    st.caption(f"Zahl außerhalb des gültigen Bereichs ({lo}–{hi}).")
+                            elif spec.required:
+                                st.caption("Pflichtfeld: bitte ausfüllen.")
+                        elif spec.long:
+                            val = st.text_area(key, value=sel.get(key,""), height=100, help=ROSTER_HELP.get(key))
+                            ws.set(key, val)
+                            suggest(spec, val)
+                            if spec.sensitive:
+                                st.caption("Hinweis Datenschutz: bitte neutral/abstrahiert formulieren, keine personenbezogenen Details.")
+                        else:
+                            val = st.text_input(key, value=sel.get(key,""), help=ROSTER_HELP.get(key))
+                            ws.set(key, val)
+                            suggest(spec, val)
+                            if spec.sensitive:
+                                st.caption("Hinweis Datenschutz: bitte neutral/abstrahiert formulieren, keine personenbezogenen Details.")
+            findings = scan_selections(sel)
+            if findings:
+                st.warning("🔒 Mögliche personenbezogene Angaben – bitte abstrahieren:\n\n" +
+                           "\n".join(f"- {f.field}: {f.kind} „{f.text}“" for f in findings))
+        with summary:
+            st.markdown("**Zwischenstand**")
+            if sel:
+                st.write("\n".join("• "+line for line in ws.to_preview_lines()))
+            else:
+                st.caption("Noch nichts erfasst.")
+            report = ws.token_report()
+            budget = st.session_state.shown_budget = st.session_state.get("token_budget") or 0
+            st.caption(f"Prompt-Größe (geschätzt): {report.total} Tokens" + (f" / Budget {budget}" if budget else ""))
+            if budget and report.total > budget:
+                st.caption("⚠️ Über Budget: die längsten Freitextfelder werden beim Erzeugen gekürzt.")
+            with st.expander("Tokens je Feld"):
+                st.caption(f"Vorlage: {report.static}")
+                for name, n in sorted(report.fields.items(), key=lambda kv: -kv[1]):
+                    st.caption(f"{name}: {n}")
+            if st.checkbox("Eingaben als JSON anzeigen"):
+                st.json(sel.to_dict())
+        autosave()
+        progress = progress_ratio(sel)
+        if not st.session_state.full_run and progress != st.session_state.get("shown_progress"):
+            st.rerun()
+        if show_timings():
+            perf = st.session_state.perf
+            st.caption(f"⏱️ Details-Fragment: {perf['ms'].get('details', 0.0):.1f} ms · "
+                       f"Fragment-Reruns: {perf['runs'].get('details', 0)} · volle Reruns: {perf['full_runs']}")
 
-        st.markdown("---")
+    @_fragment(st, "ergebnis")
+    def result_fragment() -> None:
+        st.subheader("Ergebnis")
         c1,c2,c3 = st.columns(3)
         with c1:
             if st.button("🔄 Zurücksetzen", use_container_width=True):
-                st.session_state.state = WizardState(); st.rerun()
+                state().reset(); autosave()
+                st.session_state.result = None; st.session_state.pop("export", None)
+                st.rerun()
         with c2:
             preview_clicked = st.button("👁️ Vorschau", use_container_width=True)
         with c3:
             gen_clicked = st.button("✨ Prompt erzeugen", use_container_width=True)
-
-    with col_right:
-        st.subheader("Ergebnis")
-        result_placeholder = st.empty()
-        downloads_placeholder = st.container()
-
-    want_output = preview_clicked or gen_clicked
-    issues = validate(state.selections) if want_output else []
-    if want_output and issues:
-        st.error("Bitte folgende Punkte korrigieren, bevor der Prompt erzeugt wird:")
-        st.write("\n".join("• "+m for m in issues))
-    elif want_output:
-        prompt_text = state.compose_prompt()
-        result_placeholder.code(prompt_text)
-        with downloads_placeholder:
-            st.download_button("⬇️ TXT", data=prompt_text, file_name="prompt_output.txt", mime="text/plain")
-            st.download_button("⬇️ JSON", data=json.dumps(state.selections, ensure_ascii=False, indent=2), file_name="prompt.json", mime="application/json")
-            md = f"## Prompt\n\n````\n{prompt_text}\n````\n"
-            st.download_button("⬇️ Markdown", data=md, file_name="prompt.md", mime="text/markdown")
-            st.caption("Tipp: Im Code-Block oben gibt es einen Copy-Button. Falls dein Browser blockt, nutze den Fallback unten.")
-            import streamlit.components.v1 as components
+        if preview_clicked or gen_clicked:
+            st.session_state.pop("export", None)
+            st.session_state.result = None
+            issues = validate(state().selections, privacy=st.session_state.get("privacy_block", True))
+            if issues:
+                st.error("Bitte folgende Punkte korrigieren, bevor der Prompt erzeugt wird:")
+                st.write("\n".join("• "+m for m in issues))
+                return
+            budget = st.session_state.get("token_budget") or 0
+            roster_text = None
+            if state().selections.get("Auftrag") == ROSTER_AUFTRAG and st.session_state.get("roster_draft", True):
+                try:
+                    draft = roster_draft(state().selections)
+                except ValueError as e:
+                    st.warning(f"🗓️ Kein Dienstplan-Entwurf: {e}")
+                else:
+                    roster_text = render_roster(draft)
+                    st.caption(f"🗓️ Dienstplan-Entwurf lokal berechnet ({draft.seconds * 1000:.0f} ms)" +
+                               (f", {len(draft.shortfalls)} Slots unterbesetzt" if draft.shortfalls else ""))
+                    if draft.model.unparsed:
+                        st.warning("🗓️ Nicht erkannt und im Entwurf ignoriert: " + "; ".join(f"„{c}“" for c in draft.model.unparsed) +
+                                   " – Personen bitte als MA1, MA2 … angeben.")
+            if budget:
+                if roster_text:
+                    fit, kept = fit_roster_budget(state(), roster_text, budget)
+                    if not kept:
+                        st.info(f"🗓️ Dienstplan-Entwurf (ca. {estimate_tokens(roster_text)} Tokens) passt nicht "
+                                f"ins Budget von {budget} Tokens und wurde weggelassen.")
+                else:
+                    fit = state().fit_budget(budget)
+                prompt_text = fit.prompt
+                if fit.trimmed:
+                    st.info(f"Auf ca. {fit.report.total} Tokens gekürzt: " + ", ".join(fit.trimmed))
+            else:
+                prompt_text = state().compose_prompt()
+                if roster_text: prompt_text = embed_roster(prompt_text, roster_text)
+            if gen_clicked and similar is not None:
+                archive_selections(similar, similar_scope_id, state().selections)
+            # Stand des Erzeugens festhalten: Exporte beziehen sich genau auf diesen Prompt
+            st.session_state.result = (prompt_text, state().selections.to_dict())
+        result = st.session_state.get("result")
+        if not result:
+            return
+        prompt_text, snapshot = result
+        st.code(prompt_text)
+        # Nur das gewählte Format wird gebaut, und erst nach Klick
+        e1, e2 = st.columns([2, 1])
+        with e1:
+            fmt = st.radio("Export", list(EXPORT_FORMATS), format_func=lambda f: EXPORT_FORMATS[f][0],
+                           horizontal=True, label_visibility="collapsed")
+        with e2:
+            if st.button("📄 Export vorbereiten", use_container_width=True):
+                st.session_state.export = (fmt, export_payload(fmt, prompt_text, snapshot))
+        export = st.session_state.get("export")
+        if export and export[0] == fmt:
+            label, ext, mime = EXPORT_FORMATS[fmt]
+            st.download_button(f"⬇️ {label}", data=export[1], file_name=f"prompt.{ext}", mime=mime, on_click="ignore")
+        if llm is not None:
+            if st.button("🤖 An LLM senden"):
+                try:
+                    answer = st.write_stream(llm.stream(prompt_text))
+                except (RuntimeError, OSError) as e:  # Upstream-Fehler, Zeitüberschreitung; Teilantwort nicht merken
+                    st.error(f"🤖 {e}" if isinstance(e, RuntimeError) else f"🤖 LLM-Anfrage fehlgeschlagen: {e}")
+                else:
+                    st.session_state.llm_response = (prompt_text, answer)
+            elif (st.session_state.get("llm_response") or ("",))[0] == prompt_text:
+                st.markdown(st.session_state.llm_response[1])
+        st.caption("Tipp: Im Code-Block oben gibt es einen Copy-Button. Falls dein Browser blockt, nutze den Fallback.")
+        if st.button("📋 Kopier-Fallback"):
+            # liest bevorzugt den Code-Block der Seite; der eingebettete Text ist nur die Reserve
+            import html
             components.html(f'''
             <div style="margin-top:8px">
-              <textarea id="pb_copy" style="position:absolute; left:-9999px;">{prompt_text}</textarea>
+              <textarea id="pb_copy" style="position:absolute; left:-9999px;">{html.escape(prompt_text)}</textarea>
               <button style="padding:6px 10px"
                 onclick="const el=document.getElementById('pb_copy'); el.select(); document.execCommand('copy'); this.innerText='Kopiert!'; setTimeout(()=>this.innerText='In die Zwischenablage kopieren (Fallback)',1200);">
                 In die Zwischenablage kopieren (Fallback)
@@ -489,6 +3831,64 @@ def run_streamlit_app() -> None:
             </div>
             ''', height=40)
 
+    # Sidebar zuletzt, damit der Fortschritt die Werte dieses Durchlaufs zeigt
+    @_fragment(st, "sidebar")
+    def sidebar_fragment() -> None:
+        sel = state().selections
+        d,t = progress_ratio(sel)
+        st.session_state.shown_progress = (d, t)
+        st.progress((d/t) if t else 0.0)
+        st.caption(f"Fortschritt Pflichtfelder: {d}/{t}" if t else "Noch kein Auftrag gewählt")
+        st.number_input("Token-Budget (0 = aus)", min_value=0, step=100, key="token_budget")
+        if not st.session_state.full_run and (st.session_state.get("token_budget") or 0) != st.session_state.get("shown_budget"):
+            st.rerun()  # der Zwischenstand im Details-Fragment zeigt das Budget
+        st.markdown("---")
+        st.checkbox("🔒 Datenschutz-Funde blockieren das Erzeugen", value=True, key="privacy_block")
+        if sel.get("Auftrag") == ROSTER_AUFTRAG:
+            st.checkbox("🗓️ Dienstplan-Entwurf lokal vorberechnen", value=True, key="roster_draft")
+        if llm is not None and llm.requests:
+            m = llm.metrics()
+            st.caption(f"🤖 LLM: {m['requests']} Anfragen · Cache-Treffer {m['hit_rate']:.0%} · gebündelt {m['coalesced']} · "
+                       f"erstes Stück p50 {m['first_token_p50_ms']:.0f} ms · gesamt p50 {m['total_p50_ms']:.0f} / "
+                       f"p95 {m['total_p95_ms']:.0f} ms · Verbindungen {m['connections']}")
+        if store is not None:
+            st.caption(f"💾 Entwurf `{st.session_state.draft_id}` wird automatisch gespeichert "
+                       "(Link mit ?draft=… setzt ihn fort).")
+            if st.button("📦 Alle Entwürfe als ZIP" if identity else "📦 Entwurf als ZIP"):
+                import tempfile
+                # alle Entwürfe nur mit Anmeldung; ohne nur der Entwurf dieser Sitzung
+                drafts = (store.iter_drafts(identity) if identity else
+                          iter([(st.session_state.draft_id, sel.to_dict())]))
+                # Archiv entsteht in einer Temp-Datei, nicht im Speicher
+                with tempfile.TemporaryFile() as tmp:
+                    n = write_export_bundle(((d, None, s) for d, s in drafts if not validate(s)), tmp)
+                    tmp.seek(0)
+                    st.download_button(f"⬇️ {n} Prompts (ZIP)", data=tmp, file_name="prompts.zip",
+                                       mime="application/zip", on_click="ignore")
+        st.checkbox("⏱️ Rerun-Zeiten anzeigen", key="show_timings")
+        if show_timings():
+            perf = st.session_state.perf
+            st.caption(f"Voller Rerun: {perf['full_ms']:.1f} ms (#{perf['full_runs']})")
+            for name, ms in perf["ms"].items():
+                st.caption(f"Fragment {name}: {ms:.1f} ms (#{perf['runs'].get(name, 0)})")
+
+    col_left, col_right = st.columns([2,1], gap="large")
+    with col_left:
+        st.subheader("Schritte")
+        selection_fragment()
+        details_fragment()
+    with col_right:
+        result_fragment()
+    with st.sidebar:
+        st.subheader("⚙️ Optionen")
+        sidebar_fragment()
+
+    perf = st.session_state.perf
+    perf["full_runs"] += 1
+    perf["full_ms"] = (time.perf_counter() - t_start) * 1000
+    if METRICS is not None: METRICS.observe("full_rerun", perf["full_ms"] / 1000)
+    st.session_state.full_run = False
+
 def run_tests() -> int:
     # leichte Smoke-Tests der Logik
     ws = WizardState(selections={"Rolle":"Erzieher:in","Bereich":"Elementarpädagogik","Auftrag":"Konzept Kinderaktivität"})
@@ -496,14 +3896,775 @@ def run_tests() -> int:
     sel = {"Bereich":"Elementarpädagogik","Rolle":"Kita-Leitung","Auftrag":"Dienstplanung erstellen",
            "Rahmen":["Regelbetrieb"],"Planungszeitraum (KW/Monat)":"KW 41-44","Schichtmodell":["Früh"],"Mindestbesetzung je Zeitslot":"2"}
     assert not validate(sel)
+    # kompiliertes Template muss byteidentisch zur str.replace-Variante sein
+    for auftrag, fields in DOMAIN_INDEX.auftrag_fields.items():
+        full = {k: (["A", "B"] if k in DOMAIN_META[auftrag]["multi"] else f"Wert {k}") for k in fields}
+        full.update({"Bereich":"Elementarpädagogik","Auftrag":auftrag})
+        for s in ({"Auftrag": auftrag}, full, {**full, "Situation": "fremd"}):
+            assert WizardState(selections=dict(s)).compose_prompt() == _legacy_compose(s), auftrag
+        compact = WizardState(selections=full).compose_prompt(compact=True)
+        ctx = set(DEFAULT_KEYS) - _CORE_KEYS
+        assert all((f"- {k}: " in compact) == (k in fields) for k in ctx), auftrag
+    # Batch: Reihenfolge, Fehlerzeilen, leere Zeilen
+    import io
+    out = io.StringIO()
+    count, _ = run_batch(io.StringIO(json.dumps(sel) + "\n\n{kaputt\n" + json.dumps({"Auftrag":"Elternbrief verfassen"}) + "\n"), out, chunk_size=2)
+    rows = [json.loads(l) for l in out.getvalue().splitlines()]
+    assert count == 3 and [r["line"] for r in rows] == [1, 3, 4]
+    assert rows[0]["ok"] and rows[0]["prompt"] == WizardState(selections=sel).compose_prompt()
+    assert "error" in rows[1] and "Pflichtfeld fehlt: Anlass" in rows[2]["issues"]
+    # Validatoren: Mehrfachauswahl, Zahlenbereich, Gruppierung, Konsistenzprüfung
+    bad = {"Bereich":"Elementarpädagogik","Rolle":"Erzieher:in","Auftrag":"Konzept Kinderaktivität","Thema":[],"Dauer (Minuten)":"9999"}
+    assert validate(bad) == ["Pflichtfeld fehlt: Zielgruppe","Pflichtfeld (Mehrfachauswahl) fehlt: Thema","Pflichtfeld fehlt: Rahmen","Dauer (Minuten): muss ≤ 600 sein"]
+    assert progress_ratio(bad) == (4, 7) and progress_ratio({}) == (0, 0)
+    assert validate_many([sel, bad, {}]) == [validate(sel), validate(bad), validate({})]
+    assert validate({**bad, "Dauer (Minuten)": "zehn"})[-1] == "Dauer (Minuten): muss eine Zahl sein"
+    broken = {**DOMAIN_META, "Elternbrief verfassen": {"required": [], "multi": [], "numeric": {"Anlass": {"min": 1}}}}
+    try:
+        compile_validators(DOMAIN_TREE, broken); raise AssertionError("Inkonsistenz nicht erkannt")
+    except ValueError as e:
+        assert "Zahlenfeld 'Anlass'" in str(e)
+    # Domain-Index
+    assert DOMAIN_INDEX.auftraege["Praxisanleiter:in"] == ("Anleitung planen", "Feedbackgespräch führen")
+    thema = next(f for f in DOMAIN_INDEX.leaf("Erzieher:in", "Konzept Kinderaktivität") if f.key == "Thema")
+    assert thema.multi and thema.required and thema.positions["Musik"] == thema.options.index("Musik")
+    assert "Dienstplanung erstellen" in DOMAIN_INDEX.field_auftraege["Rahmen"] and DOMAIN_INDEX.leaf("Erzieher:in", None) == ()
+    # HTTP-Service: Routing, Cache, Keep-Alive-Roundtrip
+    svc = ComposeService(cache_size=2)
+    status, body = svc.handle("POST", "/compose", _json_bytes(sel))
+    assert status == 200 and json.loads(body)["prompt"] == WizardState(selections=sel).compose_prompt()
+    assert svc.handle("POST", "/compose", _json_bytes({**sel, "Restriktionen/Wünsche": ""}))[1] == body and svc.hits == 1
+    assert svc.handle("POST", "/compose", b"{}")[0] == 422 and svc.handle("GET", "/compose", b"")[0] == 405
+    assert svc.handle("POST", "/validate", b"[1]")[0] == 400 and svc.handle("GET", "/nix", b"")[0] == 404
+    assert json.loads(svc.handle("GET", "/schema", b"")[1])["meta"] == DOMAIN_META
+    import asyncio
+    class FailingService(ComposeService):
+        def handle(self, method: str, target: str, body: bytes) -> Tuple[int, bytes]:
+            if target == "/kaputt": raise RuntimeError("kaputt")
+            return super().handle(method, target, body)
+    async def roundtrip() -> List[int]:
+        server = await _start_http_server(FailingService(), "127.0.0.1", 0)
+        reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+        codes = [(await _http_request(reader, writer, "POST", "/validate", _json_bytes(sel)))[0],
+                 (await _http_request(reader, writer, "GET", "/kaputt"))[0],
+                 (await _http_request(reader, writer, "GET", "/schema"))[0]]  # gleiche Verbindung nach dem Fehler
+        writer.close(); await writer.wait_closed(); await asyncio.sleep(0.01)
+        server.close(); await server.wait_closed()
+        return codes
+    from contextlib import redirect_stderr
+    with redirect_stderr(io.StringIO()) as err:
+        assert asyncio.run(roundtrip()) == [200, 500, 200]
+    assert "RuntimeError('kaputt')" in err.getvalue()
+    # Benchmark-Suite: synthetische Auswahlen sind gültig, Vergleich erkennt Regressionen
+    for auftrag in DOMAIN_META:
+        assert not validate(bench_selections(auftrag, 200)), auftrag
+    rep = {"results": {"validate|leer|A": {"ns": 100.0, "alloc_bytes": 10}}}
+    assert not compare_benchmarks(rep, rep)
+    assert compare_benchmarks(rep, {"results": {"validate|leer|A": {"ns": 200.0, "alloc_bytes": 10}}})
+    # Inkrementeller WizardState: Caches folgen Setter und direkten dict-Änderungen
+    ws = WizardState(selections=dict(full))
+    p1, lines1 = ws.compose_prompt(), ws.to_preview_lines()
+    assert ws.compose_prompt() is p1 and not ws.selections.dirty
+    ws.set("Materialien", "Papier")
+    assert "- Materialien: Papier" in ws.compose_prompt() and "Materialien: Papier" in ws.to_preview_lines()
+    ws.selections["Materialien"] = ["Stifte", "Papier"]
+    assert "- Materialien: Stifte, Papier" in ws.compose_prompt() and ws.compose_prompt() == _legacy_compose(ws.selections)
+    assert ws.set_auftrag("Teammeeting vorbereiten") and set(ws.selections) == {"Bereich", "Rolle", "Auftrag"}
+    assert ws.compose_prompt() == _legacy_compose(ws.selections) and len(ws.to_preview_lines()) == 3
+    assert ws.set_rolle("Erzieher:in") and "Auftrag" not in ws.selections and not ws.set_rolle("Erzieher:in")
+    ws.selections = {"Auftrag": "Elternbrief verfassen"}
+    assert ws.to_preview_lines() == ["Auftrag: Elternbrief verfassen"]
+    ws.reset()
+    assert ws.to_preview_lines() == [] and ws.compose_prompt() == _legacy_compose({}) == render_prompt({})
+    # kompakte Speicherung: Optionen als Index, Rohwerte bleiben erhalten, Reihenfolge bleibt
+    raw = {"Thema": ["Musik", "Sprache"], "Bereich": "Elementarpädagogik", "Rolle": "Erzieher:in",
+           "Auftrag": "Konzept Kinderaktivität", "Zielgruppe": "U3", "Rahmen": ["Mond"], "Dauer (Minuten)": 30}
+    ts = TrackedSelections(raw)
+    assert ts._data["Thema"] == bytes([4, 0]) and ts._data["Zielgruppe"] == 0 and ts._data["Rahmen"] == ["Mond"]
+    assert ts.to_dict() == raw and list(ts) == list(raw) and json.loads(json.dumps(ts.to_dict())) == raw
+    assert ts.get("Zielgruppe") is DOMAIN_INDEX.specs["Konzept Kinderaktivität"]["Zielgruppe"].options[0]
+    ts["Auftrag"] = "Konzept weiterentwickeln"
+    assert ts["Thema"] == ["Musik", "Sprache"] and ts._data["Thema"] == ["Musik", "Sprache"]
+    assert WizardState(selections=raw).compose_prompt() == render_prompt(raw)
+    # Token-Schätzung und Budget
+    assert estimate_tokens("") == 0 and estimate_tokens("Hallo Welt.") == 4
+    long_text = "Die Kinder bauen im Garten eine Murmelbahn aus Ästen. " * 2000
+    assert abs(estimate_tokens(long_text) - _count_tokens(long_text)) < _count_tokens(long_text) * 0.02
+    big = {**sel, "Restriktionen/Wünsche": long_text, "Abwesenheiten (Urlaub/Krankheit)": "Urlaub KW 42"}
+    ws = WizardState(selections=big)
+    rep = ws.token_report()
+    assert rep.total == rep.static + sum(rep.fields.values()) and rep.fields["Restriktionen/Wünsche"] > 10000
+    fit = ws.fit_budget(800)
+    assert fit.report.total <= 800 and fit.trimmed == ["Restriktionen/Wünsche"] and TRIM_MARKER in fit.prompt
+    assert "- Abwesenheiten (Urlaub/Krankheit): Urlaub KW 42" in fit.prompt and ws.compose_prompt(budget=800) == fit.prompt
+    assert ws.fit_budget(10**6).prompt == ws.compose_prompt() and not validate(big)
+    konzept = {"Bereich": "Elementarpädagogik", "Rolle": "Erzieher:in", "Auftrag": "Konzept Kinderaktivität", "Thema": ["Musik"],
+               "Zielgruppe": "U3", "Rahmen": ["Drinnen"], "Dauer (Minuten)": "90", "Materialien": long_text[:2000]}
+    fit = fit_to_budget(konzept, 50)
+    assert fit.trimmed == ["Materialien"] and "- Dauer (Minuten): 90\n" in fit.prompt
+    # Datenschutz-Scanner: ein Durchlauf, Spannen je Feld, Blockieren per validate(privacy=True)
+    priv = {**sel, "Besonderheiten": "Anna (geb. 03.05.2019) wohnt Lindenstraße 12, 12345 Berlin",
+            "Materialien": "Tel. 0171 2345678, Mail mama@example.org; Jana und Jan am 3. März"}
+    found = [(f.field, f.kind, f.text) for f in scan_selections(priv)]
+    assert found == [("Besonderheiten", "Name", "Anna"), ("Besonderheiten", "Datum", "03.05.2019"),
+                     ("Besonderheiten", "Adresse", "Lindenstraße 12"), ("Besonderheiten", "Adresse", "12345 Berlin"),
+                     ("Materialien", "Telefon", "0171 2345678"), ("Materialien", "E-Mail", "mama@example.org"),
+                     ("Materialien", "Name", "Jana"), ("Materialien", "Name", "Jan")], found
+    for f in scan_selections(priv):
+        assert priv[f.field][f.start:f.end] == f.text
+    assert not scan_selections(sel) and validate(priv) == [] and len(validate(priv, privacy=True)) == len(found)
+    assert not [t for t in (o for leaf in DOMAIN_INDEX.leaves.values() for fs in leaf for o in fs.options + (fs.key,)) if scan_text(t)]
+    assert validate_many([priv, sel], privacy=True) == [validate(priv, privacy=True), []]
+    assert not scan_text("Max. 4 Tage am Stück, Jan. bis März keine Fortbildung") and scan_text("Frei mit Max. Danach")
+    from datetime import date
+    ordinary = ("Einladung zum Sommerfest am 12.07.2026", "Sommerfest am 12. Juli", "Fördermittel 15000 Euro",
+                "Treffpunkt Marktplatz 10 Uhr", "Ausflug zum Spielplatz 2x", "Rosa Tücher", "Elternabend am 3. März")
+    assert not [t for t in ordinary if scan_text(t)], [t for t in ordinary if scan_text(t)]
+    born = f"03.05.{date.today().year - 4}"
+    assert [k for k, _, _ in scan_text(f"Einschulung, {born}; am 3. März Geburtstag; Hauptstraße 5a, 12345 Berlin")] == \
+        ["Datum", "Datum", "Adresse", "Adresse"]
+    planned = {**sel, "Planungszeitraum (KW/Monat)": "02.11.2026-27.11.2026", "Schließtage/Termine": "05.11.2026"}
+    assert not validate(planned, privacy=True)
+    assert [f.kind for f in scan_selections({**planned, "Besonderheiten": "geb. 03.05.2019"})] == ["Datum"]
+    audit = io.StringIO()
+    run_privacy_audit(io.StringIO(json.dumps(sel) + "\n" + json.dumps(priv, ensure_ascii=True) + "\n"), audit)
+    assert [json.loads(l)["line"] for l in audit.getvalue().splitlines()] == [2]
+
+    # Enumerator: Anzahl, Eindeutigkeit, Gültigkeit, Shards zerlegen den Raum lückenlos
+    plan = enumeration_plan(["Anleitung planen", "Dienstplanung erstellen"])
+    assert [leaf.count for leaf in plan] == [63 * 63, 4 * 15]
+    combos = list(enumerate_selections(plan))
+    assert [k for k, _ in combos] == list(range(63 * 63 + 60))
+    assert len({json.dumps(c, sort_keys=True) for _, c in combos}) == len(combos) and not any(validate(c) for _, c in combos)
+    assert combos[0][1]["Kompetenzziel"] == [DOMAIN_INDEX.specs["Anleitung planen"]["Kompetenzziel"].options[0]]
+    sharded = sorted(kc for i in range(3) for kc in enumerate_selections(plan, (i, 3)))
+    assert [k for k, _ in sharded] == [k for k, _ in combos] and sharded[-1][1] == combos[-1][1]
+    assert sum(leaf.count for leaf in enumeration_plan()) == 401_829
+    opt = enumeration_plan(["Konzept weiterentwickeln"])[0]
+    assert "Konzeptbaustein(e)" not in _decode(opt, 0) and opt.base["Zielbild / Outcome"] == "[Zielbild / Outcome]"
+    out = io.StringIO()
+    assert run_enumeration(plan, out, (1, 2)) == ((63 * 63 + 60) // 2, 0)
+    assert json.loads(out.getvalue().splitlines()[0])["i"] == 1 and parse_shard("2/4") == (2, 4)
+
+    # Suche: Normalisierung, Rangfolge, Tippfehler, Sprung mit Vorauswahl, vergrößerter Bereich
+    assert normalize_search("Erzieher:innen") == normalize_search("ErzieherIn") == normalize_search("Erzieher/-in") == "erzieher"
+    assert normalize_search("Mädchen") == normalize_search("Maedchen") == "madchen" and normalize_search("Straße") == "strasse"
+    assert normalize_search("3–4 Jahre") == "3 4 jahre" and normalize_search("Natur & Umwelt") == "natur umwelt"
+    assert search("erzieh") == [SearchHit("Rolle", "Erzieher:in", "Erzieher:in")]
+    assert search("Praxisanleiter*innen")[0].rolle == "Praxisanleiter:in"
+    assert search("dienstplnung")[0].auftrag == "Dienstplanung erstellen"  # Tippfehler
+    assert [h.auftrag for h in search("el", limit=3)] == ["Elternabend planen", "Elternbrief verfassen", "Elterngespräch vorbereiten"]
+    musik = search("musik")
+    assert musik == [SearchHit("Option", "Musik", "Erzieher:in", "Konzept Kinderaktivität", "Thema", "Musik")]
+    assert not search("") and not search("xqzv")
+    ws = WizardState(selections={"Bereich": "Elementarpädagogik", "Rolle": "Kita-Leitung", "Auftrag": "Dienstplanung erstellen"})
+    assert ws.jump_to(musik[0]) and ws.selections["Thema"] == ["Musik"] and not ws.jump_to(musik[0])
+    hit = next(h for h in search("Förderempfehlung") if h.kind == "Option")
+    assert ws.jump_to(hit) and ws.selections.to_dict() == {"Bereich": "Elementarpädagogik", "Rolle": "Erzieher:in",
+                                                          "Auftrag": "Elterngespräch vorbereiten", "Anlass": "Förderempfehlung"}
+    big_index = SearchIndex(scaled_domain_index(20))
+    assert len(big_index) == 20 * len(search_index()) and len(big_index.search("musik", 50)) == 20
+    assert big_index.search("elternbrief verfassen 7")[0].auftrag == "Elternbrief verfassen 7"
+
+    # Dienstplan: Zeitraum/Regeln parsen, gierig + Reparatur, alle Sperren eingehalten, Entwurf im Prompt
+    from datetime import date
+    assert len(parse_period("KW 45-48 2026")) == 20 and parse_period("November 2026")[0] == date(2026, 11, 2)
+    assert parse_period("02.11.2026-06.11.2026") == parse_period("KW 45 2026") == parse_period("11/2026")[:5]
+    rsel = {**sel, "Planungszeitraum (KW/Monat)": "KW 45 2026", "Schichtmodell": ["Früh", "Spät"],
+            "Mindestbesetzung je Zeitslot": "Früh 2, Spät 1; Fr Spät 2", "Schließtage/Termine": "Laternenfest 05.11.",
+            "Abwesenheiten (Urlaub/Krankheit)": "MA1 03.11.-04.11., 06.11.", "Restriktionen/Wünsche": "Team 4; MA2 nur Früh; MA3 frei Mo; MA4 26h"}
+    model = roster_model(rsel)
+    assert model.staff == 4 and len(model.days) == 4 and model.demand == (2, 1, 2, 1, 2, 1, 2, 2) and model.cap[3] == 26 * 60
+    draft = solve_roster(model)
+    assert [(d, n) for d, _, n in draft.shortfalls] == [(3, 1)]  # Fr: vier Slots, nur drei Personen verfügbar
+    for inst in (model, roster_model(roster_instance(0))):
+        d = draft if inst is model else solve_roster(inst)
+        S = len(inst.shifts)
+        assert all(d.cover[i] & ~inst.avail[i] == 0 for i in range(len(inst.demand)))
+        for p_, row in enumerate(d.shift_of):
+            assert all(d.cover[i * S + s] >> p_ & 1 for i, s in enumerate(row) if s >= 0)
+            for w in set(inst.week_of):
+                week = [s for i, s in enumerate(row) if inst.week_of[i] == w and s >= 0]
+                assert sum(inst.minutes[s] for s in week) <= inst.cap[p_] and len(week) <= inst.max_days[p_]
+    assert not d.shortfalls and d.seconds < 1.0
+    text = render_roster(draft)
+    assert "Do 05.11.:" not in text and "Fr 06.11.: Früh" in text and "Fr 06.11. " in text.split("Unterdeckung")[1]
+    embedded = embed_roster(render_prompt(rsel), text)
+    assert embedded.startswith(render_prompt(rsel).split("\n\nAufgabe:")[0] + "\n\n" + text)
+    assert embedded.endswith(render_prompt(rsel)[render_prompt(rsel).index("\n\nAufgabe:"):])
+    nsel = roster_instance(0)  # November, ~1450 Tokens Entwurf
+    ntext = render_roster(roster_draft(nsel))
+    nfit, kept = fit_roster_budget(WizardState(selections=dict(nsel)), ntext, 600)
+    assert not kept and "Dienstplan-Entwurf" not in nfit.prompt and nfit.report.total <= 600
+    need = estimate_tokens(embed_roster("", ntext))
+    nfit, kept = fit_roster_budget(WizardState(selections=dict(nsel)), ntext, need + 600)
+    assert kept and nfit.trimmed and ntext in nfit.prompt and estimate_tokens(nfit.prompt) <= need + 600 + 2
+    for bad in ({"Planungszeitraum (KW/Monat)": "irgendwann"}, {"Restriktionen/Wünsche": "Team 4; MA9 20h"}):
+        try:
+            roster_model({**rsel, **bad}); raise AssertionError(bad)
+        except ValueError:
+            pass
+    assert roster_draft({"Auftrag": "Elternbrief verfassen"}) is None
+    assert model.unparsed == ()
+    vague = roster_model({**rsel, "Abwesenheiten (Urlaub/Krankheit)": "Anna Urlaub 2.11.-6.11.; MA1 03.11., Ben 05.11.",
+                          "Restriktionen/Wünsche": "Team 4; Anna nur Früh; MA3 mag Kuchen; alle max 4 Tage",
+                          "Mindestbesetzung je Zeitslot": "Früh 2, Spät viele"})
+    assert vague.unparsed == ("Spät viele", "Anna nur Früh", "MA3 mag Kuchen", "Anna Urlaub 2.11.-6.11.", "Ben 05.11.")
+    assert vague.max_days == (4, 4, 4, 4) and vague.avail == (15, 15, 14, 14, 15, 15, 15, 15)  # nur MA1 fehlt am Di
+    wrap = parse_period("KW 52-2 2026")
+    assert (wrap[0], wrap[-1], len(wrap)) == (date(2026, 12, 21), date(2027, 1, 15), 20)  # 2026 hat 53 KW
+    assert parse_period("28.12.-8.1.2027")[0] == date(2026, 12, 28)
+    ymodel = roster_model({**rsel, "Planungszeitraum (KW/Monat)": "KW 53-1 2026", "Schließtage/Termine": "31.12., 1.1.",
+                           "Abwesenheiten (Urlaub/Krankheit)": "MA1 30.12.-4.1."})
+    assert ymodel.closed == (date(2026, 12, 31), date(2027, 1, 1)) and len(ymodel.days) == 8
+    assert all(not ymodel.avail[ymodel.days.index(d) * 2] & 1 for d in (date(2026, 12, 30), date(2027, 1, 4)))
+
+    # Template-Packs: lazy, Binär-Cache nach mtime, Hot-Reload, eingebauter Bereich als Pack exportierbar
+    import tempfile
+    global PACKS
+    saved_packs = PACKS
+    with tempfile.TemporaryDirectory() as tmp:
+        hort = {"Rolle": {"Hortner:in": {"Auftrag": {"Hausaufgabenzeit planen": {
+                    "Klassenstufe": ["1", "2", "3", "4"], "Fächer": ["Deutsch", "Mathe"], "Besonderheiten": "freitext"}}}},
+                "meta": {"Hausaufgabenzeit planen": {"required": ["Klassenstufe"], "multi": ["Fächer"], "numeric": {}}}}
+        with open(os.path.join(tmp, "Hort.json"), "w", encoding="utf-8") as f: json.dump(hort, f)
+        with open(os.path.join(tmp, "Elementar.json"), "w", encoding="utf-8") as f:
+            json.dump(BUILTIN_PACK.to_data(), f, ensure_ascii=False)
+        with open(os.path.join(tmp, "Jugendhilfe.toml"), "w", encoding="utf-8") as f:
+            f.write('[Rolle."Sozialarbeiter:in".Auftrag."Hilfeplan vorbereiten"]\nAnlass = ["Erstgespräch", "Fortschreibung"]\n'
+                    '[meta."Hilfeplan vorbereiten"]\nrequired = ["Anlass"]\nmulti = []\n')
+        reg = PackRegistry(tmp, check_interval=0)
+        assert reg.bereiche() == ["Elementar", "Hort", "Jugendhilfe"] and reg.parsed == 0  # noch nichts geparst
+        PACKS = reg
+        try:
+            hsel = {"Bereich": "Hort", "Rolle": "Hortner:in", "Auftrag": "Hausaufgabenzeit planen", "Fächer": ["Mathe"]}
+            assert validate(hsel) == ["Pflichtfeld fehlt: Klassenstufe"] and reg.parsed == 1
+            hsel["Klassenstufe"] = "3"
+            assert not validate(hsel) and "- Fächer: Mathe\n" in render_prompt(hsel) and "Aufgabe:" in render_prompt(hsel)
+            assert "- Besonderheiten:" not in render_prompt(hsel, compact=True)
+            ws = WizardState(selections=dict(hsel))
+            assert ws.selections._data["Klassenstufe"] == 2 and ws.compose_prompt() == render_prompt(hsel)
+            assert ws.set_bereich("Jugendhilfe") and dict(ws.selections) == {"Bereich": "Jugendhilfe"}
+            assert validate({"Bereich": "Jugendhilfe", "Rolle": "Sozialarbeiter:in", "Auftrag": "Hilfeplan vorbereiten"}) == ["Pflichtfeld fehlt: Anlass"]
+            esel = {**full, "Bereich": "Elementar"}
+            assert render_prompt(esel) == render_prompt(full).replace("Bereich: Elementarpädagogik", "Bereich: Elementar")
+            assert validate(esel) == validate(full) and reg.parsed == 3
+            assert search("hausaufg", "Hort")[0].auftrag == "Hausaufgabenzeit planen" and not search("hausaufg")
+            hort_schema = json.loads(ComposeService().handle("GET", "/schema?bereich=Hort", b"")[1])
+            assert "Hausaufgabenzeit planen" in hort_schema["tree"]["Bereich"]["Hort"]["Rolle"]["Hortner:in"]["Auftrag"]
+            assert hort_schema["meta"]["Hausaufgabenzeit planen"]["required"] == ["Klassenstufe"] and "Hort" in hort_schema["bereiche"]
+            assert ComposeService().handle("GET", "/schema?bereich=Elementarp%C3%A4dagogik", b"")[0] == 200
+            assert ComposeService().handle("GET", "/schema?bereich=Nirgendwo", b"")[0] == 404
+            warm = PackRegistry(tmp)
+            assert warm.get("Hort") is not None and warm.parsed == 0 and warm.cache_hits == 1
+            svc = ComposeService()
+            before = json.loads(svc.handle("POST", "/compose", _json_bytes(hsel))[1])["prompt"]
+            hort["Rolle"]["Hortner:in"]["Auftrag"]["Hausaufgabenzeit planen"]["Klassenstufe"].append("5")
+            hort["aufgabe"] = "Aufgabe: Hausaufgabenzeit neu planen."
+            with open(os.path.join(tmp, "Hort.json"), "w", encoding="utf-8") as f: json.dump(hort, f)
+            os.utime(os.path.join(tmp, "Hort.json"), ns=(time.time_ns() + 10**9,) * 2)
+            assert reg.get("Hort").index.specs["Hausaufgabenzeit planen"]["Klassenstufe"].options[-1] == "5"
+            after = json.loads(svc.handle("POST", "/compose", _json_bytes(hsel))[1])["prompt"]
+            assert after != before and after.endswith("neu planen.")  # kein veralteter Cache-Treffer
+            with open(os.path.join(tmp, "Hort.json"), "w", encoding="utf-8") as f: f.write("{kaputt")
+            os.utime(os.path.join(tmp, "Hort.json"), ns=(time.time_ns() + 2 * 10**9,) * 2)
+            assert reg.get("Hort").index.specs["Hausaufgabenzeit planen"]["Klassenstufe"].options[-1] == "5" and "Hort" in reg.errors
+            assert len([n for n in os.listdir(reg.cache_dir) if n.startswith("Hort-")]) == 1
+        finally:
+            PACKS = saved_packs
+    assert pack_for("Hort") is BUILTIN_PACK or PACKS is not None
+
+    # Instrumentierung: abgeschaltet keine Umhüllung, Histogramm + Log + Bericht
+    assert METRICS is not None or (phase("x") is _NULL_PHASE and not hasattr(validate, "__wrapped_phase__")
+                                   and start_metrics_server() is None)
+    with tempfile.TemporaryDirectory() as tmp:
+        pm = PhaseMetrics(os.path.join(tmp, "m.jsonl"), flush_every=4)
+        timed_validate = _timed(pm, "validate", validate)
+        assert timed_validate(sel) == validate(sel)
+        for ms in (0.2, 3.0, 40.0): pm.observe("compose_prompt", ms / 1000)
+        with pm.time("details_render"): pass
+        pm.flush()
+        with open(pm.log_path) as f:  # type: ignore[arg-type]
+            rep = metrics_report(f)
+        assert set(rep) == {"validate", "compose_prompt", "details_render"} and rep["compose_prompt"]["p50"] == 3.0
+        server = pm.serve(port=0)
+        try:
+            from urllib.request import urlopen
+            with urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics") as r:
+                text = r.read().decode()
+        finally:
+            server.shutdown(); server.server_close()
+        assert 'prompt_builder_phase_seconds_bucket{phase="compose_prompt",le="0.005"} 2' in text
+        assert 'prompt_builder_phase_seconds_count{phase="compose_prompt"} 3' in text
+
+    # Ähnliche Einträge: inkrementell, je Geltungsbereich/Bereich/Auftrag/Feld, persistent; mit und ohne NumPy
+    base_texts = ["Kind zieht sich im Morgenkreis zurück und beobachtet die Gruppe",
+                  "Konflikt in der Bauecke um Material, zwei Kinder streiten laut",
+                  "Beim Mittagessen probiert das Kind erstmals neue Speisen aus"]
+    g = ("user:a@kita.example", BUILTIN_PACK.bereich, "Elternabend planen", "Materialien")
+    for use_np in ((False, True) if _numpy() is not None else (False,)):
+        with tempfile.TemporaryDirectory() as tmp:
+            si = SimilarityIndex(tmp, use_numpy=use_np)
+            assert si.add_many((g, t) for t in base_texts + base_texts[:1]) == 3
+            assert not si.add(g, "zu kurz")
+            hits = si.similar(g, "Konflikt in der Bauecke um das Material")
+            assert hits and hits[0].text == base_texts[1] and hits[0].score >= SIMILAR_MIN_SCORE
+            assert si.similar(g, "  " + base_texts[0].upper()) == []  # eigener Text
+            assert si.similar(("user:b@kita.example",) + g[1:], base_texts[1]) == []
+            assert si.similar(g[:2] + ("Elterngespräch vorbereiten", g[3]), base_texts[1]) == []
+            assert si.add(g, "Streit in der Bauecke um Material und Bausteine")
+            assert len(si.similar(g, "Konflikt Bauecke Material Streit", k=5)) == 2
+            reopened = SimilarityIndex(tmp, use_numpy=use_np)
+            assert len(reopened) == 4 and reopened.similar(g, "Konflikt in der Bauecke")[0].text == base_texts[1]
+            if use_np:  # Vektordatei länger bzw. kürzer als entries.jsonl wird angeglichen
+                vec = next(os.path.join(tmp, n) for n in os.listdir(tmp) if n.endswith(".f32"))
+                with open(vec, "ab") as f: f.write(b"\0" * SIMILAR_DIM * 8)
+                assert len(SimilarityIndex(tmp)._group(g)) == 4
+                os.truncate(vec, SIMILAR_DIM * 4)
+                assert SimilarityIndex(tmp).similar(g, "Beim Mittagessen neue Speisen")[0].text == base_texts[2]
+    si = SimilarityIndex()
+    scope = similar_scope("a@kita.example")
+    eltern = {**sel, "Auftrag": "Elternabend planen", "Dauer (Minuten)": "90 Minuten lang",
+              "Ziel des Gesprächs": "Eltern über Sprachförderung im Alltag informieren",
+              "Materialien": "Rückfragen an mama.muster@example.org"}
+    assert similar_scope(None) is None and archive_selections(si, None, eltern) == 0
+    assert archive_selections(si, scope, eltern) == 1
+    assert list(si._texts) == [(scope, BUILTIN_PACK.bereich, "Elternabend planen", "Ziel des Gesprächs")]
+    beob = {"Bereich": BUILTIN_PACK.bereich, "Auftrag": "Dokumentation Beobachtung",
+            "Situation": "Kind zieht sich im Morgenkreis zurück", "Interpretation": "Kind braucht mehr Sicherheit"}
+    assert archive_selections(si, scope, beob) == 0  # sensible Felder nie
+    saved_scope = os.environ.get(SIMILAR_SCOPE_ENV)
+    os.environ[SIMILAR_SCOPE_ENV] = "org"
+    try:
+        assert similar_scope("a@Kita.example") == similar_scope("b@kita.example") == "org:kita.example"
+    finally:
+        if saved_scope is None: os.environ.pop(SIMILAR_SCOPE_ENV, None)
+        else: os.environ[SIMILAR_SCOPE_ENV] = saved_scope
+
+    # LLM-Versand gegen den lokalen Stub: Streaming, Keep-Alive, Cache, Bündelung gleicher Prompts
+    import threading
+    stub = LLMStub(delay=0.005)
+    url, stop_stub = start_llm_stub(stub)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            client = LLMClient(url, cache=ResponseCache(tmp, max_bytes=400))
+            prompt = render_prompt(sel)
+            chunks = list(client.stream(prompt))
+            assert len(chunks) > 2 and "".join(chunks) == "".join(stub.reply(prompt)) and stub.calls == 1
+            assert client.complete(prompt + "  \n\n\n") == "".join(chunks) and stub.calls == 1 and client.hits == 1
+            results: List[str] = []
+            workers = [threading.Thread(target=lambda: results.append(client.complete("Gleicher Prompt"))) for _ in range(4)]
+            for w in workers: w.start()
+            for w in workers: w.join()
+            assert len(set(results)) == 1 and stub.calls == 2 and client.coalesced == 3
+            assert client.pool.opened == 1  # Keep-Alive: eine Verbindung für alle Upstream-Aufrufe
+            for i in range(20): client.complete(f"Prompt {i}")
+            assert client.cache is not None and client.cache._size <= 400 and len(client.cache) < 22
+            assert ResponseCache(tmp).get(client.cache_key("Prompt 19")) == "".join(stub.reply("Prompt 19"))
+            client.close()
+    finally:
+        stop_stub()
+    # send: fehlende Datei, kaputtes bzw. falsches JSON und toter Upstream enden als „Fehler: …“ mit Code 2
+    from types import SimpleNamespace
+    saved_llm = {k: os.environ.get(k) for k in (LLM_URL_ENV, LLM_CACHE_ENV)}
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.update({LLM_URL_ENV: url, LLM_CACHE_ENV: tmp})  # Stub ist beendet
+        try:
+            for name, body, as_sel in (("fehlt.json", None, True), ("kaputt.json", "{", True),
+                                       ("liste.json", "[1]", True), ("prompt.txt", "Hallo", False)):
+                path = os.path.join(tmp, name)
+                if body is not None:
+                    with open(path, "w", encoding="utf-8") as f: f.write(body)
+                with redirect_stderr(io.StringIO()) as err:
+                    assert _cli_send(SimpleNamespace(input=path, selections=as_sel)) == 2, name
+                assert err.getvalue().lstrip().startswith("Fehler: "), name
+        finally:
+            for k, v in saved_llm.items():
+                if v is None: os.environ.pop(k, None)
+                else: os.environ[k] = v
+
+    # Entwurfsspeicher: Kodierung, Entprellung, Fortsetzen
+    assert decode_draft(encode_draft(big)) == big and len(encode_draft(big)) < len(json.dumps(big)) // 10
+    with tempfile.TemporaryDirectory() as tmp:
+        drafts = DraftStore(os.path.join(tmp, "d.sqlite3"), debounce=60)
+        for i in range(50): drafts.autosave("u", "d1", {**sel, "Restriktionen/Wünsche": "x" * i})
+        assert drafts.load("u", "d1")["Restriktionen/Wünsche"] == "x" * 49 and drafts.rows_written == 0
+        assert drafts.flush() == 1 and drafts.transactions == 1
+        drafts.autosave("u", "d2", {"Auftrag": "Elternbrief verfassen"})
+        drafts.close()
+        drafts = DraftStore(os.path.join(tmp, "d.sqlite3"))
+        assert drafts.load("u", "d1")["Restriktionen/Wünsche"] == "x" * 49 and drafts.load("u", "nix") is None
+        assert {d for d, _ in drafts.list_drafts("u")} == {"d1", "d2"}
+        import io, zipfile
+        buf = io.BytesIO()
+        assert write_export_bundle(((d, None, s) for d, s in drafts.iter_drafts("u")), buf, ("txt", "md")) == 2
+        with zipfile.ZipFile(io.BytesIO(buf.getvalue())) as zf:
+            assert sorted(zf.namelist()) == ["d1.md", "d1.txt", "d2.md", "d2.txt"]
+            assert zf.read("d1.txt").decode("utf-8") == render_prompt(drafts.load("u", "d1"))
+        lines = [json.dumps({"line": 1, "ok": True, "prompt": "P"}), "{kaputt", "[1, 2]", json.dumps(sel), json.dumps({"line": "x", "ok": True})]
+        assert [(n, p) for n, p, _ in iter_jsonl_prompts(io.StringIO("\n".join(lines)))] == [("prompt_000001", "P"), ("prompt_000004", None)]
+        drafts.delete("u", "d2")
+        assert drafts.load("u", "d2") is None
+        drafts.close()
+    from types import SimpleNamespace as NS
+    assert session_identity(NS(user=NS(is_logged_in=True, email="a@kita.example"))) == "a@kita.example"
+    proxied = NS(user=NS(is_logged_in=False), context=NS(headers={"X-Forwarded-User": "b"}))
+    assert session_identity(proxied) is None or os.environ.get(USER_HEADER_ENV)  # Header nur, wenn konfiguriert
+    saved_header = os.environ.get(USER_HEADER_ENV)
+    os.environ[USER_HEADER_ENV] = "X-Forwarded-User"
+    try:
+        assert session_identity(proxied) == "b" and session_identity(NS()) is None
+    finally:
+        if saved_header is None: os.environ.pop(USER_HEADER_ENV, None)
+        else: os.environ[USER_HEADER_ENV] = saved_header
     print("Tests ok."); return 0
 
+def run_compose_benchmark(repeat: int = 200) -> int:
+    auftrag = "Konzept weiterentwickeln"
+    free = [f.key for f in DOMAIN_INDEX.leaf("Kita-Leitung", auftrag) if f.freitext]
+    print(f"{'Freitext/Feld':>14} {'str.replace':>14} {'kompiliert':>14} {'Faktor':>8}")
+    for size in (0, 1_000, 100_000, 1_000_000):
+        sel = {"Bereich":"Elementarpädagogik","Rolle":"Kita-Leitung","Auftrag":auftrag,
+               "Thema":["Partizipation","Inklusion"], **{k: ("x" * size) for k in free}}
+        assert render_prompt(sel) == _legacy_compose(sel)
+        n = max(3, repeat if size < 100_000 else repeat // 20)
+        t0 = time.perf_counter()
+        for _ in range(n): _legacy_compose(sel)
+        t1 = time.perf_counter()
+        for _ in range(n): render_prompt(sel)
+        t2 = time.perf_counter()
+        old, new = (t1 - t0) / n, (t2 - t1) / n
+        print(f"{size:>14,} {old*1e6:>12.1f}µs {new*1e6:>12.1f}µs {old/new:>7.1f}×")
+    return 0
+
+# -------------------- Benchmark suite --------------------
+# Synthetische Auswahlen für jeden Auftrag in drei Freitextgrößen; Zeiten (Minimum über
+# Wiederholungen nach Warmup) und Spitzenallokation pro Aufruf (tracemalloc) landen in
+# einer JSON-Baseline, gegen die `bench compare` auf Regressionen prüft.
+BENCH_SIZES = {"leer": 0, "typisch": 200, "100k": 100_000}
+BENCH_BASELINE = "bench_baseline.json"
+
+def bench_selections(auftrag: str, size: int) -> Dict[str, Any]:
+    rolle = next(r for r, auftraege in DOMAIN_INDEX.auftraege.items() if auftrag in auftraege)
+    sel: Dict[str, Any] = {"Bereich": DOMAIN_INDEX.bereich, "Rolle": rolle, "Auftrag": auftrag}
+    if not size:
+        return sel
+    text = ("Beobachtung im Morgenkreis, Kleingruppe am Maltisch; " * (size // 50 + 1))[:size]
+    for spec in DOMAIN_INDEX.leaf(rolle, auftrag):
+        if spec.options:
+            sel[spec.key] = list(spec.options[:2]) if spec.multi else spec.options[0]
+        elif spec.numeric is not None:
+            sel[spec.key] = "30"
+        else:
+            sel[spec.key] = text
+    return sel
+
+def _bench_hot_paths(sel: Dict[str, Any]) -> Dict[str, Any]:
+    ws = WizardState(selections=sel)
+    free = next((k for k, v in sel.items() if isinstance(v, str) and k not in _CORE_KEYS), None)
+    edits = [sel.get(free, "") + "a", sel.get(free, "") + "b"]
+    toggle = [0]
+    def edit_and_compose() -> str:
+        # ein Tastendruck in einem Freitextfeld, danach Prompt und Vorschau neu
+        toggle[0] ^= 1
+        if free: ws.set(free, edits[toggle[0]])
+        ws.to_preview_lines()
+        return ws.compose_prompt()
+    return {
+        "compose_prompt": lambda: render_prompt(sel),
+        "validate": lambda: validate(sel),
+        "progress_ratio": lambda: progress_ratio(sel),
+        "to_preview_lines": lambda: WizardState(selections=sel).to_preview_lines(),
+        "edit_recompose": edit_and_compose,
+    }
+
+def _time_call(fn: Any, repeat: int, sample_ns: float = 5e6) -> float:
+    # Minimum der Wiederholungen (wie timeit): am wenigsten von Störungen durch andere Prozesse beeinflusst
+    for _ in range(3): fn()
+    t0 = time.perf_counter_ns(); fn()
+    number = max(1, int(sample_ns / max(1, time.perf_counter_ns() - t0)))
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter_ns()
+        for _ in range(number): fn()
+        samples.append((time.perf_counter_ns() - t0) / number)
+    return min(samples)
+
+def _alloc_per_call(fn: Any) -> int:
+    import tracemalloc
+    tracemalloc.start()
+    try:
+        fn()
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn()
+        return max(0, tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+
+def run_benchmarks(repeat: int = 5) -> Dict[str, Any]:
+    import platform
+    results: Dict[str, Dict[str, float]] = {}
+    for auftrag in DOMAIN_META:
+        for size_name, size in BENCH_SIZES.items():
+            for name, fn in _bench_hot_paths(bench_selections(auftrag, size)).items():
+                results[f"{name}|{size_name}|{auftrag}"] = {"ns": _time_call(fn, repeat), "alloc_bytes": _alloc_per_call(fn)}
+    return {"python": platform.python_version(), "platform": platform.platform(),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}
+
+def bench_summary(report: Dict[str, Any]) -> Dict[str, Dict[str, float]]:
+    # Hot Path = Funktion × Größe, summiert über alle Aufträge (robuster als Einzelwerte)
+    out: Dict[str, Dict[str, float]] = {}
+    for key, r in report["results"].items():
+        name, size_name, _ = key.split("|", 2)
+        agg = out.setdefault(f"{name}|{size_name}", {"ns": 0.0, "alloc_bytes": 0.0, "n": 0})
+        agg["ns"] += r["ns"]; agg["alloc_bytes"] += r["alloc_bytes"]; agg["n"] += 1
+    return out
+
+def compare_benchmarks(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float = 0.25) -> List[str]:
+    base, cur = bench_summary(baseline), bench_summary(current)
+    regressions = []
+    for key, c in cur.items():
+        b = base.get(key)
+        if not b: continue
+        for metric in ("ns", "alloc_bytes"):
+            if b[metric] and c[metric] > b[metric] * (1 + threshold):
+                regressions.append(f"{key} {metric}: {b[metric]:,.0f} -> {c[metric]:,.0f} (+{c[metric]/b[metric]-1:.0%})")
+    return regressions
+
+def _print_bench_summary(report: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None) -> None:
+    base = bench_summary(baseline) if baseline else {}
+    print(f"{'Hot Path':<28} {'µs/Aufruf (Ø)':>14} {'KiB/Aufruf (Ø)':>15} {'vs. Baseline':>13}")
+    for key, r in bench_summary(report).items():
+        b = base.get(key)
+        delta = f"{r['ns']/b['ns']-1:+.0%}" if b and b["ns"] else ""
+        print(f"{key:<28} {r['ns']/r['n']/1000:>14.2f} {r['alloc_bytes']/r['n']/1024:>15.1f} {delta:>13}")
+
+def _cli_bench(args: argparse.Namespace) -> int:
+    report = run_benchmarks(args.repeat)
+    if args.action == "run":
+        with open(args.baseline, "w", encoding="utf-8") as fh:
+            json.dump(report, fh, ensure_ascii=False, indent=1)
+        _print_bench_summary(report)
+        print(f"Baseline geschrieben: {args.baseline}", file=sys.stderr)
+        return 0
+    with open(args.baseline, encoding="utf-8") as fh:
+        baseline = json.load(fh)
+    regressions = compare_benchmarks(baseline, report, args.threshold)
+    for _ in range(args.confirm):
+        # vor dem Fehlschlag nachmessen und je Fall das Minimum behalten (Rauschen auf geteilten Maschinen)
+        if not regressions: break
+        for key, r in run_benchmarks(args.repeat)["results"].items():
+            cur = report["results"].get(key)
+            if cur is not None:
+                cur["ns"] = min(cur["ns"], r["ns"]); cur["alloc_bytes"] = min(cur["alloc_bytes"], r["alloc_bytes"])
+        regressions = compare_benchmarks(baseline, report, args.threshold)
+    _print_bench_summary(report, baseline)
+    for line in regressions:
+        print(f"REGRESSION {line}", file=sys.stderr)
+    return 1 if regressions else 0
+
+# -------------------- Session memory --------------------
+# Simuliert viele offene Sitzungen und misst den residenten Speicher (RSS) je Darstellung:
+# "legacy" = bisheriger dict mit Listen und kopierten Optionsstrings, "compact" = WizardState.
+def _rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _simulated_session(i: int, rng: Any) -> Dict[str, Any]:
+    auftrag = rng.choice(list(DOMAIN_META))
+    sel = bench_selections(auftrag, 0)
+    for spec in DOMAIN_INDEX.specs[auftrag].values():
+        if spec.options:
+            sel[spec.key] = rng.sample(spec.options, rng.randint(1, min(3, len(spec.options)))) if spec.multi else rng.choice(spec.options)
+        elif spec.numeric is not None:
+            sel[spec.key] = str(rng.randint(15, 90))
+        elif rng.random() < 0.5:
+            sel[spec.key] = f"Sitzung {i}: " + "kurze Notiz zur Gruppe " * rng.randint(2, 8)
+    # Browser/JSON liefert eigene String-Objekte je Sitzung
+    return json.loads(json.dumps(sel))
+
+def measure_sessions(mode: str, sessions: int = 1000, seed: int = 1) -> Dict[str, float]:
+    import gc, random
+    rng = random.Random(seed)
+    raw = [_simulated_session(i, rng) for i in range(sessions)]
+    payload = [json.dumps(r) for r in raw]
+    del raw
+    import tracemalloc
+    gc.collect()
+    tracemalloc.start()
+    before, traced_before = _rss_bytes(), tracemalloc.get_traced_memory()[0]
+    if mode == "legacy":
+        from types import SimpleNamespace
+        store: List[Any] = [SimpleNamespace(selections=json.loads(p)) for p in payload]
+    else:
+        store = [WizardState(selections=json.loads(p)) for p in payload]
+    gc.collect()
+    after, traced_after = _rss_bytes(), tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return {"mode": mode, "sessions": sessions, "rss_before": before, "rss_after": after,
+            "per_session": (after - before) / sessions, "traced_per_session": (traced_after - traced_before) / sessions,
+            "alive": len(store)}
+
+def _cli_memsim(args: argparse.Namespace) -> int:
+    import subprocess
+    if args.mode:
+        print(json.dumps(measure_sessions(args.mode, args.sessions)))
+        return 0
+    # jede Darstellung in einem eigenen Prozess, damit freigegebener Speicher nicht mitzählt
+    res = {}
+    for mode in ("legacy", "compact"):
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), "memsim", "--mode", mode,
+                              "--sessions", str(args.sessions)], capture_output=True, text=True, check=True).stdout
+        res[mode] = json.loads(out)
+    for mode, r in res.items():
+        print(f"{mode:>8}: RSS {r['rss_before']/2**20:7.1f} -> {r['rss_after']/2**20:7.1f} MiB "
+              f"({r['per_session']:,.0f} Bytes/Sitzung RSS, {r['traced_per_session']:,.0f} Bytes/Sitzung Python-Objekte, "
+              f"{r['sessions']} Sitzungen)")
+    legacy, compact = res["legacy"]["traced_per_session"], res["compact"]["traced_per_session"]
+    if legacy > 0:
+        print(f"Ersparnis (Python-Objekte): {1 - compact / legacy:.0%}")
+    return 0
+
 def _run_cli() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument("--test", action="store_true")
+    parser.add_argument("--bench", action="store_true", help="compose_prompt: str.replace vs. kompiliertes Template")
+    sub = parser.add_subparsers(dest="command")
+    p_batch = sub.add_parser("batch", help="JSONL-Auswahlen headless validieren und Prompts erzeugen")
+    p_batch.add_argument("input", nargs="?", default="-", help="JSONL-Datei (Standard: stdin)")
+    p_batch.add_argument("-o", "--output", default="-", help="JSONL-Ausgabe (Standard: stdout)")
+    p_batch.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1)
+    p_batch.add_argument("--chunk-size", type=int, default=256)
+    p_batch.add_argument("--compact", action="store_true", help="leere Kontextzeilen weglassen")
+    p_batch.add_argument("--privacy", action="store_true", help="Datenschutz-Funde blockieren die Erzeugung")
+    p_audit = sub.add_parser("privacy-audit", help="JSONL-Archiv auf personenbezogene Angaben prüfen")
+    p_audit.add_argument("input", nargs="?", default="-", help="JSONL-Datei (Standard: stdin)")
+    p_audit.add_argument("-o", "--output", default="-", help="JSONL mit Funden (Standard: stdout)")
+    p_audit.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1)
+    p_audit.add_argument("--chunk-size", type=int, default=2048)
+    p_serve = sub.add_parser("serve", help="lokaler HTTP-Service (POST /validate, POST /compose, GET /schema)")
+    p_serve.add_argument("--host", default="127.0.0.1")
+    p_serve.add_argument("--port", type=int, default=8765)
+    p_serve.add_argument("--cache-size", type=int, default=4096)
+    p_load = sub.add_parser("loadtest", help="Lasttest gegen den lokalen HTTP-Service")
+    p_load.add_argument("--host", default="127.0.0.1")
+    p_load.add_argument("--port", type=int, default=8765)
+    p_load.add_argument("--endpoint", default="/compose", choices=["/compose", "/validate"])
+    p_load.add_argument("-c", "--connections", type=int, default=32)
+    p_load.add_argument("-n", "--requests", type=int, default=20000)
+    p_load.add_argument("--unique", type=float, default=0.1, help="Anteil nicht cachebarer Anfragen (0–1)")
+    p_load.add_argument("--spawn", action="store_true", help="Service für den Lasttest selbst starten")
+    p_bench = sub.add_parser("bench", help="Benchmark-Suite für compose_prompt/validate/progress_ratio/to_preview_lines")
+    p_bench.add_argument("action", choices=["run", "compare"], help="run: Baseline schreiben, compare: gegen Baseline prüfen")
+    p_bench.add_argument("--baseline", default=BENCH_BASELINE)
+    p_bench.add_argument("--repeat", type=int, default=5)
+    p_bench.add_argument("--threshold", type=float, default=0.25, help="erlaubte Verschlechterung (0.25 = +25 %%)")
+    p_bench.add_argument("--confirm", type=int, default=2, help="Nachmessungen, bevor compare fehlschlägt")
+    p_mem = sub.add_parser("memsim", help="Speicherbedarf vieler Sitzungen messen (alt vs. kompakt)")
+    p_mem.add_argument("--sessions", type=int, default=1000)
+    p_mem.add_argument("--mode", choices=["legacy", "compact"], help=argparse.SUPPRESS)
+    p_export = sub.add_parser("export-bundle", help="viele Prompts als ZIP exportieren (gestreamt)")
+    p_export.add_argument("input", nargs="?", default="-", help="JSONL: Batch-Ausgabe oder Auswahlen (Standard: stdin)")
+    p_export.add_argument("-o", "--output", default="-", help="ZIP-Datei (Standard: stdout)")
+    p_export.add_argument("--drafts", help="stattdessen gespeicherte Entwürfe aus dieser Datenbank")
+    p_export.add_argument("--user", default="anonym")
+    p_export.add_argument("--formats", default="txt,json", help="Komma-Liste aus " + ",".join(EXPORT_FORMATS))
+    p_export.add_argument("--compact", action="store_true")
+    p_enum = sub.add_parser("enumerate", help="alle gültigen Options-Kombinationen als Prompts (JSONL, gestreamt)")
+    p_enum.add_argument("-o", "--output", default="-", help="Ausgabe; .gz/.xz/.bz2 wird komprimiert (Standard: stdout)")
+    p_enum.add_argument("--shard", default="0/1", help="i/n: nur Kombinationen mit Index ≡ i (mod n)")
+    p_enum.add_argument("--bereich", help="Bereich bzw. Template-Pack (Standard: eingebaut)")
+    p_enum.add_argument("--auftrag", action="append", default=[], help="nur diese Aufträge (mehrfach möglich)")
+    p_enum.add_argument("--fill", action="append", default=[], metavar="FELD=TEXT", help="Wert für Freitextfelder")
+    p_enum.add_argument("--compact", action="store_true")
+    p_enum.add_argument("--count", action="store_true", help="nur Anzahl je Auftrag ausgeben")
+    p_search = sub.add_parser("search", help="Rollen, Aufträge, Felder und Optionen durchsuchen")
+    p_search.add_argument("query", nargs="*")
+    p_search.add_argument("--bereich", help="Bereich bzw. Template-Pack (Standard: eingebaut)")
+    p_search.add_argument("-n", "--limit", type=int, default=8)
+    p_search.add_argument("--scale", type=int, default=0, metavar="FAKTOR",
+                          help="Latenz messen, Bereich FAKTOR-fach vergrößert (1 = wie er ist)")
+    p_search.add_argument("--repeat", type=int, default=500)
+    p_roster = sub.add_parser("roster", help=f"Dienstplan-Entwurf für „{ROSTER_AUFTRAG}“ lokal berechnen")
+    p_roster.add_argument("input", nargs="?", default="-", help="Auswahl als JSON (Standard: stdin)")
+    p_roster.add_argument("--prompt", action="store_true", help="kompletten Prompt mit eingebettetem Entwurf ausgeben")
+    p_roster.add_argument("--time-limit", type=float, default=0.5, help="Sekunden für die lokale Suche")
+    p_roster.add_argument("--instances", type=int, default=0, metavar="N", help="Benchmark: N erzeugte Instanzen lösen")
+    p_roster.add_argument("--staff", type=int, default=30, help="Teamgröße der erzeugten Instanzen")
+    p_sim = sub.add_parser("similar", help=f"ähnliche frühere Freitexte finden bzw. archivieren ({SIMILAR_ENV})")
+    p_sim.add_argument("text", nargs="?", help="Anfragetext (mit --auftrag und --field)")
+    p_sim.add_argument("--dir", help=f"Index-Verzeichnis (Standard: {SIMILAR_ENV})")
+    p_sim.add_argument("--add", metavar="JSONL", help="Freitexte dieser Auswahlen archivieren (- = stdin)")
+    p_sim.add_argument("--scope", help="Geltungsbereich des Archivs (user:… bzw. org:…)")
+    p_sim.add_argument("--bereich")
+    p_sim.add_argument("--auftrag")
+    p_sim.add_argument("--field")
+    p_sim.add_argument("-k", type=int, default=3)
+    p_sim.add_argument("--synthetic", type=int, default=0, metavar="N", help="Benchmark: N erzeugte Einträge, Anfragezeiten messen")
+    p_sim.add_argument("--no-numpy", action="store_true", help="reine Python-Variante erzwingen")
+    p_mrep = sub.add_parser("metrics-report", help=f"p50/p95/p99 je Phase aus dem JSONL-Log ({METRICS_ENV}=jsonl:…)")
+    p_mrep.add_argument("log")
+    p_pack = sub.add_parser("pack-export", help="eingebauten Bereich als Template-Pack (JSON) ausgeben – Vorlage für neue Packs")
+    p_pack.add_argument("-o", "--output", default="-")
+    p_stub = sub.add_parser("llm-stub", help="lokaler OpenAI-kompatibler Stub-Server (Tests/Demo)")
+    p_stub.add_argument("--host", default="127.0.0.1")
+    p_stub.add_argument("--port", type=int, default=8766)
+    p_stub.add_argument("--delay", type=float, default=0.02, help="Sekunden je gestreamtem Wort")
+    p_send = sub.add_parser("send", help=f"Prompt an das LLM senden ({LLM_URL_ENV})")
+    p_send.add_argument("input", nargs="?", default="-", help="Prompt-Datei (Standard: stdin)")
+    p_send.add_argument("--selections", action="store_true", help="Eingabe ist eine JSON-Auswahl statt eines Prompts")
+    p_drafts = sub.add_parser("drafts-stress", help="Stresstest des SQLite-Entwurfsspeichers")
+    p_drafts.add_argument("--sessions", type=int, default=300)
+    p_drafts.add_argument("--seconds", type=float, default=5.0)
+    p_drafts.add_argument("--rate", type=float, default=8.0, help="Tastendrücke je Sekunde und Sitzung")
+    p_drafts.add_argument("--debounce", type=float, default=0.5)
+    p_drafts.add_argument("--db", help="Datenbankdatei (Standard: temporär)")
     args,_ = parser.parse_known_args()
     if args.test:
         sys.exit(run_tests())
+    if args.bench:
+        sys.exit(run_compose_benchmark())
+    if args.command == "batch":
+        sys.exit(_cli_batch(args))
+    if args.command == "bench":
+        sys.exit(_cli_bench(args))
+    if args.command == "memsim":
+        sys.exit(_cli_memsim(args))
+    if args.command == "enumerate":
+        sys.exit(_cli_enumerate(args))
+    if args.command == "search":
+        sys.exit(_cli_search(args))
+    if args.command == "roster":
+        sys.exit(_cli_roster(args))
+    if args.command == "similar":
+        sys.exit(_cli_similar(args))
+    if args.command == "metrics-report":
+        sys.exit(_cli_metrics_report(args))
+    if args.command == "pack-export":
+        text = json.dumps(BUILTIN_PACK.to_data(), ensure_ascii=False, indent=2) + "\n"
+        if args.output == "-": sys.stdout.write(text)
+        else:
+            with open(args.output, "w", encoding="utf-8") as f: f.write(text)
+        sys.exit(0)
+    if args.command == "llm-stub":
+        sys.exit(_cli_llm_stub(args))
+    if args.command == "send":
+        sys.exit(_cli_send(args))
+    if args.command == "privacy-audit":
+        sys.exit(_cli_privacy_audit(args))
+    if args.command == "export-bundle":
+        sys.exit(_cli_export_bundle(args))
+    if args.command == "drafts-stress":
+        sys.exit(_cli_drafts_stress(args))
+    if args.command == "serve":
+        sys.exit(run_server(args.host, args.port, args.cache_size))
+    if args.command == "loadtest":
+        sys.exit(_cli_loadtest(args))
     run_streamlit_app()
 
 if __name__ == "__main__":